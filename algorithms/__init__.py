@@ -1,6 +1,7 @@
 import json
 
-from db_driver import DRIVER_BYTEORDER
+# the byte order of the driver protocol, the algorithms do not depend on the driver
+BYTEORDER = 'big'
 
 
 class Frozen:
@@ -19,6 +20,13 @@ class Frozen:
     def froze(self):
         self._is_frozen = True
 
+    def unfroze(self):
+        self._is_frozen = False
+
+    @property
+    def is_frozen(self) -> bool:
+        return self._is_frozen
+
     decorator = staticmethod(decorator)
 
 
@@ -27,7 +35,7 @@ def to_bytes(obj) -> bytearray:
         return obj.encode('utf-8')
 
     if isinstance(obj, int):
-        return obj.to_bytes((obj.bit_length() + 7) // 8, byteorder=DRIVER_BYTEORDER)
+        return obj.to_bytes((obj.bit_length() + 7) // 8, byteorder=BYTEORDER)
 
     if isinstance(obj, list):
         return str(obj).encode('utf-8')
@@ -49,3 +57,42 @@ def to_bytearray_from_values(d: dict, acc: bytearray = None) -> bytearray:
             acc.extend(to_bytes(value))
 
     return acc
+
+
+def _value_contribution(value) -> bytearray:
+    if isinstance(value, dict):
+        return to_bytearray_from_values(value)
+
+    return bytearray(to_bytes(value))
+
+
+def diff_bytearrays_from_values(old: dict, new: dict, removed: bytearray = None, added: bytearray = None) -> tuple:
+    # Returns the bytes which left the document and the bytes which came into it.
+    # Together with to_bytearray_from_values it allows to maintain additive digests
+    # (SBF, PH2) without hashing the unchanged values again
+    if removed is None:
+        removed = bytearray()
+    if added is None:
+        added = bytearray()
+
+    for key, old_value in old.items():
+        if key not in new:
+            removed.extend(_value_contribution(old_value))
+
+    for key, new_value in new.items():
+        if key not in old:
+            added.extend(_value_contribution(new_value))
+            continue
+
+        old_value = old[key]
+        if isinstance(old_value, dict) and isinstance(new_value, dict):
+            diff_bytearrays_from_values(old_value, new_value, removed, added)
+            continue
+
+        if type(old_value) is type(new_value) and old_value == new_value:
+            continue
+
+        removed.extend(_value_contribution(old_value))
+        added.extend(_value_contribution(new_value))
+
+    return removed, added
@@ -0,0 +1,69 @@
+import bisect
+import hashlib
+
+from algorithms import BYTEORDER
+
+TOKEN_SIZE = 8
+DEFAULT_VIRTUAL_NODES = 64
+
+
+def token(key: bytes) -> int:
+    h = hashlib.blake2b(key, digest_size=TOKEN_SIZE)
+    return int.from_bytes(h.digest(), byteorder=BYTEORDER, signed=False)
+
+
+class HashRing:
+    # Every node has virtual_nodes tokens on the ring. A document is stored by the replication_factor
+    # distinct nodes which follow the token of (collection, doc_id) clockwise, so adding or removing
+    # a node moves only the documents of the ranges next to its tokens
+    SEPARATOR = b'/'
+
+    def __init__(self, nodes: list, replication_factor: int, virtual_nodes: int = DEFAULT_VIRTUAL_NODES):
+        if len(nodes) == 0:
+            raise Exception('Ring should have nodes')
+
+        if replication_factor < 1 or virtual_nodes < 1:
+            raise Exception('Replication factor and virtual nodes should be positive')
+
+        self._nodes = sorted(set(nodes))
+        self._replication_factor = min(replication_factor, len(self._nodes))
+
+        tokens = []
+        for node in self._nodes:
+            for i in range(virtual_nodes):
+                tokens.append((token(f"{node}#{i}".encode('utf-8')), node))
+        tokens.sort()
+
+        self._tokens = [t for t, _ in tokens]
+        self._token_nodes = [node for _, node in tokens]
+
+    @property
+    def nodes(self) -> list:
+        return list(self._nodes)
+
+    @property
+    def replication_factor(self) -> int:
+        return self._replication_factor
+
+    @staticmethod
+    def key(collection_name: str, doc_id: str) -> bytes:
+        return collection_name.encode('utf-8') + HashRing.SEPARATOR + str(doc_id).encode('utf-8')
+
+    def replicas(self, collection_name: str, doc_id: str) -> list:
+        # the first one is the primary replica
+        index = bisect.bisect_right(self._tokens, token(HashRing.key(collection_name, doc_id)))
+
+        res = []
+        for i in range(len(self._tokens)):
+            node = self._token_nodes[(index + i) % len(self._tokens)]
+            if node in res:
+                continue
+
+            res.append(node)
+            if len(res) == self._replication_factor:
+                break
+
+        return res
+
+    def is_replica(self, node: str, collection_name: str, doc_id: str) -> bool:
+        return node in self.replicas(collection_name, doc_id)
@@ -0,0 +1,258 @@
+import hashlib
+import json
+
+from algorithms import Frozen, to_bytearray_from_values
+from algorithms.ph2 import PH2
+from algorithms.spectral_bloom_filter import SpectralBloomFilter
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+SPEC_DELIMITER = ':'
+MAX_DIGEST_SIZE = 64
+
+
+class Digest(Frozen):
+    NAME = None
+    CODE = None
+    DEFAULT_SIZE = None
+    IS_ADDITIVE = False
+
+    def __init__(self, digest_size: int = None):
+        super().__init__()
+        if digest_size is None:
+            digest_size = self.DEFAULT_SIZE
+
+        self._validate_size(digest_size)
+        self._digest_size = digest_size
+
+    def _validate_size(self, digest_size: int):
+        if digest_size != self.DEFAULT_SIZE:
+            raise Exception(f"Digest {self.NAME} supports only {self.DEFAULT_SIZE} bytes size")
+
+    @property
+    def digest_size(self) -> int:
+        return self._digest_size
+
+    @property
+    def spec(self) -> str:
+        return f"{self.NAME}{SPEC_DELIMITER}{self._digest_size}"
+
+    @staticmethod
+    def encode_document(document: dict) -> bytes:
+        # the canonical serialization keeps the keys and the boundaries of the values,
+        # so a renamed key or a value moved to another key changes the digest
+        return json.dumps(document, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def update(self, _bytes: bytes): ...
+
+    def remove(self, _bytes: bytes):
+        raise Exception(f"Digest {self.NAME} is not additive")
+
+    def copy(self) -> 'Digest': ...
+
+    def get(self) -> bytes: ...
+
+
+class SbfPh2Digest(Digest):
+    NAME = 'sbf_ph2'
+    CODE = 1
+    DEFAULT_SIZE = 14
+    IS_ADDITIVE = True
+
+    def __init__(self, digest_size: int = None):
+        super().__init__(digest_size)
+        self._sbf = SpectralBloomFilter()
+        self._ph2 = PH2()
+
+    @staticmethod
+    def encode_document(document: dict) -> bytes:
+        # the additive digest is maintained by the values only, see diff_bytearrays_from_values
+        return to_bytearray_from_values(document)
+
+    @property
+    def sbf(self) -> SpectralBloomFilter:
+        return self._sbf
+
+    @property
+    def ph2(self) -> PH2:
+        return self._ph2
+
+    @Frozen.decorator
+    def update(self, _bytes: bytes):
+        self._sbf.add(_bytes)
+        self._ph2.append(_bytes)
+
+    @Frozen.decorator
+    def remove(self, _bytes: bytes):
+        self._sbf.remove(_bytes)
+        self._ph2.remove(_bytes)
+
+    def froze(self):
+        super().froze()
+        self._sbf.froze()
+        self._ph2.froze()
+
+    def copy(self) -> 'SbfPh2Digest':
+        res = SbfPh2Digest()
+        res._sbf = self._sbf.copy()
+        res._ph2 = self._ph2.copy()
+
+        return res
+
+    def get(self) -> bytes:
+        return self._sbf.get() + self._ph2.hashing()
+
+
+class StreamingHashDigest(Digest):
+    MIN_SIZE = 1
+    MAX_SIZE = DEFAULT_SIZE = None
+
+    def __init__(self, digest_size: int = None):
+        super().__init__(digest_size)
+        self._hash = self._new_hash()
+
+    def _validate_size(self, digest_size: int):
+        if not self.MIN_SIZE <= digest_size <= self.MAX_SIZE:
+            raise Exception(f"Digest {self.NAME} supports {self.MIN_SIZE}-{self.MAX_SIZE} bytes size")
+
+    def _new_hash(self): ...
+
+    @Frozen.decorator
+    def update(self, _bytes: bytes):
+        self._hash.update(_bytes)
+
+    def copy(self) -> 'StreamingHashDigest':
+        res = type(self)(self._digest_size)
+        res._hash = self._hash.copy()
+
+        return res
+
+    def get(self) -> bytes:
+        return self._hash.digest()[:self._digest_size]
+
+
+class Blake2bDigest(StreamingHashDigest):
+    NAME = 'blake2b'
+    CODE = 2
+    DEFAULT_SIZE = 16
+    MAX_SIZE = hashlib.blake2b.MAX_DIGEST_SIZE
+
+    def _new_hash(self):
+        return hashlib.blake2b(digest_size=self._digest_size)
+
+
+class XXH64Digest(StreamingHashDigest):
+    NAME = 'xxh64'
+    CODE = 3
+    DEFAULT_SIZE = MAX_SIZE = 8
+
+    def _new_hash(self):
+        return xxhash.xxh64()
+
+
+class XXH3Digest(StreamingHashDigest):
+    NAME = 'xxh3_128'
+    CODE = 4
+    DEFAULT_SIZE = MAX_SIZE = 16
+
+    def _new_hash(self):
+        return xxhash.xxh3_128()
+
+
+DEFAULT_DIGEST = SbfPh2Digest.NAME
+
+_digests_by_name = dict()
+_digests_by_code = dict()
+
+
+def register_digest(digest_class):
+    if digest_class.CODE in _digests_by_code.keys():
+        raise Exception(f"Digest code {digest_class.CODE} is already registered")
+
+    _digests_by_name[digest_class.NAME] = digest_class
+    _digests_by_code[digest_class.CODE] = digest_class
+
+
+def registered_digests() -> list:
+    return list(_digests_by_name.keys())
+
+
+def parse_spec(spec: str) -> tuple:
+    # 'blake2b:8' -> ('blake2b', 8), 'blake2b' -> ('blake2b', None)
+    if SPEC_DELIMITER not in spec:
+        return spec, None
+
+    name, digest_size = spec.split(SPEC_DELIMITER, 1)
+    return name, int(digest_size)
+
+
+def is_supported(spec: str) -> bool:
+    name, _ = parse_spec(spec)
+    return name in _digests_by_name.keys()
+
+
+def create_digest(spec: str = DEFAULT_DIGEST) -> Digest:
+    name, digest_size = parse_spec(spec)
+    if name not in _digests_by_name.keys():
+        raise Exception(f"Unknown digest {name}")
+
+    res = _digests_by_name[name](digest_size)
+    return res
+
+
+def spec_by_code(code: int, digest_size: int) -> str:
+    # returns None if the digest is not available on this node
+    if code not in _digests_by_code.keys():
+        return None
+
+    res = f"{_digests_by_code[code].NAME}{SPEC_DELIMITER}{digest_size}"
+    return res
+
+
+def code_by_spec(spec: str) -> int:
+    name, _ = parse_spec(spec)
+    return _digests_by_name[name].CODE
+
+
+def header_by_spec(spec: str) -> bytes:
+    # |DIGEST_CODE|DIGEST_SIZE|
+    #     1byte       1byte
+    digest = create_digest(spec)
+    return bytes([digest.CODE, digest.digest_size])
+
+
+def calculate_digest(_bytearray: bytes, spec: str = DEFAULT_DIGEST) -> Digest:
+    res = create_digest(spec)
+    res.update(_bytearray)
+    res.froze()
+
+    return res
+
+
+def calculate_document_digest(document: dict, spec: str = DEFAULT_DIGEST) -> Digest:
+    res = create_digest(spec)
+    res.update(res.encode_document(document))
+    res.froze()
+
+    return res
+
+
+def recalculate_digest(digest: Digest, removed: bytes, added: bytes) -> Digest:
+    # the stored digest could be read by AAE at the same time,
+    # so the changes are applied to the unfrozen copy
+    res = digest.copy()
+    res.remove(removed)
+    res.update(added)
+    res.froze()
+
+    return res
+
+
+register_digest(SbfPh2Digest)
+register_digest(Blake2bDigest)
+if xxhash is not None:
+    register_digest(XXH64Digest)
+    register_digest(XXH3Digest)
@@ -0,0 +1,215 @@
+import hashlib
+
+from algorithms import BYTEORDER
+
+HASH_SUM_SIZE = 8
+COUNT_SIZE = 4
+
+
+def _hash(key: bytes, salt: bytes) -> int:
+    h = hashlib.blake2b(key, digest_size=HASH_SUM_SIZE, salt=salt)
+    return int.from_bytes(h.digest(), byteorder=BYTEORDER, signed=False)
+
+
+class InvertibleBloomLookupTable:
+    # Cells are split into hash_count subtables, one per hash function.
+    # The subtable size is a power of two, so a table could be folded into a smaller one
+    # by adding the halves: h % (size / 2) == (h % size) % (size / 2)
+    CHECKSUM_SALT = b'checksum'
+    HEADER_LENGTH = 4
+
+    def __init__(self, subtable_size: int, key_size: int, hash_count: int = 3):
+        if subtable_size & (subtable_size - 1) != 0:
+            raise Exception(f"Subtable size {subtable_size} is not a power of two")
+
+        self._subtable_size = subtable_size
+        self._key_size = key_size
+        self._hash_count = hash_count
+
+        cells = subtable_size * hash_count
+        self._counts = [0] * cells
+        self._key_sums = [0] * cells
+        self._hash_sums = [0] * cells
+
+    @property
+    def subtable_size(self) -> int:
+        return self._subtable_size
+
+    @property
+    def key_size(self) -> int:
+        return self._key_size
+
+    @property
+    def hash_count(self) -> int:
+        return self._hash_count
+
+    def _indexes(self, key: bytes) -> list:
+        res = []
+        for i in range(self._hash_count):
+            h = _hash(key, bytes([i]))
+            res.append(i * self._subtable_size + h % self._subtable_size)
+
+        return res
+
+    def _apply(self, key: bytes, sign: int):
+        if len(key) != self._key_size:
+            raise Exception(f"Key size should be {self._key_size} bytes")
+
+        key_int = int.from_bytes(key, byteorder=BYTEORDER, signed=False)
+        checksum = _hash(key, InvertibleBloomLookupTable.CHECKSUM_SALT)
+        for index in self._indexes(key):
+            self._counts[index] += sign
+            self._key_sums[index] ^= key_int
+            self._hash_sums[index] ^= checksum
+
+    def insert(self, key: bytes):
+        self._apply(key, 1)
+
+    def erase(self, key: bytes):
+        self._apply(key, -1)
+
+    def _check_compatible(self, other: 'InvertibleBloomLookupTable'):
+        if (self._subtable_size, self._key_size, self._hash_count) != \
+                (other._subtable_size, other._key_size, other._hash_count):
+            raise Exception('Tables have different parameters')
+
+    def subtract(self, other: 'InvertibleBloomLookupTable') -> 'InvertibleBloomLookupTable':
+        self._check_compatible(other)
+
+        res = InvertibleBloomLookupTable(self._subtable_size, self._key_size, self._hash_count)
+        for i in range(len(self._counts)):
+            res._counts[i] = self._counts[i] - other._counts[i]
+            res._key_sums[i] = self._key_sums[i] ^ other._key_sums[i]
+            res._hash_sums[i] = self._hash_sums[i] ^ other._hash_sums[i]
+
+        return res
+
+    def fold(self, subtable_size: int) -> 'InvertibleBloomLookupTable':
+        if subtable_size > self._subtable_size or self._subtable_size % subtable_size != 0:
+            raise Exception(f"Could not fold {self._subtable_size} cells subtable to {subtable_size}")
+
+        res = InvertibleBloomLookupTable(subtable_size, self._key_size, self._hash_count)
+        for i in range(len(self._counts)):
+            subtable, offset = divmod(i, self._subtable_size)
+            index = subtable * subtable_size + offset % subtable_size
+
+            res._counts[index] += self._counts[i]
+            res._key_sums[index] ^= self._key_sums[i]
+            res._hash_sums[index] ^= self._hash_sums[i]
+
+        return res
+
+    def copy(self) -> 'InvertibleBloomLookupTable':
+        return self.fold(self._subtable_size)
+
+    def _is_pure(self, index: int) -> bool:
+        if self._counts[index] not in [1, -1]:
+            return False
+
+        key = self._key_sums[index].to_bytes(self._key_size, byteorder=BYTEORDER, signed=False)
+        return self._hash_sums[index] == _hash(key, InvertibleBloomLookupTable.CHECKSUM_SALT)
+
+    def decode(self) -> tuple:
+        # Returns keys which only the minuend has, keys which only the subtrahend has and
+        # whether the decoding succeeded. The table itself is not changed
+        table = self.copy()
+        positive = set()
+        negative = set()
+
+        pure = [i for i in range(len(table._counts)) if table._is_pure(i)]
+        while len(pure) > 0:
+            index = pure.pop()
+            if not table._is_pure(index):
+                continue
+
+            sign = table._counts[index]
+            key = table._key_sums[index].to_bytes(self._key_size, byteorder=BYTEORDER, signed=False)
+            if sign > 0:
+                positive.add(key)
+            else:
+                negative.add(key)
+
+            table._apply(key, -sign)
+            pure.extend(i for i in table._indexes(key) if table._is_pure(i))
+
+        is_decoded = all(count == 0 for count in table._counts) and \
+            all(key_sum == 0 for key_sum in table._key_sums)
+
+        return positive, negative, is_decoded
+
+    @staticmethod
+    def cell_length(key_size: int) -> int:
+        return COUNT_SIZE + key_size + HASH_SUM_SIZE
+
+    def to_bytes(self) -> bytearray:
+        # |Subtable size|Hash count|Key size|   Cells   |
+        #     2bytes       1byte     1byte    Count(4) Key sum(key size) Hash sum(8)
+        res = bytearray()
+        res.extend(self._subtable_size.to_bytes(2, BYTEORDER, signed=False))
+        res.extend(bytes([self._hash_count, self._key_size]))
+
+        for i in range(len(self._counts)):
+            res.extend(self._counts[i].to_bytes(COUNT_SIZE, BYTEORDER, signed=True))
+            res.extend(self._key_sums[i].to_bytes(self._key_size, BYTEORDER, signed=False))
+            res.extend(self._hash_sums[i].to_bytes(HASH_SUM_SIZE, BYTEORDER, signed=False))
+
+        return res
+
+    @staticmethod
+    def from_bytes(src: bytes) -> 'InvertibleBloomLookupTable':
+        subtable_size = int.from_bytes(src[:2], BYTEORDER, signed=False)
+        hash_count, key_size = src[2], src[3]
+        res = InvertibleBloomLookupTable(subtable_size, key_size, hash_count)
+
+        offset = InvertibleBloomLookupTable.HEADER_LENGTH
+        for i in range(len(res._counts)):
+            res._counts[i] = int.from_bytes(src[offset:offset + COUNT_SIZE], BYTEORDER, signed=True)
+            offset += COUNT_SIZE
+            res._key_sums[i] = int.from_bytes(src[offset:offset + key_size], BYTEORDER, signed=False)
+            offset += key_size
+            res._hash_sums[i] = int.from_bytes(src[offset:offset + HASH_SUM_SIZE], BYTEORDER, signed=False)
+            offset += HASH_SUM_SIZE
+
+        return res
+
+
+class DocumentSetSketch:
+    # Maintains IBLT of (doc_id, digest) pairs of the collection at the biggest size.
+    # An exchange folds it to the size requested by the neighbor
+    FINGERPRINT_SIZE = 8
+    MAX_SUBTABLE_SIZE = 256
+    HASH_COUNT = 3
+
+    def __init__(self, doc_id_length: int):
+        self._doc_id_length = doc_id_length
+        self._keys = dict()
+        self._table = InvertibleBloomLookupTable(
+            DocumentSetSketch.MAX_SUBTABLE_SIZE, self.key_size, DocumentSetSketch.HASH_COUNT)
+
+    @property
+    def key_size(self) -> int:
+        return self._doc_id_length + DocumentSetSketch.FINGERPRINT_SIZE
+
+    def key(self, doc_id: str, digest: bytes) -> bytes:
+        fingerprint = hashlib.blake2b(digest, digest_size=DocumentSetSketch.FINGERPRINT_SIZE).digest()
+        return doc_id.encode('utf-8') + fingerprint
+
+    def doc_id(self, key: bytes) -> str:
+        return key[:self._doc_id_length].decode('utf-8')
+
+    def set(self, doc_id: str, digest: bytes):
+        self.remove(doc_id)
+
+        key = self.key(doc_id, digest)
+        self._keys[doc_id] = key
+        self._table.insert(key)
+
+    def remove(self, doc_id: str):
+        key = self._keys.pop(doc_id, None)
+        if key is None:
+            return
+
+        self._table.erase(key)
+
+    def sketch(self, subtable_size: int) -> InvertibleBloomLookupTable:
+        return self._table.fold(subtable_size)
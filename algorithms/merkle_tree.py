@@ -0,0 +1,92 @@
+import hashlib
+
+
+class MerkleTree:
+    # The documents are bucketed by the time range of their ID: year, month, day, hour, minute, second.
+    # A node hash is XOR of the leaf hashes under it, so a change of one document updates
+    # the path from its leaf to the root only
+    PREFIX_LENGTHS = (4, 7, 10, 13, 16, 19)
+    HASH_SIZE = 16
+    ROOT = ''
+
+    def __init__(self):
+        self._hashes = {MerkleTree.ROOT: 0}
+        self._children = {MerkleTree.ROOT: set()}
+        self._leaves = dict()
+
+    @staticmethod
+    def _path(doc_id: str) -> list:
+        res = [MerkleTree.ROOT]
+        res.extend(doc_id[:length] for length in MerkleTree.PREFIX_LENGTHS)
+
+        return res
+
+    @staticmethod
+    def _leaf_hash(doc_id: str, digest: bytes) -> int:
+        h = hashlib.blake2b(doc_id.encode('utf-8'), digest_size=MerkleTree.HASH_SIZE)
+        h.update(digest)
+
+        return int.from_bytes(h.digest(), byteorder='big', signed=False)
+
+    @staticmethod
+    def is_leaf(key: str) -> bool:
+        return len(key) > MerkleTree.PREFIX_LENGTHS[-1]
+
+    def __len__(self):
+        return len(self._leaves)
+
+    def set(self, doc_id: str, digest: bytes):
+        self.remove(doc_id)
+
+        leaf = MerkleTree._leaf_hash(doc_id, digest)
+        self._leaves[doc_id] = leaf
+
+        path = MerkleTree._path(doc_id)
+        for parent, child in zip(path, path[1:] + [doc_id]):
+            if parent not in self._children.keys():
+                self._children[parent] = set()
+            self._children[parent].add(child)
+
+        for node in path:
+            self._hashes[node] = self._hashes.get(node, 0) ^ leaf
+
+    def remove(self, doc_id: str):
+        leaf = self._leaves.pop(doc_id, None)
+        if leaf is None:
+            return
+
+        path = MerkleTree._path(doc_id)
+        for node in path:
+            self._hashes[node] ^= leaf
+
+        # the empty buckets are dropped from the bottom to the root
+        child = doc_id
+        for node in reversed(path):
+            self._children[node].discard(child)
+            if node == MerkleTree.ROOT or len(self._children[node]) > 0:
+                break
+
+            del self._children[node]
+            del self._hashes[node]
+            child = node
+
+    def _to_bytes(self, value: int) -> bytes:
+        return value.to_bytes(MerkleTree.HASH_SIZE, byteorder='big', signed=False)
+
+    def hash(self, prefix: str = ROOT) -> bytes:
+        if MerkleTree.is_leaf(prefix):
+            value = self._leaves.get(prefix)
+        else:
+            value = self._hashes.get(prefix)
+
+        if value is None:
+            return None
+
+        return self._to_bytes(value)
+
+    def children(self, prefix: str = ROOT) -> dict:
+        res = dict()
+        for child in self._children.get(prefix, set()):
+            res[child] = self.hash(child)
+
+        return res
@@ -1,4 +1,5 @@
 from bisect import bisect_left
+from collections import Counter
 
 from algorithms import Frozen
 
@@ -15,71 +16,83 @@ PRIME_NUMBERS = [
 ]
 
 
+def search(alist, item):
+    'Locate the leftmost value exactly equal to item'
+    i = bisect_left(alist, item)
+    if i != len(alist) and alist[i] == item:
+        return True
+
+    return False
+
+
 class PH2(Frozen):
 
     def __init__(self):
         super().__init__()
-        self._bytes = bytearray()
+        # The hash depends only on the counts and the sums of the blocks,
+        # so the working state keeps them instead of the bytes themselves.
+        # It makes append/remove/merge cost O(changed bytes)
+        self._regular_count = 0
+        self._primes_count = 0
+        self._regular_total = 0
+        self._primes_total = 0
 
     @Frozen.decorator
     def append(self, _bytes: bytes):
-        self._bytes.extend(_bytes)
-
-    def hashing(self) -> bytes:
-        required_bytes_per_block = BLOCK_SIZE // 8
+        self._apply(_bytes, 1)
 
-        need_to_add_bytes = required_bytes_per_block - (len(self._bytes) % required_bytes_per_block)
-        need_to_add_bytes = need_to_add_bytes % required_bytes_per_block # to avoid extra adding
-        self._bytes.extend([0] * need_to_add_bytes)
+    @Frozen.decorator
+    def remove(self, _bytes: bytes):
+        self._apply(_bytes, -1)
 
-        bytes_len = len(self._bytes)
+    @Frozen.decorator
+    def merge(self, other: 'PH2'):
+        self._regular_count += other._regular_count
+        self._primes_count += other._primes_count
+        self._regular_total += other._regular_total
+        self._primes_total += other._primes_total
+
+    def _apply(self, _bytes: bytes, sign: int):
+        for item, count in Counter(PH2._blocks(_bytes)).items():
+            if search(PRIME_NUMBERS, item):
+                self._primes_count += sign * count
+                self._primes_total += sign * count * item
+            else:
+                self._regular_count += sign * count
+                self._regular_total += sign * count * item
 
-        def search(alist, item):
-            'Locate the leftmost value exactly equal to item'
-            i = bisect_left(alist, item)
-            if i != len(alist) and alist[i] == item:
-                return True
+    @staticmethod
+    def _blocks(_bytes: bytes):
+        required_bytes_per_block = BLOCK_SIZE // 8
+        if required_bytes_per_block == 1:
+            return _bytes
 
-            return False
+        need_to_add_bytes = required_bytes_per_block - (len(_bytes) % required_bytes_per_block)
+        need_to_add_bytes = need_to_add_bytes % required_bytes_per_block # to avoid extra adding
+        _bytes = bytes(_bytes) + bytes(need_to_add_bytes)
 
-        sum_regular = 0
-        overflow_regular = 0
-        sum_primes = 0
-        overflow_primes = 0
-        primes_count = 0
-        regular_count = 0
+        return [
+            int.from_bytes(_bytes[i:i + required_bytes_per_block:1], byteorder='big', signed=False)
+            for i in range(0, len(_bytes), required_bytes_per_block)
+        ]
 
-        for i in range(0, bytes_len, required_bytes_per_block):
-            start = i
-            end = i + required_bytes_per_block
-            part = self._bytes[start:end:1]
-            item = int.from_bytes(part, byteorder='big', signed=False)
+    def copy(self) -> 'PH2':
+        res = PH2()
+        res.merge(self)
 
-            if search(PRIME_NUMBERS, item):
-                diff = MAX_VALUE - sum_primes
-                if item >= diff:
-                    sum_primes = item - diff
-                    overflow_primes = (overflow_primes + 1) % MAX_VALUE
-                else:
-                    sum_primes += item
-                primes_count = (primes_count + 1) % MAX_VALUE
-            else:
-                diff = MAX_VALUE - sum_regular
-                if item >= diff:
-                    sum_regular = item - diff
-                    overflow_regular = (overflow_regular + 1) % MAX_VALUE
-                else:
-                    sum_regular += item
-                regular_count = (regular_count + 1) % MAX_VALUE
+        return res
 
+    def hashing(self) -> bytes:
+        # every overflow of the running sum subtracts MAX_VALUE from it,
+        # so the sum is the total modulo MAX_VALUE and the overflows are the quotient
         return bytes(
             [
-                regular_count % MAX_VALUE,
-                primes_count % MAX_VALUE,
-                sum_regular % MAX_VALUE,
-                overflow_regular % MAX_VALUE,
-                sum_primes % MAX_VALUE,
-                overflow_primes % MAX_VALUE,
+                self._regular_count % MAX_VALUE,
+                self._primes_count % MAX_VALUE,
+                self._regular_total % MAX_VALUE,
+                (self._regular_total // MAX_VALUE) % MAX_VALUE,
+                self._primes_total % MAX_VALUE,
+                (self._primes_total // MAX_VALUE) % MAX_VALUE,
             ]
         )
 
@@ -1,8 +1,11 @@
+from collections import Counter
+
 from algorithms import Frozen
 
 
 class SpectralBloomFilter(Frozen):
     PRIMES = [2, 3, 5, 7, 11, 13, 17]
+    MODULO = 255
 
     def __init__(self, *args, **kwargs):
         super().__init__()
@@ -11,19 +14,38 @@ class SpectralBloomFilter(Frozen):
 
     @Frozen.decorator
     def add(self, _bytes: bytes):
-        for _b in _bytes:
-            self._add_single(_b)
+        self._apply(_bytes, 1)
+
+    @Frozen.decorator
+    def remove(self, _bytes: bytes):
+        # counters are additive, so removal of the bytes which were added before
+        # restores the previous state of the filter
+        self._apply(_bytes, -1)
 
     @Frozen.decorator
-    def _add_single(self, _byte: int):
+    def merge(self, other: 'SpectralBloomFilter'):
+        for i, entry in enumerate(other._entries):
+            self._entries[i] = (self._entries[i] + entry) % SpectralBloomFilter.MODULO
+
+    def _apply(self, _bytes: bytes, sign: int):
+        for _byte, count in Counter(_bytes).items():
+            self._add_single(_byte, sign * count)
+
+    def _add_single(self, _byte: int, times: int = 1):
         is_jocker = True
         for i, prime in enumerate(SpectralBloomFilter.PRIMES):
             if _byte % prime == 0:
-                self._entries[i] = (self._entries[i] + 1) % 255
+                self._entries[i] = (self._entries[i] + times) % SpectralBloomFilter.MODULO
                 is_jocker = False
 
         if is_jocker:
-            self._entries[-1] = (self._entries[-1] + 1) % 255
+            self._entries[-1] = (self._entries[-1] + times) % SpectralBloomFilter.MODULO
+
+    def copy(self) -> 'SpectralBloomFilter':
+        res = SpectralBloomFilter()
+        res._entries = list(self._entries)
+
+        return res
 
     def get(self) -> bytes:
         return bytes(self._entries)
@@ -1,12 +1,17 @@
+import datetime
 import json
+import logging
 import os
+import threading
+import time
 from enum import Enum
 from queue import Queue
 
+from algorithms.digest import DEFAULT_DIGEST
 from autumn_db import DocumentId, DOC_ID_LENGTH
 from autumn_db.data_storage.collection import CollectionOperations
 from autumn_db.data_storage.collection.impl import CollectionOperationsImpl
-from autumn_db.event_bus import EventBus, DocumentOrientedEvent
+from autumn_db.event_bus import EventBus, DocumentOrientedEvent, DEFAULT_EVENT_PAYLOAD_MAX_SIZE
 from db_driver import DocumentOperation, CollectionName
 
 
@@ -23,6 +28,9 @@ class DBOperation:
         self._oper_type = oper_type
         self._collection = collection
         self._is_finished = False
+        # the last error of the operation, the failed operation could be retried
+        self._error = None
+        self._is_cancelled = False
 
     @property
     def collection(self) -> str:
@@ -34,6 +42,20 @@ class DBOperation:
     def is_finished(self) -> bool:
         return self._is_finished
 
+    @property
+    def error(self) -> Exception:
+        return self._error
+
+    def set_error(self, error: Exception):
+        self._error = error
+
+    def cancel(self):
+        # the operation which is not waited for anymore is not retried
+        self._is_cancelled = True
+
+    def is_cancelled(self) -> bool:
+        return self._is_cancelled
+
     @property
     def operation_type(self) -> DBOperationType:
         return self._oper_type
@@ -55,6 +77,7 @@ class ReadOperation(DocumentIdBasedOperation):
     def __init__(self, collection: str, document_id: DocumentId):
         super().__init__(DBOperationType.READ, collection, document_id)
         self._response = None
+        self._is_found = False
 
     @property
     def data(self) -> str:
@@ -67,12 +90,17 @@ class ReadOperation(DocumentIdBasedOperation):
         if self._response is not None:
             raise Exception('Setting second time is forbidden')
 
+        self._is_found = data is not None
         if data is None:
             data = str(data)
 
         self._response = data
         self.finished()
 
+    @property
+    def is_found(self) -> bool:
+        return self._is_found
+
 
 class DeleteOperation(DocumentIdBasedOperation):
 
@@ -82,10 +110,14 @@ class DeleteOperation(DocumentIdBasedOperation):
 
 class CreateOperation(DBOperation):
 
-    def __init__(self, collection: str, data: str):
+    def __init__(self, collection: str, data: str, write_quorum: int = None):
         super().__init__(DBOperationType.CREATE, collection)
         self._data = data
         self._doc_id = DocumentId()
+        # the number of the replicas which should persist the write before it is acknowledged,
+        # None means the write is acknowledged without waiting
+        self._write_quorum = write_quorum
+        self._updated_at = None
 
     @property
     def document_id(self) -> DocumentId:
@@ -95,17 +127,41 @@ class CreateOperation(DBOperation):
     def data(self) -> str:
         return self._data
 
+    @property
+    def write_quorum(self) -> int:
+        return self._write_quorum
+
+    @property
+    def updated_at(self) -> datetime.datetime:
+        return self._updated_at
+
+    def set_updated_at(self, updated_at: datetime.datetime):
+        self._updated_at = updated_at
+
 
 class UpdateOperation(DocumentIdBasedOperation):
 
-    def __init__(self, collection: str, document_id: DocumentId, data: str):
+    def __init__(self, collection: str, document_id: DocumentId, data: str, write_quorum: int = None):
         super().__init__(DBOperationType.UPDATE, collection, document_id)
         self._data = data
+        self._write_quorum = write_quorum
+        self._updated_at = None
 
     @property
     def data(self) -> str:
         return self._data
 
+    @property
+    def write_quorum(self) -> int:
+        return self._write_quorum
+
+    @property
+    def updated_at(self) -> datetime.datetime:
+        return self._updated_at
+
+    def set_updated_at(self, updated_at: datetime.datetime):
+        self._updated_at = updated_at
+
 
 class DatabaseOperations:
 
@@ -150,22 +206,33 @@ class DatabaseOperationsMockImpl(DatabaseOperations):
 
 class DBCoreEngine:
 
-    def __init__(self, db_holder: str = None):
+    def __init__(self, db_holder: str = None, incremental_snapshot: bool = False, deferred_snapshot: bool = False,
+                 digests: dict = None, default_digest: str = DEFAULT_DIGEST):
         if db_holder is None:
             db_holder = os.getcwd()
 
         self._db_holder = db_holder
+        self._incremental_snapshot = incremental_snapshot
+        self._deferred_snapshot = deferred_snapshot
+        # collection name -> digest spec, e.g. {'telemetry': 'blake2b:16'}
+        self._digests = dict() if digests is None else digests
+        self._default_digest = default_digest
+        # the collections keep the change logs only while they are served to the neighbors
+        self._change_logs = False
         if not os.path.exists(self._db_holder):
             os.mkdir(self._db_holder)
         self._collections = self._discover_existing()
+        # the collections could be created by the AAE workers at the same time
+        self._collections_lock = threading.RLock()
 
     def create_collection(self, name: str):
-        if name in self._collections.keys():
-            raise Exception(f"Collection {name} already exists")
-        collection = CollectionOperationsImpl(name, self._db_holder)
-        collection.create()
+        with self._collections_lock:
+            if name in self._collections.keys():
+                raise Exception(f"Collection {name} already exists")
+            collection = self._new_collection(name)
+            collection.create()
 
-        self._collections[name] = collection
+            self._collections[name] = collection
 
     def delete_collection(self, name: str):
         collection = self._collections[name]
@@ -173,7 +240,8 @@ class DBCoreEngine:
         del self._collections[name]
 
     def _discover_existing(self) -> dict:
-        collections_candidates = [f for f in os.scandir(self._db_holder) if f.is_dir()]
+        # the dot directories keep the service data, e.g. the hints of AAE
+        collections_candidates = [f for f in os.scandir(self._db_holder) if f.is_dir() and not f.name.startswith('.')]
 
         exclude = set()
         for candidate in collections_candidates:
@@ -186,23 +254,66 @@ class DBCoreEngine:
 
         collections = [entry for entry in collections_candidates if entry not in exclude]
 
-        result = {collection.name: CollectionOperationsImpl(collection.name, self._db_holder) for collection in collections}
+        result = {collection.name: self._new_collection(collection.name) for collection in collections}
         return result
 
+    def _new_collection(self, name: str) -> CollectionOperationsImpl:
+        digest = self._digests.get(name, self._default_digest)
+        res = CollectionOperationsImpl(name, self._db_holder, self._incremental_snapshot, self._deferred_snapshot, digest,
+                                       self._change_logs)
+        return res
+
+    def enable_change_logs(self):
+        # must be called before the writes
+        with self._collections_lock:
+            self._change_logs = True
+            for collection in self._collections.values():
+                collection.enable_change_log()
+
     @property
     def collections(self) -> dict:
         return self._collections
 
+    @property
+    def db_holder(self) -> str:
+        return self._db_holder
+
     def get_collection_safely(self, collection_name: str) -> CollectionOperations:
-        if collection_name not in self._collections.keys():
-            self.create_collection(collection_name)
+        with self._collections_lock:
+            if collection_name not in self._collections.keys():
+                self.create_collection(collection_name)
 
-        return self._collections[collection_name]
+            return self._collections[collection_name]
 
 
-class DBOperationEngine:
+class SnapshotWorker:
+    IDLE_TIMEOUT = 0.05
 
     def __init__(self, db_core: DBCoreEngine):
+        self._db_core_engine = db_core
+        self._is_stopped = False
+
+    def processing(self):
+        # calculates snapshots of the documents written in the deferred mode and of the ones found at start
+        while not self._is_stopped:
+            calculated = False
+            for collection in list(self._db_core_engine.collections.values()):
+                try:
+                    calculated = collection.calculate_pending_snapshot() or calculated
+                except Exception as e:
+                    logging.warning(e)
+
+            if not calculated:
+                time.sleep(SnapshotWorker.IDLE_TIMEOUT)
+
+    def stop(self):
+        self._is_stopped = True
+
+
+class DBOperationEngine:
+
+    def __init__(self, db_core: DBCoreEngine, event_payload_max_size: int = DEFAULT_EVENT_PAYLOAD_MAX_SIZE,
+                 async_events: bool = False):
         self._in_progress = set()
         self._read_queue = Queue()
         self._create_queue = Queue()
@@ -213,7 +324,10 @@ class DBOperationEngine:
 
         self._is_stopped = False
 
-        self._event_bus = EventBus()
+        # in the asynchronous mode the subscribers do not delay the operations
+        self._event_bus = EventBus(is_async=async_events)
+        # the written documents up to the size are carried by the events, so the subscribers do not read them again
+        self._event_payload_max_size = event_payload_max_size
 
     @property
     def event_bus(self) -> EventBus:
@@ -248,6 +362,7 @@ class DBOperationEngine:
             if self._read_queue.qsize() > 0:
                 read_operation: ReadOperation = self._read_queue.get()
                 if read_operation.document_id in deleted_per_iteration:
+                    read_operation.set_data(None)
                     continue
 
                 self._handle_read_operation(read_operation)
@@ -265,28 +380,52 @@ class DBOperationEngine:
                 try:
                     self._handle_update_operation(update_operation)
                 except Exception as e:
-                    self._update_queue.put(update_operation)
+                    update_operation.set_error(e)
+                    if not update_operation.is_cancelled():
+                        self._update_queue.put(update_operation)
 
     def _handle_create_operation(self, operation: CreateOperation):
         collection: CollectionOperations = self._db_core_engine.get_collection_safely(operation.collection)
 
         doc_id = str(operation.document_id)
-        collection.create_document(doc_id, operation.data)
+        updated_at = datetime.datetime.utcnow()
+        collection.create_document(doc_id, operation.data, updated_at, is_shipped=True)
 
         ev = DocumentOrientedEvent(CollectionName(operation.collection), DocumentOperation.CREATE_DOC,
-                                   DocumentId(doc_id))
+                                   DocumentId(doc_id), *self._event_payload(operation.data, updated_at),
+                                   is_replicated=self._is_replicated_synchronously(operation.write_quorum))
         self.event_bus.publish(DocumentOperation.CREATE_DOC, ev)
 
+        operation.set_updated_at(updated_at)
+        operation.finished()
+
     def _handle_update_operation(self, operation: UpdateOperation):
         collection: CollectionOperations = self._db_core_engine.get_collection_safely(operation.collection)
 
         filename = str(operation.document_id)
 
-        collection.update_document(operation.document_id, operation.data)
+        updated_at = datetime.datetime.utcnow()
+        collection.update_document(operation.document_id, operation.data, updated_at, is_shipped=True)
 
-        ev = DocumentOrientedEvent(CollectionName(operation.collection), DocumentOperation.UPDATE_DOC, DocumentId(filename))
+        ev = DocumentOrientedEvent(CollectionName(operation.collection), DocumentOperation.UPDATE_DOC, DocumentId(filename),
+                                   *self._event_payload(operation.data, updated_at),
+                                   is_replicated=self._is_replicated_synchronously(operation.write_quorum))
         self.event_bus.publish(DocumentOperation.UPDATE_DOC, ev)
 
+        operation.set_updated_at(updated_at)
+        operation.finished()
+
+    @staticmethod
+    def _is_replicated_synchronously(write_quorum: int) -> bool:
+        # the quorum write is sent to the replicas by the client endpoint
+        return write_quorum is not None and write_quorum > 1
+
+    def _event_payload(self, data: str, updated_at: datetime.datetime) -> tuple:
+        if len(data) > self._event_payload_max_size:
+            return None, None
+
+        return data, updated_at
+
     def _handle_read_operation(self, operation: ReadOperation):
         collection: CollectionOperations = self._db_core_engine.get_collection_safely(operation.collection)
 
@@ -301,4 +440,5 @@ class DBOperationEngine:
         collection: CollectionOperations = self._db_core_engine.get_collection_safely(operation.collection)
 
         filename = str(operation.document_id)
-        collection.delete_document(filename)
+        updated_at = datetime.datetime.utcnow()
+        collection.delete_document(filename, updated_at, is_shipped=True)
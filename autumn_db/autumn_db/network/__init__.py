@@ -1,16 +1,20 @@
 import json
+import logging
 import os
 import socket
 import threading
+import time
 
 from autumn_db import DocumentId
-from autumn_db.autumn_db import DBCoreEngine, DBOperationEngine, CreateOperation, ReadOperation, UpdateOperation, DeleteOperation
+from autumn_db.autumn_db import DBCoreEngine, DBOperationEngine, CreateOperation, ReadOperation, UpdateOperation, \
+    DeleteOperation, SnapshotWorker
 from autumn_db.event_bus.active_anti_entropy import AAEConfig, ActiveAntiEntropy
 from db_driver import DRIVER_COLLECTION_NAME_LENGTH_BYTES as COLLECTION_NAME_LENGTH_BYTES, DRIVER_OPERATION_LENGTH, \
-    DRIVER_DOCUMENT_ID_LENGTH, DocumentOperation
+    DRIVER_DOCUMENT_ID_LENGTH, DRIVER_DOCUMENT_NOT_FOUND, DocumentOperation
 from db_driver import DRIVER_BYTEORDER as BYTEORDER
 from db_driver import DocumentOperation as DBOperation
 from db_driver import CollectionOperation as CollectionOperation
+from db_driver import ClusterOperation
 
 
 # MESSAGE format
@@ -18,21 +22,30 @@ from db_driver import CollectionOperation as CollectionOperation
 #  1byte        1byte               1-255bytes   Xbytes
 class ClientEndpoint:
     BUFFER_SIZE = 1
+    WAIT_INTERVAL = 0.001
+    QUORUM_REACHED = b'+'
+    QUORUM_NOT_REACHED = b'-'
 
     def __init__(self, port: int, db_core: DBCoreEngine):
         self._db_core = db_core
 
         conf = self._read_aae_config()
-        self._db_opers = DBOperationEngine(db_core)
+        self._db_opers = DBOperationEngine(db_core, async_events=conf.async_events)
         aae = ActiveAntiEntropy(conf, self._db_opers)
+        self._aae = aae
+        self._write_quorum_timeout = conf.write_quorum_timeout
 
         threading.Thread(target=aae.processing, args=()).start()
 
         th = threading.Thread(target=self._db_opers.processing, args=())
         th.start()
 
-        self._db_opers.event_bus.subscribe(DocumentOperation.UPDATE_DOC, aae.callback)
-        self._db_opers.event_bus.subscribe(DocumentOperation.CREATE_DOC, aae.callback)
+        snapshot_worker = SnapshotWorker(db_core)
+        threading.Thread(target=snapshot_worker.processing, args=()).start()
+
+        # the pushes of AAE are not dropped, the writes wait for AAE instead
+        self._db_opers.event_bus.subscribe(DocumentOperation.UPDATE_DOC, aae.callback, lossless=True)
+        self._db_opers.event_bus.subscribe(DocumentOperation.CREATE_DOC, aae.callback, lossless=True)
 
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._port = port
@@ -56,91 +69,206 @@ class ClientEndpoint:
     def processing(self):
         while True:
             connection, client_address = self._socket.accept()
+            try:
+                if self._handle(connection):
+                    connection.close()
+            except Exception as e:
+                # the request is dropped, the other clients are served
+                logging.warning(e)
+                connection.close()
+
+    def _handle(self, connection: socket.socket) -> bool:
+        # returns False if the connection is answered by another thread
+        received = bytearray()
+        while True:
+            part = connection.recv(ClientEndpoint.BUFFER_SIZE)
+            if not part or part == b'\x00':
+                break
 
-            received = bytearray()
-            while True:
-                part = connection.recv(ClientEndpoint.BUFFER_SIZE)
-                if not part or part == b'\x00':
-                    break
+            received.extend(part)
 
-                received.extend(part)
+        oper = received[0]
+        received = received[DRIVER_OPERATION_LENGTH::]
+        if oper in [DBOperation.CREATE_DOC_QUORUM.value, DBOperation.UPDATE_DOC_QUORUM.value]:
+            # the client is answered by another thread once the replicas persisted the write
+            threading.Thread(target=self._handle_quorum_write, args=(connection, oper, received), daemon=True).start()
+            return False
 
-            oper = received[0]
-            received = received[DRIVER_OPERATION_LENGTH::]
-            if DBOperation.CREATE_DOC.value == oper:
-                collection_name_length_bytes = received[:COLLECTION_NAME_LENGTH_BYTES:1]
-                received = received[COLLECTION_NAME_LENGTH_BYTES::]
+        if DBOperation.READ_DOC_QUORUM.value == oper:
+            # the client is answered by another thread once the replicas are checked
+            threading.Thread(target=self._handle_quorum_read, args=(connection, received), daemon=True).start()
+            return False
 
-                collection_name_length = int.from_bytes(collection_name_length_bytes, BYTEORDER, signed=False)
-                collection_name_bytes = received[:collection_name_length:1]
-                collection_name = collection_name_bytes.decode('utf-8')
+        if DBOperation.CREATE_DOC.value == oper:
+            collection_name_length_bytes = received[:COLLECTION_NAME_LENGTH_BYTES:1]
+            received = received[COLLECTION_NAME_LENGTH_BYTES::]
 
-                received = received[collection_name_length::]
-                doc_str = received.decode('utf-8')
-                oper = CreateOperation(collection_name, doc_str)
-                self._db_opers.add_operation(oper)
+            collection_name_length = int.from_bytes(collection_name_length_bytes, BYTEORDER, signed=False)
+            collection_name_bytes = received[:collection_name_length:1]
+            collection_name = collection_name_bytes.decode('utf-8')
 
-                doc_id = oper.document_id
-                response_bytes = str(doc_id).encode('utf-8')
-                connection.sendall(response_bytes)
+            received = received[collection_name_length::]
+            doc_str = received.decode('utf-8')
+            oper = CreateOperation(collection_name, doc_str)
+            self._db_opers.add_operation(oper)
 
-            if DBOperation.READ_DOC.value == oper:
-                collection_name_length_bytes = received[:COLLECTION_NAME_LENGTH_BYTES:1]
-                received = received[COLLECTION_NAME_LENGTH_BYTES::]
+            doc_id = oper.document_id
+            response_bytes = str(doc_id).encode('utf-8')
+            connection.sendall(response_bytes)
 
-                collection_name_length = int.from_bytes(collection_name_length_bytes, BYTEORDER, signed=False)
-                collection_name_bytes = received[:collection_name_length:1]
-                collection_name = collection_name_bytes.decode('utf-8')
+        if DBOperation.READ_DOC.value == oper:
+            collection_name_length_bytes = received[:COLLECTION_NAME_LENGTH_BYTES:1]
+            received = received[COLLECTION_NAME_LENGTH_BYTES::]
 
-                received = received[collection_name_length::]
-                doc_id = received.decode('utf-8')
-                doc_id = DocumentId(doc_id)
+            collection_name_length = int.from_bytes(collection_name_length_bytes, BYTEORDER, signed=False)
+            collection_name_bytes = received[:collection_name_length:1]
+            collection_name = collection_name_bytes.decode('utf-8')
 
-                oper = ReadOperation(collection_name, doc_id)
-                self._db_opers.add_operation(oper)
+            received = received[collection_name_length::]
+            doc_id = received.decode('utf-8')
+            doc_id = DocumentId(doc_id)
 
-                while not oper.is_finished():
-                    continue
+            oper = ReadOperation(collection_name, doc_id)
+            self._db_opers.add_operation(oper)
 
-                result = oper.data
-                _response_bytes = bytearray(result.encode('utf-8'))
-                _response_bytes.extend(b'\x00')
+            while not oper.is_finished():
+                continue
 
-                connection.sendall(_response_bytes)
+            _response_bytes = bytearray(self._read_response(oper))
+            _response_bytes.extend(b'\x00')
 
-            if DBOperation.UPDATE_DOC.value == oper:
-                oper = self._map_to_update_operation(received)
-                self._db_opers.add_operation(oper)
+            connection.sendall(_response_bytes)
+            self._aae.on_read(collection_name, doc_id)
 
-            if DBOperation.DELETE_DOC.value == oper:
-                collection_name_length_bytes = received[:COLLECTION_NAME_LENGTH_BYTES:1]
-                received = received[COLLECTION_NAME_LENGTH_BYTES::]
+        if DBOperation.UPDATE_DOC.value == oper:
+            oper = self._map_to_update_operation(received)
+            self._db_opers.add_operation(oper)
 
-                collection_name_length = int.from_bytes(collection_name_length_bytes, BYTEORDER, signed=False)
-                collection_name_bytes = received[:collection_name_length:1]
-                collection_name = collection_name_bytes.decode('utf-8')
+        if DBOperation.DELETE_DOC.value == oper:
+            collection_name_length_bytes = received[:COLLECTION_NAME_LENGTH_BYTES:1]
+            received = received[COLLECTION_NAME_LENGTH_BYTES::]
 
-                received = received[collection_name_length::]
-                doc_id = received.decode('utf-8')
-                doc_id = DocumentId(doc_id)
+            collection_name_length = int.from_bytes(collection_name_length_bytes, BYTEORDER, signed=False)
+            collection_name_bytes = received[:collection_name_length:1]
+            collection_name = collection_name_bytes.decode('utf-8')
 
-                oper = DeleteOperation(collection_name, doc_id)
-                self._db_opers.add_operation(oper)
+            received = received[collection_name_length::]
+            doc_id = received.decode('utf-8')
+            doc_id = DocumentId(doc_id)
 
-            if CollectionOperation.DELETE_COLLECTION.value == oper:
-                collection_name_length_bytes = received[:COLLECTION_NAME_LENGTH_BYTES]
-                received = received[COLLECTION_NAME_LENGTH_BYTES:]
+            oper = DeleteOperation(collection_name, doc_id)
+            self._db_opers.add_operation(oper)
+
+        if ClusterOperation.GET_TOPOLOGY.value == oper:
+            topology = self._aae.topology(self._port)
+            _response_bytes = bytearray(json.dumps(topology).encode('utf-8'))
+            _response_bytes.extend(b'\x00')
+
+            connection.sendall(_response_bytes)
+
+        if CollectionOperation.DELETE_COLLECTION.value == oper:
+            collection_name_length_bytes = received[:COLLECTION_NAME_LENGTH_BYTES]
+            received = received[COLLECTION_NAME_LENGTH_BYTES:]
 
-                collection_name_length = int.from_bytes(collection_name_length_bytes, BYTEORDER, signed=False)
-                collection_name_bytes = received[:collection_name_length]
-                collection_name = collection_name_bytes.decode('utf-8')
+            collection_name_length = int.from_bytes(collection_name_length_bytes, BYTEORDER, signed=False)
+            collection_name_bytes = received[:collection_name_length]
+            collection_name = collection_name_bytes.decode('utf-8')
 
-                self._db_core.delete_collection(collection_name)
+            self._db_core.delete_collection(collection_name)
+
+        return True
+
+    def _handle_quorum_write(self, connection: socket.socket, oper: int, received: bytes):
+        # QUORUM WRITE MESSAGE format
+        # |OpCode|W|Collection name length|Collection name|Document ID (update)|   Data   |
+        #  1byte 1byte       1byte           1-255bytes         26bytes           Xbytes
+        # RESPONSE format
+        # |Status|Document ID (create)|
+        #  1byte       26bytes
+        with connection:
+            write_quorum = received[0]
+            received = received[1:]
+
+            if DBOperation.CREATE_DOC_QUORUM.value == oper:
+                collection_name_length = int.from_bytes(received[:COLLECTION_NAME_LENGTH_BYTES], BYTEORDER, signed=False)
+                received = received[COLLECTION_NAME_LENGTH_BYTES:]
+                collection_name = received[:collection_name_length].decode('utf-8')
+                doc_str = received[collection_name_length:].decode('utf-8')
+                operation = CreateOperation(collection_name, doc_str, write_quorum)
+            else:
+                operation = self._map_to_update_operation(received, write_quorum)
+
+            # the update of an absent document fails until the document is created, it is not waited for forever.
+            # The write is persisted and replicated within write_quorum_timeout
+            deadline = time.monotonic() + self._write_quorum_timeout
+            self._db_opers.add_operation(operation)
+            while not operation.is_finished() and time.monotonic() < deadline:
+                time.sleep(ClientEndpoint.WAIT_INTERVAL)
+
+            if not operation.is_finished():
+                operation.cancel()
+                logging.warning(f"Write to {operation.collection} is not persisted: {operation.error}")
+
+                response = bytearray(ClientEndpoint.QUORUM_NOT_REACHED)
+                if DBOperation.CREATE_DOC_QUORUM.value == oper:
+                    response.extend(str(operation.document_id).encode('utf-8'))
+                response.extend(b'\x00')
+
+                connection.sendall(response)
+                return
+
+            acks = self._aae.replicate_write(operation.collection, operation.document_id, operation.data,
+                                             operation.updated_at, write_quorum, max(deadline - time.monotonic(), 0.0))
+
+            response = bytearray()
+            response.extend(ClientEndpoint.QUORUM_REACHED if acks >= write_quorum else ClientEndpoint.QUORUM_NOT_REACHED)
+            if DBOperation.CREATE_DOC_QUORUM.value == oper:
+                response.extend(str(operation.document_id).encode('utf-8'))
+            response.extend(b'\x00')
+
+            connection.sendall(response)
+
+    def _handle_quorum_read(self, connection: socket.socket, received: bytes):
+        # QUORUM READ MESSAGE format
+        # |OpCode|R|Collection name length|Collection name|Document ID|
+        #  1byte 1byte       1byte           1-255bytes      26bytes
+        # RESPONSE format
+        # |Status|Data  |
+        #  1byte  Xbytes
+        with connection:
+            read_quorum = received[0]
+            received = received[1:]
+
+            collection_name_length = int.from_bytes(received[:COLLECTION_NAME_LENGTH_BYTES], BYTEORDER, signed=False)
+            received = received[COLLECTION_NAME_LENGTH_BYTES:]
+            collection_name = received[:collection_name_length].decode('utf-8')
+            doc_id = DocumentId(received[collection_name_length:].decode('utf-8'))
+
+            # the newer version of a replica is applied before the document is read
+            replicas = self._aae.read_repair(collection_name, doc_id, read_quorum)
+
+            operation = ReadOperation(collection_name, doc_id)
+            self._db_opers.add_operation(operation)
+            while not operation.is_finished():
+                time.sleep(ClientEndpoint.WAIT_INTERVAL)
+
+            response = bytearray()
+            response.extend(ClientEndpoint.QUORUM_REACHED if replicas >= read_quorum else ClientEndpoint.QUORUM_NOT_REACHED)
+            response.extend(self._read_response(operation))
+            response.extend(b'\x00')
+
+            connection.sendall(response)
+
+    @staticmethod
+    def _read_response(operation: ReadOperation) -> bytes:
+        # the driver tells the absent document by the response
+        if not operation.is_found:
+            return DRIVER_DOCUMENT_NOT_FOUND.encode('utf-8')
 
-            connection.close()
+        return operation.data.encode('utf-8')
 
     @staticmethod
-    def _map_to_update_operation(received: bytes):
+    def _map_to_update_operation(received: bytes, write_quorum: int = None):
         # UPDATE MESSAGE format
         # |OpCode|Collection name length|Collection name|Document ID|   Data   |
         #  1byte        1byte               1-255bytes     26bytes     Xbytes
@@ -161,5 +289,5 @@ class ClientEndpoint:
         received = received[DRIVER_DOCUMENT_ID_LENGTH::]
         doc_str = received.decode('utf-8')
 
-        oper = UpdateOperation(collection_name, doc_id, doc_str)
+        oper = UpdateOperation(collection_name, doc_id, doc_str, write_quorum)
         return oper
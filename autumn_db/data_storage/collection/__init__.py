@@ -1,8 +1,9 @@
 import datetime
 
-from algorithms.ph2 import PH2
-from algorithms.spectral_bloom_filter import SpectralBloomFilter
+from algorithms.digest import Digest
+from algorithms.iblt import InvertibleBloomLookupTable
 from autumn_db import DocumentId
+from autumn_db.data_storage.collection.change_log import ChangeLog
 from autumn_db.data_storage.data_access.impl import FilesystemAccess
 
 
@@ -51,9 +52,10 @@ class CollectionOperations(object):
     def name(self) -> str:
         return self._name
 
-    def create_document(self, filename: str, data: str, updated_at: datetime.datetime = None): ...
+    def create_document(self, filename: str, data: str, updated_at: datetime.datetime = None,
+                        is_shipped: bool = False): ...
 
-    def delete_document(self, filename: str): ...
+    def delete_document(self, filename: str, deleted_at: datetime.datetime = None, is_shipped: bool = False): ...
 
     def document_exists(self, filename: str) -> bool: ...
 
@@ -61,7 +63,8 @@ class CollectionOperations(object):
 
     def delete(self): ...
 
-    def update_document(self, doc_id: DocumentId, data: str, updated_at: datetime.datetime = None): ...
+    def update_document(self, doc_id: DocumentId, data: str, updated_at: datetime.datetime = None,
+                        is_shipped: bool = False): ...
 
     def get_updated_at(self, doc_id: DocumentId) -> datetime.datetime: ...
 
@@ -73,4 +76,30 @@ class CollectionOperations(object):
 
     def doc_ids(self) -> set: ...
 
-    def get_snapshot(self, doc_id: DocumentId) -> tuple: ...
+    @property
+    def change_seq(self) -> int: ...
+
+    def doc_ids_by_change(self, since: int = -1) -> list: ...
+
+    @property
+    def change_log(self) -> ChangeLog: ...
+
+    def enable_change_log(self): ...
+
+    @property
+    def digest_spec(self) -> str: ...
+
+    def get_snapshot(self, doc_id: DocumentId) -> Digest: ...
+
+    def calculate_snapshot(self, doc_id: DocumentId, spec: str) -> Digest: ...
+
+    def calculate_pending_snapshot(self) -> bool: ...
+
+    @property
+    def has_pending_snapshots(self) -> bool: ...
+
+    def merkle_hash(self, prefix: str = '') -> bytes: ...
+
+    def merkle_children(self, prefix: str = '') -> dict: ...
+
+    def iblt_sketch(self, subtable_size: int) -> InvertibleBloomLookupTable: ...
@@ -0,0 +1,141 @@
+import datetime
+import os
+import threading
+
+from autumn_db import DocumentId
+from db_driver import DocumentOperation
+
+DEFAULT_RETENTION = 100000
+
+
+class ChangeLogEntry:
+    # the changes which are not written by the clients of the node, e.g. the replicated ones, are not shipped
+    NOT_SHIPPED_MARK = '-'
+
+    def __init__(self, seq: int, operation: DocumentOperation, doc_id: str, updated_at: datetime.datetime,
+                 is_shipped: bool = True):
+        self._seq = seq
+        self._operation = operation
+        self._doc_id = doc_id
+        self._updated_at = updated_at
+        self._is_shipped = is_shipped
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    @property
+    def operation(self) -> DocumentOperation:
+        return self._operation
+
+    @property
+    def doc_id(self) -> str:
+        return self._doc_id
+
+    @property
+    def updated_at(self) -> datetime.datetime:
+        return self._updated_at
+
+    @property
+    def is_shipped(self) -> bool:
+        return self._is_shipped
+
+    def to_line(self) -> str:
+        updated_at = self._updated_at.strftime(DocumentId.UTC_FORMAT)
+        mark = '' if self._is_shipped else f" {ChangeLogEntry.NOT_SHIPPED_MARK}"
+        return f"{self._seq} {self._operation.value} {self._doc_id} {updated_at}{mark}\n"
+
+    @staticmethod
+    def from_line(line: str) -> 'ChangeLogEntry':
+        parts = line.split()
+        is_shipped = parts[4:] != [ChangeLogEntry.NOT_SHIPPED_MARK]
+        if not is_shipped:
+            parts = parts[:4]
+        seq, operation, doc_id, updated_at = parts
+        return ChangeLogEntry(int(seq), DocumentOperation(int(operation)), doc_id,
+                              datetime.datetime.strptime(updated_at, DocumentId.UTC_FORMAT), is_shipped)
+
+
+class ChangeLog:
+    # The committed changes of a collection numbered from 1, one line per change appended to the file.
+    # The entries refer to the documents: the version is read when the entry is shipped.
+    # The sequence numbers of the entries are the change sequence numbers of the collection.
+    # The last retention entries are kept, the file is rewritten when it has twice as many
+    FILENAME = 'changelog'
+
+    def __init__(self, path: str, retention: int = DEFAULT_RETENTION):
+        self._path = path
+        self._retention = retention
+        self._entries = []
+        # the sequence number of the last dropped entry
+        self._truncated_seq = 0
+        self._lock = threading.Lock()
+
+        if os.path.exists(self._path):
+            self._load()
+
+    def _load(self):
+        with open(self._path, 'r') as f:
+            for line in f:
+                try:
+                    entry = ChangeLogEntry.from_line(line)
+                except ValueError:
+                    # the last line could be written partially
+                    continue
+
+                if len(self._entries) == 0:
+                    self._truncated_seq = entry.seq - 1
+                self._entries.append(entry)
+
+        if len(self._entries) > self._retention:
+            self._truncate()
+
+    @property
+    def head_seq(self) -> int:
+        with self._lock:
+            return self._truncated_seq + len(self._entries)
+
+    @property
+    def truncated_seq(self) -> int:
+        with self._lock:
+            return self._truncated_seq
+
+    @property
+    def entries(self) -> list:
+        with self._lock:
+            return list(self._entries)
+
+    def append(self, operation: DocumentOperation, doc_id: str, updated_at: datetime.datetime,
+               is_shipped: bool = True) -> int:
+        with self._lock:
+            entry = ChangeLogEntry(self._truncated_seq + len(self._entries) + 1, operation, str(doc_id), updated_at,
+                                   is_shipped)
+            self._entries.append(entry)
+            if len(self._entries) >= 2 * self._retention:
+                self._truncate()
+            else:
+                with open(self._path, 'a') as f:
+                    f.write(entry.to_line())
+
+            return entry.seq
+
+    def entries_since(self, seq: int, limit: int) -> list:
+        # returns up to limit entries after seq, None if some of them are already dropped
+        with self._lock:
+            if seq < self._truncated_seq:
+                return None
+
+            start = seq - self._truncated_seq
+            return self._entries[start:start + limit]
+
+    def _truncate(self):
+        # must be called under the lock
+        dropped = len(self._entries) - self._retention
+        self._truncated_seq += dropped
+        del self._entries[:dropped]
+
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in self._entries:
+                f.write(entry.to_line())
+        os.replace(tmp_path, self._path)
@@ -3,26 +3,19 @@ import json
 import os
 import shutil
 import threading
+from collections import OrderedDict
 
-from algorithms import to_bytearray_from_values
-from algorithms.ph2 import PH2
-from algorithms.spectral_bloom_filter import SpectralBloomFilter
+from algorithms import diff_bytearrays_from_values
+from algorithms.digest import Digest, DEFAULT_DIGEST, calculate_document_digest, recalculate_digest, create_digest
+from algorithms.iblt import DocumentSetSketch, InvertibleBloomLookupTable
+from algorithms.merkle_tree import MerkleTree
 from autumn_db.autumn_db import DocumentId
 from autumn_db.data_storage.collection import DocumentOperations, MetadataOperations, CollectionOperations, file_access
+from autumn_db.data_storage.collection.change_log import ChangeLog
+from db_driver import DRIVER_DOCUMENT_ID_LENGTH, DocumentOperation
 
-
-def calculate_sbf(_bytearray: bytearray) -> SpectralBloomFilter:
-    res = SpectralBloomFilter()
-    res.add(_bytearray)
-
-    return res
-
-
-def calculate_ph2(_bytearray: bytearray):
-    res = PH2()
-    res.append(_bytearray)
-
-    return res
+# the recently written documents kept parsed for the incremental snapshots, the others are read on the update
+DEFAULT_VALUES_CACHE_SIZE = 10000
 
 
 class MetadataOperationsImpl(MetadataOperations):
@@ -79,22 +72,106 @@ class DocumentOperationsImpl(DocumentOperations):
 
 class CollectionOperationsImpl(CollectionOperations):
 
-    def __init__(self, name: str, data_holder_path: str = None):
+    def __init__(self, name: str, data_holder_path: str = None, incremental_snapshot: bool = False,
+                 deferred_snapshot: bool = False, digest: str = DEFAULT_DIGEST, change_log: bool = False):
         super().__init__(name, data_holder_path)
         self._lock = threading.Lock()
+        digest_sample = create_digest(digest)
+        self._digest_spec = digest_sample.spec
+        # only additive digests could be recalculated by the changed values
+        self._incremental_snapshot = incremental_snapshot and digest_sample.IS_ADDITIVE
+        self._deferred_snapshot = deferred_snapshot
 
         # self._doc_ids = set()
+        # None as a value means the snapshot is not calculated yet
         self._doc_snapshot_mapping = dict()
+        # doc_id -> number of writes since the last calculation, in order of the first write
+        self._dirty_doc_ids = OrderedDict()
+        # documents found on the disk at start, they are calculated after the dirty ones
+        self._pending_doc_ids = OrderedDict()
+        # digests of the calculated snapshots bucketed by the document ID time range
+        self._merkle_tree = MerkleTree()
+        self._document_set_sketch = DocumentSetSketch(DRIVER_DOCUMENT_ID_LENGTH)
+        # doc_id -> the parsed document, the incremental snapshot subtracts its values on the update
+        self._last_values = OrderedDict()
+        # doc_id -> sequence number of its last change since the start
+        self._change_seq = 0
+        self._doc_change_seqs = dict()
+        # the committed changes, kept on the disk for the neighbors tailing them. With the log the sequence numbers
+        # are the ones of its entries
+        self._change_log = None
         self._init_initial_doc_ids()
+        if change_log:
+            self.enable_change_log()
 
     def _init_initial_doc_ids(self):
+        path_to_metadata = os.path.join(self._full_path_to_collection, 'metadata')
         for dirpath, _, filenames in os.walk(os.path.join(self._full_path_to_collection, 'data')):
-            doc_ids = set(filenames)
             with self._lock:
-                if self.name not in self._doc_snapshot_mapping.keys():
-                    self._doc_snapshot_mapping[self.name] = set()
+                for filename in filenames:
+                    if not os.path.isfile(os.path.join(path_to_metadata, filename)):
+                        # the node stopped while creating the document, it is received from the neighbors again
+                        os.remove(os.path.join(dirpath, filename))
+                        continue
+
+                    self._doc_snapshot_mapping[filename] = None
+                    self._pending_doc_ids[filename] = None
+
+    @property
+    def digest_spec(self) -> str:
+        return self._digest_spec
 
-                self._doc_snapshot_mapping[self.name].union(doc_ids)
+    @property
+    def change_log(self) -> ChangeLog:
+        return self._change_log
+
+    def enable_change_log(self):
+        # must be called before the writes, the changes logged before the restart keep their sequence numbers
+        with self._lock:
+            if self._change_log is not None:
+                return
+
+            self._change_log = ChangeLog(os.path.join(self._full_path_to_collection, ChangeLog.FILENAME))
+            for entry in self._change_log.entries:
+                if entry.operation == DocumentOperation.DELETE_DOC or entry.doc_id not in self._doc_snapshot_mapping:
+                    self._doc_change_seqs.pop(entry.doc_id, None)
+                else:
+                    self._doc_change_seqs[entry.doc_id] = entry.seq
+
+    def _set_snapshot(self, doc_id: str, digest: Digest):
+        # must be called under the lock
+        self._doc_snapshot_mapping[doc_id] = digest
+        self._dirty_doc_ids.pop(doc_id, None)
+        self._pending_doc_ids.pop(doc_id, None)
+        self._merkle_tree.set(doc_id, digest.get())
+        self._document_set_sketch.set(doc_id, digest.get())
+
+    def _record_change(self, doc_id: str, operation: DocumentOperation, updated_at: datetime.datetime,
+                       is_shipped: bool):
+        # must be called under the lock
+        if self._change_log is None:
+            self._change_seq += 1
+            seq = self._change_seq
+        else:
+            seq = self._change_log.append(operation, doc_id, updated_at, is_shipped)
+
+        if operation == DocumentOperation.DELETE_DOC:
+            self._doc_change_seqs.pop(doc_id, None)
+        else:
+            self._doc_change_seqs[doc_id] = seq
+
+    def _remember_values(self, doc_id: str, values: dict):
+        # must be called under the lock
+        self._last_values[doc_id] = values
+        self._last_values.move_to_end(doc_id)
+        if len(self._last_values) > DEFAULT_VALUES_CACHE_SIZE:
+            self._last_values.popitem(last=False)
+
+    def _mark_dirty(self, doc_id: str):
+        # must be called under the lock
+        self._doc_snapshot_mapping[doc_id] = None
+        self._pending_doc_ids.pop(doc_id, None)
+        self._dirty_doc_ids[doc_id] = self._dirty_doc_ids.get(doc_id, 0) + 1
 
     def __len__(self):
         return len(self._doc_snapshot_mapping.keys())
@@ -109,38 +186,60 @@ class CollectionOperationsImpl(CollectionOperations):
     def delete(self):
         shutil.rmtree(self._full_path_to_collection)
 
-    def create_document(self, filename: str, data: str, updated_at: datetime.datetime = None):
+    def create_document(self, filename: str, data: str, updated_at: datetime.datetime = None,
+                        is_shipped: bool = False):
         if updated_at is None:
             updated_at = datetime.datetime.utcnow()
 
         data_pathname = os.path.join(self._full_path_to_collection, 'data', filename)
         metadata_pathname = os.path.join(self._full_path_to_collection, 'metadata', filename)
 
-        file_access.create(data_pathname, data)
-
         metadata_content = {
             MetadataOperationsImpl.UPDATED_AT_KEY: updated_at.strftime(
                     DocumentId.UTC_FORMAT),
             MetadataOperationsImpl.IS_FROZEN_KEY: False
         }
         metadata_content_str = json.dumps(metadata_content)
-        file_access.create(metadata_pathname, metadata_content_str)
+
+        # the data file is visible to document_exists, so the metadata is written before the lock is released
+        with self._lock:
+            file_access.create(data_pathname, data)
+            file_access.create(metadata_pathname, metadata_content_str)
+            self._record_change(filename, DocumentOperation.CREATE_DOC, updated_at, is_shipped)
+
+        if self._deferred_snapshot:
+            with self._lock:
+                self._mark_dirty(filename)
+            return
 
         #calc Snapshot
-        _bytearray = to_bytearray_from_values(json.loads(data))
-        sbf = calculate_sbf(_bytearray)
-        ph2 = calculate_ph2(_bytearray)
+        values = json.loads(data)
+        digest = calculate_document_digest(values, self._digest_spec)
 
         with self._lock:
-            self._doc_snapshot_mapping[filename] = (sbf, ph2)
+            self._set_snapshot(filename, digest)
+            if self._incremental_snapshot:
+                self._remember_values(filename, values)
+
+    def delete_document(self, filename: str, deleted_at: datetime.datetime = None, is_shipped: bool = False):
+        if deleted_at is None:
+            deleted_at = datetime.datetime.utcnow()
 
-    def delete_document(self, filename: str):
         data_pathname = os.path.join(self._full_path_to_collection, 'data', filename)
         metadata_pathname = os.path.join(self._full_path_to_collection, 'metadata', filename)
 
         file_access.delete(data_pathname)
         file_access.delete(metadata_pathname)
 
+        with self._lock:
+            self._doc_snapshot_mapping.pop(filename, None)
+            self._dirty_doc_ids.pop(filename, None)
+            self._pending_doc_ids.pop(filename, None)
+            self._merkle_tree.remove(filename)
+            self._document_set_sketch.remove(filename)
+            self._last_values.pop(filename, None)
+            self._record_change(filename, DocumentOperation.DELETE_DOC, deleted_at, is_shipped)
+
     def document_exists(self, filename: str) -> bool:
         path = os.path.join(self._full_path_to_collection, 'data', filename)
         return os.path.isfile(path)
@@ -157,23 +256,65 @@ class CollectionOperationsImpl(CollectionOperations):
         res = MetadataOperationsImpl(pathname)
         return res
 
-    def update_document(self, doc_id: DocumentId, data: str, updated_at: datetime.datetime = None):
+    def update_document(self, doc_id: DocumentId, data: str, updated_at: datetime.datetime = None,
+                        is_shipped: bool = False):
         if updated_at is None:
             updated_at = datetime.datetime.utcnow()
 
         doc_id = str(doc_id)
+        if self._deferred_snapshot:
+            self._update_document_deferred(doc_id, data, updated_at, is_shipped)
+            return
+
+        if self._incremental_snapshot:
+            self._update_document_incrementally(doc_id, data, updated_at, is_shipped)
+            return
+
         doc_oper = self._get_document_operator(doc_id)
         metadata_oper = self._get_metadata_operator(doc_id)
 
         # calc Snapshot
-        _bytearray = to_bytearray_from_values(json.loads(data))
-        sbf = calculate_sbf(_bytearray)
-        ph2 = calculate_ph2(_bytearray)
+        digest = calculate_document_digest(json.loads(data), self._digest_spec)
+
+        with self._lock:
+            doc_oper.update(data)
+            metadata_oper.set_updated_at(updated_at)
+            self._record_change(doc_id, DocumentOperation.UPDATE_DOC, updated_at, is_shipped)
+            self._set_snapshot(doc_id, digest)
+
+    def _update_document_deferred(self, doc_id: str, data: str, updated_at: datetime.datetime, is_shipped: bool):
+        doc_oper = self._get_document_operator(doc_id)
+        metadata_oper = self._get_metadata_operator(doc_id)
 
         with self._lock:
             doc_oper.update(data)
             metadata_oper.set_updated_at(updated_at)
-            self._doc_snapshot_mapping[doc_id] = (sbf, ph2)
+            self._record_change(doc_id, DocumentOperation.UPDATE_DOC, updated_at, is_shipped)
+            self._mark_dirty(doc_id)
+
+    def _update_document_incrementally(self, doc_id: str, data: str, updated_at: datetime.datetime,
+                                       is_shipped: bool):
+        doc_oper = self._get_document_operator(doc_id)
+        metadata_oper = self._get_metadata_operator(doc_id)
+        new_json = json.loads(data)
+
+        with self._lock:
+            digest = self._doc_snapshot_mapping.get(doc_id)
+            if digest is None:
+                digest = calculate_document_digest(new_json, self._digest_spec)
+            else:
+                # only the changed values are hashed: the old ones are subtracted from the snapshot
+                old_json = self._last_values.get(doc_id)
+                if old_json is None:
+                    old_json = json.loads(doc_oper.read())
+                removed, added = diff_bytearrays_from_values(old_json, new_json)
+                digest = recalculate_digest(digest, removed, added)
+
+            doc_oper.update(data)
+            metadata_oper.set_updated_at(updated_at)
+            self._record_change(doc_id, DocumentOperation.UPDATE_DOC, updated_at, is_shipped)
+            self._set_snapshot(doc_id, digest)
+            self._remember_values(doc_id, new_json)
 
     def get_updated_at(self, doc_id: DocumentId) -> datetime.datetime:
         doc_id = str(doc_id)
@@ -218,10 +359,118 @@ class CollectionOperationsImpl(CollectionOperations):
         res = set(ids)
         return res
 
-    def get_snapshot(self, doc_id: DocumentId) -> tuple:
+    @property
+    def change_seq(self) -> int:
+        with self._lock:
+            if self._change_log is not None:
+                return self._change_log.head_seq
+
+            return self._change_seq
+
+    def doc_ids_by_change(self, since: int = -1) -> list:
+        # The documents changed after the since sequence number, the most recently changed go first.
+        # The ones unchanged since the start have 0 sequence number
+        with self._lock:
+            if since < 0:
+                ids = list(self._doc_snapshot_mapping.keys())
+            else:
+                ids = [doc_id for doc_id, seq in self._doc_change_seqs.items() if seq > since]
+            change_seqs = dict(self._doc_change_seqs)
+
+        res = sorted(ids, key=lambda doc_id: change_seqs.get(doc_id, 0), reverse=True)
+        return res
+
+    def get_snapshot(self, doc_id: DocumentId) -> Digest:
         _doc_id = str(doc_id)
-        if _doc_id not in self._doc_snapshot_mapping.keys():
-            return None
+        with self._lock:
+            if _doc_id not in self._doc_snapshot_mapping.keys():
+                return None
+
+            res = self._doc_snapshot_mapping[_doc_id]
+
+        if res is None:
+            # is not calculated yet, so it is done on demand
+            res = self._calculate_snapshot(_doc_id)
+
+        return res
+
+    def calculate_pending_snapshot(self) -> bool:
+        with self._lock:
+            if len(self._dirty_doc_ids) > 0:
+                doc_id = next(iter(self._dirty_doc_ids))
+            elif len(self._pending_doc_ids) > 0:
+                doc_id = next(iter(self._pending_doc_ids))
+            else:
+                return False
+
+        self._calculate_snapshot(doc_id)
+        return True
+
+    def calculate_snapshot(self, doc_id: DocumentId, spec: str) -> Digest:
+        # snapshot by other digest than the collection one, e.g. negotiated with the neighbor
+        doc_id = str(doc_id)
+        if spec == self._digest_spec:
+            return self.get_snapshot(doc_id)
+
+        doc_oper = self._get_document_operator(doc_id)
+        with self._lock:
+            if doc_id not in self._doc_snapshot_mapping.keys():
+                return None
+            data = doc_oper.read()
+
+        res = calculate_document_digest(json.loads(data), spec)
+        return res
+
+    def _calculate_snapshot(self, doc_id: str) -> Digest:
+        doc_oper = self._get_document_operator(doc_id)
+
+        with self._lock:
+            writes = self._dirty_doc_ids.get(doc_id)
+            try:
+                data = doc_oper.read()
+            except RuntimeError:
+                # the document was deleted
+                self._doc_snapshot_mapping.pop(doc_id, None)
+                self._dirty_doc_ids.pop(doc_id, None)
+                self._pending_doc_ids.pop(doc_id, None)
+                self._merkle_tree.remove(doc_id)
+                self._document_set_sketch.remove(doc_id)
+                return None
+
+        digest = calculate_document_digest(json.loads(data), self._digest_spec)
+
+        with self._lock:
+            # the document could be written again while hashing, then the result is outdated
+            is_outdated = self._dirty_doc_ids.get(doc_id) != writes or \
+                self._doc_snapshot_mapping.get(doc_id, False) is not None
+            if not is_outdated:
+                self._set_snapshot(doc_id, digest)
+
+        return digest
+
+    @property
+    def has_pending_snapshots(self) -> bool:
+        # the documents found at start are missed by the tree and the sketch until their snapshots are calculated
+        with self._lock:
+            return len(self._pending_doc_ids) > 0
+
+    # The tree and the sketch hold the last calculated snapshots, the dirty ones are calculated
+    # by the snapshot worker and are not waited for
+
+    def merkle_hash(self, prefix: str = MerkleTree.ROOT) -> bytes:
+        with self._lock:
+            res = self._merkle_tree.hash(prefix)
+
+        return res
+
+    def merkle_children(self, prefix: str = MerkleTree.ROOT) -> dict:
+        with self._lock:
+            res = self._merkle_tree.children(prefix)
+
+        return res
+
+    def iblt_sketch(self, subtable_size: int) -> InvertibleBloomLookupTable:
+        with self._lock:
+            res = self._document_set_sketch.sketch(subtable_size)
 
-        res = self._doc_snapshot_mapping[_doc_id]
         return res
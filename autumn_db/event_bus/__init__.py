@@ -1,8 +1,21 @@
+import datetime
+import logging
+import threading
 from enum import Enum
+from queue import Queue, Full, Empty
 
 from autumn_db import DocumentId
 from db_driver import DocumentOperation, CollectionOperation, CollectionName
 
+# the bigger documents are not carried by the events, the subscribers read them from the collection
+DEFAULT_EVENT_PAYLOAD_MAX_SIZE = 65536
+# the events waiting for a subscriber in the asynchronous mode, the ones over it are dropped
+DEFAULT_SUBSCRIBER_QUEUE_SIZE = 10000
+# the number of the waiting events a dispatcher delivers at once
+DEFAULT_DISPATCH_BATCH_SIZE = 256
+# seconds between the checks whether the subscription is stopped
+DISPATCH_POLL_INTERVAL = 0.1
+
 
 class Event:
 
@@ -36,10 +49,16 @@ class CollectionOrientedEvent(Event):
 
 class DocumentOrientedEvent(Event):
 
-    def __init__(self, collection: CollectionName, operation: DocumentOperation, doc_id: DocumentId):
+    def __init__(self, collection: CollectionName, operation: DocumentOperation, doc_id: DocumentId,
+                 payload: str = None, updated_at: datetime.datetime = None, is_replicated: bool = False):
         super().__init__(collection)
         self._operation = operation
         self._doc_id = doc_id
+        # the written document and its updated_at, None if the event does not carry them
+        self._payload = payload
+        self._updated_at = updated_at
+        # the document is sent to the neighbors already
+        self._is_replicated = is_replicated
 
     @property
     def event_code(self) -> int:
@@ -49,32 +68,163 @@ class DocumentOrientedEvent(Event):
     def document_id(self) -> DocumentId:
         return self._doc_id
 
+    @property
+    def payload(self) -> str:
+        return self._payload
+
+    @property
+    def updated_at(self) -> datetime.datetime:
+        return self._updated_at
+
+    @property
+    def is_replicated(self) -> bool:
+        return self._is_replicated
+
+    @property
+    def has_payload(self) -> bool:
+        return self._payload is not None and self._updated_at is not None
+
     def __str__(self):
         return f"DocumentOrientedEvent, {self.document_id},{self.collection}"
 
 
+class _Subscription:
+    # The events of one subscriber wait in its bounded queue, the dispatcher thread delivers them in batches:
+    # the list of the events to the batch callback, one by one otherwise. The events over the full queue
+    # are dropped, the lossless subscription delays the publisher instead
+
+    def __init__(self, callback, is_batch: bool, queue_size: int, batch_size: int, is_lossless: bool = False):
+        self._callback = callback
+        self._is_batch = is_batch
+        self._batch_size = batch_size
+        self._is_lossless = is_lossless
+        self._queue = Queue(maxsize=queue_size)
+        self._dropped = 0
+        self._is_overloaded = False
+        self._is_stopped = False
+
+        threading.Thread(target=self._dispatch, args=(), daemon=True).start()
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    def put(self, event: Event):
+        if self._is_lossless:
+            # the publisher waits for the slow subscriber until the subscription is stopped
+            while not self._is_stopped:
+                try:
+                    self._queue.put(event, timeout=DISPATCH_POLL_INTERVAL)
+                    return
+                except Full:
+                    continue
+            return
+
+        try:
+            self._queue.put_nowait(event)
+            self._is_overloaded = False
+        except Full:
+            # the publisher is not delayed by the slow subscriber
+            self._dropped += 1
+            if not self._is_overloaded:
+                logging.warning(f"Events of {self._callback} are dropped, the subscriber is too slow")
+            self._is_overloaded = True
+
+    def stop(self):
+        # the dispatcher exits within DISPATCH_POLL_INTERVAL, the waiting events are not delivered
+        self._is_stopped = True
+
+    def _dispatch(self):
+        while not self._is_stopped:
+            try:
+                events = [self._queue.get(timeout=DISPATCH_POLL_INTERVAL)]
+            except Empty:
+                continue
+
+            while len(events) < self._batch_size:
+                try:
+                    events.append(self._queue.get_nowait())
+                except Empty:
+                    break
+
+            try:
+                if self._is_batch:
+                    self._callback(events)
+                else:
+                    for event in events:
+                        self._callback(event)
+            except Exception as e:
+                logging.warning(e)
+
+
 class EventBus:
+    # In the synchronous mode the publishing thread calls the subscribers. In the asynchronous mode every
+    # subscriber has the bounded queue and the dispatcher thread, so a slow subscriber does not delay
+    # the operations. A subscriber gets the events in the publishing order of all the operations
+    # it is subscribed to
+
+    def __init__(self, is_async: bool = False, queue_size: int = DEFAULT_SUBSCRIBER_QUEUE_SIZE,
+                 batch_size: int = DEFAULT_DISPATCH_BATCH_SIZE):
+        if queue_size < 1 or batch_size < 1:
+            raise Exception('Queue size and batch size should be positive')
 
-    def __init__(self):
         opers = list(CollectionOperation) + list(DocumentOperation)
-        self._subscribers_by_oper = {oper.value: set() for oper in opers}
+        # oper code -> callback -> is batch
+        self._subscribers_by_oper = {oper.value: dict() for oper in opers}
+        self._is_async = is_async
+        self._queue_size = queue_size
+        self._batch_size = batch_size
+        # callback -> subscription of the asynchronous mode
+        self._subscriptions = dict()
+        self._lock = threading.Lock()
 
-    def subscribe(self, oper: Enum, callback):
+    @property
+    def dropped(self) -> int:
+        # the number of the events dropped for the slow subscribers
+        with self._lock:
+            return sum(subscription.dropped for subscription in self._subscriptions.values())
+
+    def subscribe(self, oper: Enum, callback, batch: bool = False, lossless: bool = False):
+        # With batch the callback gets the list of the events. In the asynchronous mode the events of the lossless
+        # subscriber are not dropped, the publisher waits while its queue is full
         if oper.value not in self._subscribers_by_oper.keys():
             raise Exception(f"Unknown oper {oper}")
 
-        code = oper.value
-
-        self._subscribers_by_oper[code] = set()
-        self._subscribers_by_oper[code].add(callback)
+        with self._lock:
+            self._subscribers_by_oper[oper.value][callback] = batch
+            if self._is_async and callback not in self._subscriptions.keys():
+                self._subscriptions[callback] = _Subscription(callback, batch, self._queue_size, self._batch_size,
+                                                              lossless)
 
     def unsubscribe(self, oper: Enum, callback):
-        raise Exception('Is not implemented yet')
+        if oper.value not in self._subscribers_by_oper.keys():
+            raise Exception(f"Unknown oper {oper}")
+
+        with self._lock:
+            self._subscribers_by_oper[oper.value].pop(callback, None)
+
+            # the dispatcher is stopped once the callback is not subscribed to anything
+            if any(callback in subscribers for subscribers in self._subscribers_by_oper.values()):
+                return
+
+            subscription = self._subscriptions.pop(callback, None)
+            if subscription is not None:
+                subscription.stop()
 
     def publish(self, oper: Enum, event: Event):
         code = oper.value
         if code not in self._subscribers_by_oper.keys():
             return
 
-        for callback in self._subscribers_by_oper[code]:
-            callback(event)
+        with self._lock:
+            subscribers = list(self._subscribers_by_oper[code].items())
+            subscriptions = [self._subscriptions.get(callback) for callback, _ in subscribers]
+
+        if self._is_async:
+            for subscription in subscriptions:
+                if subscription is not None:
+                    subscription.put(event)
+            return
+
+        for callback, is_batch in subscribers:
+            callback([event] if is_batch else event)
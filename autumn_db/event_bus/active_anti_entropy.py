@@ -1,25 +1,54 @@
-import json
 import logging
+import os
+import random
 import socket
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from enum import Enum
-from queue import Queue
+from queue import Queue, Full, Empty
 
 from typing import List
 
-from algorithms.ph2 import PH2
-from algorithms.spectral_bloom_filter import SpectralBloomFilter
+from algorithms.consistent_hash import HashRing, DEFAULT_VIRTUAL_NODES
+from algorithms.digest import Digest, MAX_DIGEST_SIZE, code_by_spec, spec_by_code, is_supported, header_by_spec, \
+    calculate_digest
+from algorithms.iblt import InvertibleBloomLookupTable, DocumentSetSketch
+from algorithms.merkle_tree import MerkleTree
 from autumn_db import DocumentId
 from autumn_db.autumn_db import DBCoreEngine, DBOperationEngine
 from autumn_db.data_storage.collection import CollectionOperations
-from autumn_db.event_bus import Event, Subscriber, DocumentOrientedEvent
+from autumn_db.event_bus import Event, Subscriber, DocumentOrientedEvent, document_codec
+from autumn_db.event_bus.failure_detector import NeighborHealth
+from autumn_db.event_bus.hinted_handoff import HintQueue, HINTS_DIR, DEFAULT_MAX_HINTS
+from autumn_db.event_bus.log_shipping import ChangeLogServer, ChangeLogTailer, LogFrameType, CHANGE_LOG_DIR, \
+    decode_deletion, SnapshotBootstrap, BOOTSTRAP_FILENAME
+from autumn_db.event_bus.replication_stream import ReplicationStream, STREAM_MARKER, READ_BUFFER_SIZE, \
+    DEFAULT_STREAM_WINDOW, POLL_INTERVAL, serve_stream
+from autumn_db.event_bus.sweep_scheduler import SweepScheduler
 from db_driver import CollectionName, Document, DRIVER_COLLECTION_NAME_LENGTH_BYTES, DRIVER_BYTEORDER, \
-    DRIVER_DOCUMENT_ID_LENGTH, CollectionOperation, DocumentOperation, send_message_to
+    DRIVER_DOCUMENT_ID_LENGTH, CollectionOperation, DocumentOperation, \
+    DRIVER_COLLECTION_NAME_LENGTH_BYTES_MAX
 
 
 _timeout = 0.2
+DATAGRAM_MAX_SIZE = 65507
+# IPv4 and UDP headers
+UDP_HEADERS_SIZE = 28
+DEFAULT_PATH_MTU = 1400
+DEFAULT_INFLIGHT_WINDOW = 4
+DEFAULT_ANSWERER_WORKERS = 4
+DEFAULT_ANSWERER_BACKLOG = 1024
+DEFAULT_DELTA_CACHE_SIZE = 1024
+WILDCARD_ADDR = '0.0.0.0'
+LOOPBACK_PREFIX = '127.'
+
+RECONCILIATION_PER_DOCUMENT = 'per_document'
+RECONCILIATION_MERKLE = 'merkle'
+RECONCILIATION_IBLT = 'iblt'
 
 @dataclass
 class Endpoint:
@@ -31,26 +60,153 @@ class Endpoint:
 class NodeConfig:
     snapshot_receiver: Endpoint
     document_receiver: Endpoint
+    # the node serves its change log, the neighbors tail it instead of getting the pushes of the written documents
+    change_log: Endpoint = None
+    # the client endpoint of the node, it is announced to the cluster drivers
+    client: Endpoint = None
 
     def __post_init__(self):
         self.snapshot_receiver = Endpoint(**self.snapshot_receiver)
         self.document_receiver = Endpoint(**self.document_receiver)
+        if self.change_log is not None:
+            self.change_log = Endpoint(**self.change_log)
+        if self.client is not None:
+            self.client = Endpoint(**self.client)
+
+    @property
+    def node_id(self) -> str:
+        return f"{self.snapshot_receiver.addr}:{self.snapshot_receiver.port}"
 
 
 @dataclass
 class AAEConfig:
     current: NodeConfig
     neighbors: List[NodeConfig]
+    reconciliation: str = RECONCILIATION_PER_DOCUMENT
+    path_mtu: int = DEFAULT_PATH_MTU
+    # the number of batches sent to a neighbor before waiting for the replies
+    inflight_window: int = DEFAULT_INFLIGHT_WINDOW
+    # the number of documents sent to a neighbor before waiting for the acks
+    stream_window: int = DEFAULT_STREAM_WINDOW
+    # the requests of the neighbors are answered by the pool, the ones over the backlog are dropped
+    answerer_workers: int = DEFAULT_ANSWERER_WORKERS
+    answerer_backlog: int = DEFAULT_ANSWERER_BACKLOG
+    # the request timeout adapts to the round-trip time of the neighbor up to the max one,
+    # the neighbor which is down is not requested for up to max_suspension seconds
+    max_request_timeout: float = 2.0
+    max_suspension: float = 60.0
+    # seconds between the sweeps, the pause grows up to the max one while the neighbors are converged
+    sweep_interval: float = 1.0
+    max_sweep_interval: float = 30.0
+    sweep_jitter: float = 0.2
+    # None means the sweep is not limited
+    sweep_docs_per_second: float = None
+    sweep_bytes_per_second: float = None
+    adaptive_sweep_rate: bool = True
+    # every Nth sweep checks all the documents, the others only the ones changed since the neighbor confirmed them
+    full_sweep_period: int = 10
+    # the documents are shipped compressed, with the dictionary of the collection if there is one.
+    # collection name -> path to the dictionary file, it should be the same on all the nodes
+    compression: bool = True
+    compression_dictionaries: dict = None
+    # the number of the shipped versions remembered per neighbor to send the next versions as deltas
+    # against them, 0 disables the deltas
+    delta_cache_size: int = DEFAULT_DELTA_CACHE_SIZE
+    # the documents which were not pushed to a neighbor are remembered on disk and pushed once it is back,
+    # up to max_hints per neighbor
+    max_hints: int = DEFAULT_MAX_HINTS
+    # seconds to wait for the replicas to acknowledge a quorum write
+    write_quorum_timeout: float = 5.0
+    # the client endpoint publishes the events of the operations to the subscribers asynchronously,
+    # the events of a slow subscriber are dropped, except the ones for AAE
+    async_events: bool = False
+    # the share of the reads which check the document with the other replicas in the background,
+    # a quorum read checks it before the answer and waits up to read_quorum_timeout seconds
+    read_repair_chance: float = 0.0
+    read_quorum_timeout: float = 5.0
+    # the documents are partitioned by the consistent hash ring of the current node and the neighbors,
+    # every document is stored by replication_factor nodes. None means every node stores all the documents
+    replication_factor: int = None
+    virtual_nodes: int = DEFAULT_VIRTUAL_NODES
+    # the node ID of the neighbor the new node streams the snapshot of all the collections from,
+    # the sweeps start once it is streamed. The neighbor should serve the change log
+    bootstrap_from: str = None
 
     def __post_init__(self):
         self.current = NodeConfig(**self.current)
         self.neighbors = [NodeConfig(**entry) for entry in self.neighbors]
 
+        if self.reconciliation not in [RECONCILIATION_PER_DOCUMENT, RECONCILIATION_MERKLE, RECONCILIATION_IBLT]:
+            raise Exception(f"Unknown reconciliation {self.reconciliation}")
+
+        if not AAECheckSnapshotBatch.MIN_DATAGRAM_SIZE + UDP_HEADERS_SIZE <= self.path_mtu <= DATAGRAM_MAX_SIZE:
+            raise Exception(f"Path MTU {self.path_mtu} is out of range")
+
+        if self.inflight_window < 1:
+            raise Exception("In-flight window should be positive")
+
+        if self.stream_window < 1:
+            raise Exception("Stream window should be positive")
+
+        if self.answerer_workers < 1 or self.answerer_backlog < 1:
+            raise Exception("Answerer workers and backlog should be positive")
+
+        if self.max_request_timeout <= 0 or self.max_suspension <= 0:
+            raise Exception("Max request timeout and max suspension should be positive")
+
+        if self.sweep_interval < 0 or not 0 <= self.sweep_jitter < 1:
+            raise Exception("Sweep interval should not be negative and jitter should be in [0, 1)")
+
+        if self.full_sweep_period < 1:
+            raise Exception("Full sweep period should be positive")
+
+        if self.delta_cache_size < 0:
+            raise Exception("Delta cache size should not be negative")
+
+        if self.max_hints < 1:
+            raise Exception("Max hints should be positive")
+
+        if self.write_quorum_timeout <= 0:
+            raise Exception("Write quorum timeout should be positive")
+
+        if not 0 <= self.read_repair_chance <= 1 or self.read_quorum_timeout <= 0:
+            raise Exception("Read repair chance should be in [0, 1] and read quorum timeout should be positive")
+
+        if self.replication_factor is not None:
+            if self.replication_factor < 1 or self.virtual_nodes < 1:
+                raise Exception("Replication factor and virtual nodes should be positive")
+
+            # the merkle tree and the sketch cover the whole collection, not the shared ranges
+            if self.reconciliation != RECONCILIATION_PER_DOCUMENT:
+                raise Exception(f"Partitioning requires {RECONCILIATION_PER_DOCUMENT} reconciliation")
+
+        if self.compression_dictionaries is None:
+            self.compression_dictionaries = dict()
+
+        if self.bootstrap_from is not None:
+            neighbors = [neigh for neigh in self.neighbors if neigh.node_id == self.bootstrap_from]
+            if len(neighbors) == 0 or neighbors[0].change_log is None:
+                raise Exception(f"Bootstrap neighbor {self.bootstrap_from} should be a neighbor with the change log")
+
+    @property
+    def bootstrap_neighbor(self) -> NodeConfig:
+        for neigh in self.neighbors:
+            if neigh.node_id == self.bootstrap_from:
+                return neigh
+
+        return None
+
+    @property
+    def datagram_size(self) -> int:
+        return self.path_mtu - UDP_HEADERS_SIZE
+
 
 class DocumentReceiver:
-    BUFFER_SIZE = 1
+    # Accepts both the replication streams and the connections carrying a single document
+    BUFFER_SIZE = READ_BUFFER_SIZE
+    CONNECTION_TIMEOUT = 5.0
 
-    def __init__(self, port: int):
+    def __init__(self, port: int, handler, stream_handler=None):
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._port = port
         self._socket.bind(
@@ -58,28 +214,50 @@ class DocumentReceiver:
         )
         self._socket.settimeout(_timeout)
         self._socket.listen()
+        self._handler = handler
+        self._stream_handler = handler if stream_handler is None else stream_handler
 
-    def get_document_and_metadata(self) -> bytearray:
+    def processing(self):
         try:
             connection, client_address = self._socket.accept()
         except socket.timeout:
             return None
 
-        data = bytearray()
-        while True:
-            part = connection.recv(DocumentReceiver.BUFFER_SIZE)
-            if not part:
-                break
+        connection.settimeout(DocumentReceiver.CONNECTION_TIMEOUT)
+        first = connection.recv(1)
+        if first == STREAM_MARKER:
+            # every stream is served by its own thread until the neighbor closes it
+            connection.settimeout(None)
+            threading.Thread(target=serve_stream, args=(connection, self._stream_handler), daemon=True).start()
+            return
 
-            data.extend(part)
+        data = bytearray(first)
+        with connection:
+            while True:
+                part = connection.recv(DocumentReceiver.BUFFER_SIZE)
+                if not part:
+                    break
+
+                data.extend(part)
 
-        return data
+        if len(data) > 0:
+            self._handler(data)
 
 
 class AAEOperationType(Enum):
     TERMINATE_SESSION: int = 0
     SENDING_SNAPSHOT: int = 1
     SENDING_TIMESTAMP: int = 2
+    UNSUPPORTED_DIGEST: int = 3
+    MERKLE_REQUEST: int = 4
+    MERKLE_CHILDREN: int = 5
+    IBLT_SKETCH: int = 6
+    IBLT_DIFFERENCE: int = 7
+    IBLT_DECODE_FAILED: int = 8
+    ENVELOPE: int = 9
+    CHECK_SNAPSHOT_BATCH: int = 10
+    SNAPSHOT_VERDICTS: int = 11
+    PULL_DOCUMENTS: int = 12
 
     @staticmethod
     def get_by_value(value: int):
@@ -108,18 +286,21 @@ class AAECommunication(AAESnapshot):
 
 
 class Snapshot:
+    # |DIGEST_CODE|DIGEST_SIZE| DIGEST |
+    #     1byte       1byte     Xbytes
+    HEADER_LENGTH = 2
 
-    def __init__(self, sbf: SpectralBloomFilter, hash: PH2):
-        b_sbf = sbf.get()
-        b_hash = hash.hashing()
+    def __init__(self, digest: Digest):
+        self._code = code_by_spec(digest.spec)
+        self._digest_size = digest.digest_size
+        self._bytearray = bytearray(digest.get())
 
-        self._bytearray = bytearray()
-        parts = [
-            b_sbf,
-            b_hash,
-        ]
-        for part in parts:
-            self._bytearray.extend(part)
+    @property
+    def spec(self) -> str:
+        return spec_by_code(self._code, self._digest_size)
+
+    def get_header(self) -> bytes:
+        return bytes([self._code, self._digest_size])
 
     def get(self) -> bytearray:
         return self._bytearray
@@ -147,6 +328,7 @@ class AAECheckSnapshot(AAECommunication):
             collection_name_len_encoded,
             b_collection_name,
             b_doc_id,
+            snapshot.get_header(),
             snapshot.get(),
         ]
         for part in parts:
@@ -156,6 +338,197 @@ class AAECheckSnapshot(AAECommunication):
         return self._bytearray
 
 
+class AAEEnvelope(AAECommunication):
+    # |OpCode|Request id|Message|
+    #  1byte   4bytes    Xbytes
+    # The reply to the enveloped message is enveloped with the same request id
+    REQUEST_ID_LENGTH = 4
+    HEADER_LENGTH = 1 + REQUEST_ID_LENGTH
+
+    def __init__(self, request_id: int, message: bytes):
+        super().__init__(AAEOperationType.ENVELOPE)
+
+        self._bytearray = bytearray()
+        parts = [
+            self.get_opcode(),
+            request_id.to_bytes(AAEEnvelope.REQUEST_ID_LENGTH, DRIVER_BYTEORDER, signed=False),
+            message,
+        ]
+        for part in parts:
+            self._bytearray.extend(part)
+
+    def get(self) -> bytearray:
+        return self._bytearray
+
+    @staticmethod
+    def parse(payload: bytes) -> tuple:
+        request_id = int.from_bytes(payload[1:AAEEnvelope.HEADER_LENGTH], DRIVER_BYTEORDER, signed=False)
+        return request_id, payload[AAEEnvelope.HEADER_LENGTH:]
+
+
+class AAECheckSnapshotBatch(AAECommunication):
+    # |OpCode|Collection name length|Collection name|DIGEST_CODE|DIGEST_SIZE|Count|  DOC_ID  | DIGEST |...
+    #  1byte        1byte               1-255bytes      1byte       1byte   2bytes  26bytes    Xbytes
+    # All the entries are checked by the same digest, so the header is sent once
+    COUNT_LENGTH = 2
+    # the envelope and the biggest header with one entry of the biggest digest
+    MIN_DATAGRAM_SIZE = AAEEnvelope.HEADER_LENGTH + 1 + DRIVER_COLLECTION_NAME_LENGTH_BYTES + \
+        DRIVER_COLLECTION_NAME_LENGTH_BYTES_MAX + Snapshot.HEADER_LENGTH + COUNT_LENGTH + \
+        DRIVER_DOCUMENT_ID_LENGTH + MAX_DIGEST_SIZE
+
+    def __init__(self, collection_name: str, header: bytes, max_size: int):
+        super().__init__(AAEOperationType.CHECK_SNAPSHOT_BATCH)
+        b_collection_name = collection_name.encode('utf-8')
+        collection_name_len = len(b_collection_name)
+        collection_name_len_encoded = collection_name_len.to_bytes(DRIVER_COLLECTION_NAME_LENGTH_BYTES,
+                                                                   DRIVER_BYTEORDER, signed=False)
+
+        self._header = bytearray()
+        parts = [
+            self.get_opcode(),
+            collection_name_len_encoded,
+            b_collection_name,
+            header,
+        ]
+        for part in parts:
+            self._header.extend(part)
+
+        self._max_size = max_size
+        self._entries = bytearray()
+        self._doc_ids = []
+
+    @property
+    def doc_ids(self) -> list:
+        return self._doc_ids
+
+    def add(self, doc_id: str, snapshot: Snapshot) -> bool:
+        # returns False if the entry does not fit into the datagram
+        entry = doc_id.encode('utf-8') + bytes(snapshot.get())
+        size = len(self._header) + AAECheckSnapshotBatch.COUNT_LENGTH + len(self._entries) + len(entry)
+        if size > self._max_size:
+            return False
+
+        self._entries.extend(entry)
+        self._doc_ids.append(doc_id)
+        return True
+
+    def get(self) -> bytearray:
+        res = bytearray(self._header)
+        res.extend(len(self._doc_ids).to_bytes(AAECheckSnapshotBatch.COUNT_LENGTH, DRIVER_BYTEORDER, signed=False))
+        res.extend(self._entries)
+
+        return res
+
+
+class AAESnapshotVerdicts(AAECommunication):
+    # |OpCode|Count|Verdict|UPDATED_AT|...
+    #  1byte 2bytes 1byte    26bytes (only if the snapshots differ)
+    # The verdicts are in the order of the batch entries
+    SAME = 0
+    DIFFERENT = 1
+    ABSENT = 2
+    ENTRIES_OFFSET = 3
+    UPDATED_AT_LENGTH = 26
+
+    def __init__(self, verdicts: list):
+        super().__init__(AAEOperationType.SNAPSHOT_VERDICTS)
+
+        self._bytearray = bytearray()
+        self._bytearray.extend(self.get_opcode())
+        self._bytearray.extend(len(verdicts).to_bytes(2, DRIVER_BYTEORDER, signed=False))
+        for verdict, updated_at in verdicts:
+            self._bytearray.extend(bytes([verdict]))
+            if verdict == AAESnapshotVerdicts.DIFFERENT:
+                self._bytearray.extend(datetime.strftime(updated_at, DocumentId.UTC_FORMAT).encode('utf-8'))
+
+    def get(self) -> bytearray:
+        return self._bytearray
+
+    @staticmethod
+    def parse(payload: bytes) -> list:
+        count = int.from_bytes(payload[1:AAESnapshotVerdicts.ENTRIES_OFFSET], DRIVER_BYTEORDER, signed=False)
+
+        res = []
+        offset = AAESnapshotVerdicts.ENTRIES_OFFSET
+        for _ in range(count):
+            verdict = payload[offset]
+            offset += 1
+
+            updated_at = None
+            if verdict == AAESnapshotVerdicts.DIFFERENT:
+                s_updated_at = bytes(payload[offset:offset + AAESnapshotVerdicts.UPDATED_AT_LENGTH]).decode('utf-8')
+                updated_at = datetime.strptime(s_updated_at, DocumentId.UTC_FORMAT)
+                offset += AAESnapshotVerdicts.UPDATED_AT_LENGTH
+
+            res.append((verdict, updated_at))
+
+        return res
+
+
+class AAEPullDocuments(AAECommunication):
+    # |OpCode|Collection name length|Collection name|Document receiver port|Count|  DOC_ID  |...
+    #  1byte        1byte               1-255bytes           2bytes          2bytes  26bytes
+    # The neighbor pushes its versions of the documents to the document receiver of the requester
+    PORT_LENGTH = 2
+    COUNT_LENGTH = 2
+
+    def __init__(self, collection_name: str, document_receiver_port: int, max_size: int):
+        super().__init__(AAEOperationType.PULL_DOCUMENTS)
+        b_collection_name = collection_name.encode('utf-8')
+        collection_name_len = len(b_collection_name)
+        collection_name_len_encoded = collection_name_len.to_bytes(DRIVER_COLLECTION_NAME_LENGTH_BYTES,
+                                                                   DRIVER_BYTEORDER, signed=False)
+
+        self._header = bytearray()
+        parts = [
+            self.get_opcode(),
+            collection_name_len_encoded,
+            b_collection_name,
+            document_receiver_port.to_bytes(AAEPullDocuments.PORT_LENGTH, DRIVER_BYTEORDER, signed=False),
+        ]
+        for part in parts:
+            self._header.extend(part)
+
+        self._max_size = max_size
+        self._doc_ids = []
+
+    @property
+    def doc_ids(self) -> list:
+        return self._doc_ids
+
+    def add(self, doc_id: str) -> bool:
+        # returns False if the document does not fit into the datagram
+        size = len(self._header) + AAEPullDocuments.COUNT_LENGTH + (len(self._doc_ids) + 1) * DRIVER_DOCUMENT_ID_LENGTH
+        if size > self._max_size:
+            return False
+
+        self._doc_ids.append(doc_id)
+        return True
+
+    def get(self) -> bytearray:
+        res = bytearray(self._header)
+        res.extend(len(self._doc_ids).to_bytes(AAEPullDocuments.COUNT_LENGTH, DRIVER_BYTEORDER, signed=False))
+        for doc_id in self._doc_ids:
+            res.extend(doc_id.encode('utf-8'))
+
+        return res
+
+    @staticmethod
+    def parse(payload: bytes) -> tuple:
+        # the payload goes after the collection name, returns the document receiver port and the doc ids
+        offset = AAEPullDocuments.PORT_LENGTH
+        port = int.from_bytes(payload[:offset], DRIVER_BYTEORDER, signed=False)
+        count = int.from_bytes(payload[offset:offset + AAEPullDocuments.COUNT_LENGTH], DRIVER_BYTEORDER, signed=False)
+        offset += AAEPullDocuments.COUNT_LENGTH
+
+        doc_ids = []
+        for _ in range(count):
+            doc_ids.append(bytes(payload[offset:offset + DRIVER_DOCUMENT_ID_LENGTH]).decode('utf-8'))
+            offset += DRIVER_DOCUMENT_ID_LENGTH
+
+        return port, doc_ids
+
+
 class AAERequestSnapshot(AAECommunication):
 
     def __init__(self, collection_name: str, doc_id: str):
@@ -181,12 +554,299 @@ class AAERequestSnapshot(AAECommunication):
         return self._bytearray
 
 
+class AAEMerkleRequest(AAECommunication):
+    # |OpCode|Collection name length|Collection name|Digest header|Prefix length|Prefix|  Hash  |After length|After|
+    #  1byte        1byte               1-255bytes       2bytes        1byte     0-26bytes 16bytes    1byte   0-26bytes
+    # the digest header is the one the leaves of the tree are hashed by,
+    # only the children after the key are answered, so the children are paged
+
+    def __init__(self, collection_name: str, header: bytes, prefix: str, _hash: bytes, after: str = ''):
+        super().__init__(AAEOperationType.MERKLE_REQUEST)
+        b_collection_name = collection_name.encode('utf-8')
+        collection_name_len = len(b_collection_name)
+        collection_name_len_encoded = collection_name_len.to_bytes(DRIVER_COLLECTION_NAME_LENGTH_BYTES,
+                                                                   DRIVER_BYTEORDER, signed=False)
+        b_prefix = prefix.encode('utf-8')
+        b_after = after.encode('utf-8')
+
+        self._bytearray = bytearray()
+        parts = [
+            self.get_opcode(),
+            collection_name_len_encoded,
+            b_collection_name,
+            header,
+            len(b_prefix).to_bytes(1, DRIVER_BYTEORDER, signed=False),
+            b_prefix,
+            _hash,
+            len(b_after).to_bytes(1, DRIVER_BYTEORDER, signed=False),
+            b_after,
+        ]
+        for part in parts:
+            self._bytearray.extend(part)
+
+    def get(self) -> bytearray:
+        return self._bytearray
+
+
+class AAEMerkleChildren(AAECommunication):
+    # |OpCode|Is truncated|Count|Key length|Key|  Hash  |...
+    #  1byte     1byte    2bytes   1byte        16bytes
+    # the children up to the datagram size, the truncated reply is continued after its last key
+    ENTRIES_OFFSET = 4
+
+    def __init__(self, children: dict, datagram_size: int):
+        super().__init__(AAEOperationType.MERKLE_CHILDREN)
+        # the reply is enveloped
+        max_size = datagram_size - AAEEnvelope.HEADER_LENGTH
+
+        entries = bytearray()
+        count = 0
+        is_truncated = False
+        for key in sorted(children.keys()):
+            b_key = key.encode('utf-8')
+            entry = len(b_key).to_bytes(1, DRIVER_BYTEORDER, signed=False) + b_key + children[key]
+            if AAEMerkleChildren.ENTRIES_OFFSET + len(entries) + len(entry) > max_size:
+                is_truncated = True
+                break
+
+            entries.extend(entry)
+            count += 1
+
+        self._bytearray = bytearray()
+        parts = [
+            self.get_opcode(),
+            bytes([1 if is_truncated else 0]),
+            count.to_bytes(2, DRIVER_BYTEORDER, signed=False),
+            entries,
+        ]
+        for part in parts:
+            self._bytearray.extend(part)
+
+    def get(self) -> bytearray:
+        return self._bytearray
+
+    @staticmethod
+    def parse(payload: bytes) -> tuple:
+        is_truncated = payload[1] == 1
+        count = int.from_bytes(payload[2:AAEMerkleChildren.ENTRIES_OFFSET], DRIVER_BYTEORDER, signed=False)
+
+        children = dict()
+        offset = AAEMerkleChildren.ENTRIES_OFFSET
+        for _ in range(count):
+            key_length = payload[offset]
+            offset += 1
+            key = bytes(payload[offset:offset + key_length]).decode('utf-8')
+            offset += key_length
+            children[key] = bytes(payload[offset:offset + MerkleTree.HASH_SIZE])
+            offset += MerkleTree.HASH_SIZE
+
+        return children, is_truncated
+
+
+class AAEIbltSketch(AAECommunication):
+    # |OpCode|Collection name length|Collection name|Digest header|After length|  After  | IBLT |
+    #  1byte        1byte               1-255bytes       2bytes        1byte    0-26bytes Xbytes
+    # the digest header is the one the snapshots of the sketch are hashed by,
+    # only the difference after the document is answered, so the difference is paged
+
+    def __init__(self, collection_name: str, header: bytes, sketch: InvertibleBloomLookupTable, after: str = ''):
+        super().__init__(AAEOperationType.IBLT_SKETCH)
+        b_collection_name = collection_name.encode('utf-8')
+        collection_name_len = len(b_collection_name)
+        collection_name_len_encoded = collection_name_len.to_bytes(DRIVER_COLLECTION_NAME_LENGTH_BYTES,
+                                                                   DRIVER_BYTEORDER, signed=False)
+
+        self._bytearray = bytearray()
+        parts = [
+            self.get_opcode(),
+            collection_name_len_encoded,
+            b_collection_name,
+            header,
+            len(after.encode('utf-8')).to_bytes(1, DRIVER_BYTEORDER, signed=False),
+            after.encode('utf-8'),
+            sketch.to_bytes(),
+        ]
+        for part in parts:
+            self._bytearray.extend(part)
+
+    def get(self) -> bytearray:
+        return self._bytearray
+
+
+class AAEIbltDifference(AAECommunication):
+    # |OpCode|Is truncated|Count|  DOC_ID  |Has document|UPDATED_AT|...
+    #  1byte     1byte    2bytes  26bytes      1byte      26bytes (only if the document exists)
+    # the difference up to the datagram size, the truncated reply is continued after its last document
+    ENTRIES_OFFSET = 4
+    UPDATED_AT_LENGTH = 26
+
+    def __init__(self, updated_at_by_doc_id: dict, datagram_size: int):
+        super().__init__(AAEOperationType.IBLT_DIFFERENCE)
+        # the reply is enveloped
+        max_size = datagram_size - AAEEnvelope.HEADER_LENGTH
+
+        entries = bytearray()
+        count = 0
+        is_truncated = False
+        for doc_id, updated_at in sorted(updated_at_by_doc_id.items()):
+            entry = bytearray(doc_id.encode('utf-8'))
+            if updated_at is None:
+                entry.extend(b'\x00')
+            else:
+                entry.extend(b'\x01')
+                entry.extend(datetime.strftime(updated_at, DocumentId.UTC_FORMAT).encode('utf-8'))
+
+            if AAEIbltDifference.ENTRIES_OFFSET + len(entries) + len(entry) > max_size:
+                is_truncated = True
+                break
+
+            entries.extend(entry)
+            count += 1
+
+        self._bytearray = bytearray()
+        parts = [
+            self.get_opcode(),
+            bytes([1 if is_truncated else 0]),
+            count.to_bytes(2, DRIVER_BYTEORDER, signed=False),
+            entries,
+        ]
+        for part in parts:
+            self._bytearray.extend(part)
+
+    def get(self) -> bytearray:
+        return self._bytearray
+
+    @staticmethod
+    def parse(payload: bytes) -> tuple:
+        is_truncated = payload[1] == 1
+        count = int.from_bytes(payload[2:AAEIbltDifference.ENTRIES_OFFSET], DRIVER_BYTEORDER, signed=False)
+
+        res = dict()
+        offset = AAEIbltDifference.ENTRIES_OFFSET
+        for _ in range(count):
+            doc_id = bytes(payload[offset:offset + DRIVER_DOCUMENT_ID_LENGTH]).decode('utf-8')
+            offset += DRIVER_DOCUMENT_ID_LENGTH
+            has_document = payload[offset] == 1
+            offset += 1
+
+            updated_at = None
+            if has_document:
+                s_updated_at = bytes(payload[offset:offset + AAEIbltDifference.UPDATED_AT_LENGTH]).decode('utf-8')
+                updated_at = datetime.strptime(s_updated_at, DocumentId.UTC_FORMAT)
+                offset += AAEIbltDifference.UPDATED_AT_LENGTH
+
+            res[doc_id] = updated_at
+
+        return res, is_truncated
+
+
+def _split_collection_name(payload: bytes) -> tuple:
+    collection_name_length_bytes = payload[:DRIVER_COLLECTION_NAME_LENGTH_BYTES:1]
+    payload = payload[DRIVER_COLLECTION_NAME_LENGTH_BYTES::]
+
+    collection_name_length = int.from_bytes(collection_name_length_bytes, DRIVER_BYTEORDER, signed=False)
+    collection_name_bytes = payload[:collection_name_length:1]
+    collection_name_str = collection_name_bytes.decode('utf-8')
+
+    return collection_name_str, payload[collection_name_length::1]
+
+
+class NeighborChannel:
+    # One long-lived socket per neighbor. The requests are enveloped with an increasing id,
+    # so a late reply to a timed out request is not taken for the reply to the next one.
+    # The replies and the timeouts feed the failure detector of the neighbor
+
+    def __init__(self, addr_port: tuple, health: NeighborHealth):
+        self._addr_port = addr_port
+        self._health = health
+        self._socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self._request_id = 0
+        self._lock = threading.Lock()
+
+    @property
+    def addr_port(self) -> tuple:
+        return self._addr_port
+
+    @property
+    def health(self) -> NeighborHealth:
+        return self._health
+
+    def is_available(self) -> bool:
+        return self._health.is_available()
+
+    def request(self, message: bytes) -> bytes:
+        # returns None if the neighbor did not reply in time
+        return self.request_all([message], 1)[0]
+
+    def request_all(self, messages: list, window: int) -> list:
+        # Keeps up to window requests in flight and returns the replies in the order of the messages.
+        # A reply is None if it did not come in time. If the neighbor has not replied to anything
+        # before the first timeout or is suspected to be down, the rest of the messages are not sent
+        with self._lock:
+            replies = [None] * len(messages)
+            if not self._health.is_available():
+                return replies
+
+            in_flight = dict()
+            next_index = 0
+            has_replied = False
+
+            while next_index < len(messages) or len(in_flight) > 0:
+                while next_index < len(messages) and len(in_flight) < window:
+                    self._request_id = (self._request_id + 1) % (1 << 8 * AAEEnvelope.REQUEST_ID_LENGTH)
+                    self._socket.sendto(AAEEnvelope(self._request_id, messages[next_index]).get(), self._addr_port)
+                    sent_at = time.monotonic()
+                    in_flight[self._request_id] = (next_index, sent_at, sent_at + self._health.timeout)
+                    next_index += 1
+
+                now = time.monotonic()
+                expired = [request_id for request_id, (_, _, deadline) in in_flight.items() if deadline <= now]
+                if len(expired) > 0:
+                    for request_id in expired:
+                        del in_flight[request_id]
+
+                    # the requests sent together expire together, it is one failure
+                    self._health.on_timeout()
+                    if not has_replied or not self._health.is_available():
+                        next_index = len(messages)
+                    continue
+
+                remaining = min(deadline for _, _, deadline in in_flight.values()) - now
+                self._socket.settimeout(remaining)
+                try:
+                    payload, _ = self._socket.recvfrom(DATAGRAM_MAX_SIZE)
+                except socket.timeout:
+                    continue
+
+                if len(payload) < AAEEnvelope.HEADER_LENGTH or payload[0] != AAEOperationType.ENVELOPE.value:
+                    continue
+
+                reply_id, reply = AAEEnvelope.parse(payload)
+                if reply_id not in in_flight.keys():
+                    continue
+
+                index, sent_at, _ = in_flight.pop(reply_id)
+                replies[index] = reply
+                has_replied = True
+                self._health.on_reply(time.monotonic() - sent_at)
+
+            return replies
+
+    def close(self):
+        self._socket.close()
+
+
 class AAEAnswererWorker:
-    BUFFER_SIZE = 46
+    # the biggest request is the IBLT sketch
+    BUFFER_SIZE = DATAGRAM_MAX_SIZE
     SENDING_TIMESTAMP_PAYLOAD_PART = bytes([AAEOperationType.SENDING_TIMESTAMP.value])
     TERMINATION_PAYLOAD = bytes([AAEOperationType.TERMINATE_SESSION.value])
+    UNSUPPORTED_DIGEST_PAYLOAD_PART = bytes([AAEOperationType.UNSUPPORTED_DIGEST.value])
+    IBLT_DECODE_FAILED_PAYLOAD = bytes([AAEOperationType.IBLT_DECODE_FAILED.value])
 
-    def __init__(self, addr: str, port: int, db_core: DBCoreEngine, receivers: List[NodeConfig]):
+    def __init__(self, addr: str, port: int, db_core: DBCoreEngine, receivers: List[NodeConfig], pusher=None,
+                 backlog: int = DEFAULT_ANSWERER_BACKLOG, is_ready=None,
+                 datagram_size: int = DEFAULT_PATH_MTU - UDP_HEADERS_SIZE):
         super().__init__()
         self._socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
         self._socket.settimeout(_timeout)
@@ -199,17 +859,66 @@ class AAEAnswererWorker:
 
         self._db_core = db_core
         self._receivers = receivers
+        # pusher(collection name, doc ids, document receiver addr and port) sends the local versions
+        self._pusher = pusher
+
+        # is_ready() is False while the node is not filled yet, the neighbors do not check it then
+        self._is_ready = is_ready
+        # the replies which could be long are paged by the path MTU
+        self._datagram_size = datagram_size
+
+        # the received datagrams wait here for the workers
+        self._backlog = Queue(maxsize=backlog)
+        self._dropped = 0
+        self._is_overloaded = False
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
 
     def processing(self):
+        # receives one datagram, the workers answer it
         try:
             payload, addr_port = self._socket.recvfrom(AAEAnswererWorker.BUFFER_SIZE)
         except socket.timeout:
             return None
 
+        if self._is_ready is not None and not self._is_ready():
+            # the neighbor suspects the node and checks it once it is ready
+            return None
+
+        try:
+            self._backlog.put_nowait((payload, addr_port))
+            self._is_overloaded = False
+        except Full:
+            # the neighbor times out and checks the documents again later
+            self._dropped += 1
+            if not self._is_overloaded:
+                logging.warning("AAE answerer backlog is full, the requests are dropped")
+            self._is_overloaded = True
+
+    def answer_backlog(self):
+        # answers one received datagram, called by the workers
+        try:
+            payload, addr_port = self._backlog.get(timeout=_timeout)
+        except Empty:
+            return None
+
+        def reply(data: bytes):
+            self._socket.sendto(data, addr_port)
+
+        self._answer(payload, reply, addr_port[0])
+
+    def _answer(self, payload: bytes, reply, sender_addr: str):
         oper_code = payload[0]
         payload = payload[1::1]
         operation_type = AAEOperationType.get_by_value(oper_code)
 
+        if operation_type == AAEOperationType.ENVELOPE:
+            request_id, message = AAEEnvelope.parse(bytes([oper_code]) + payload)
+            self._answer(message, lambda data: reply(AAEEnvelope(request_id, data).get()), sender_addr)
+            return
+
         def send_timestamp(timestamp: datetime):
             s_timestamp = datetime.strftime(timestamp, DocumentId.UTC_FORMAT)
             b_timestamp = s_timestamp.encode('utf-8')
@@ -222,7 +931,7 @@ class AAEAnswererWorker:
             for part in parts:
                 _bytearray.extend(part)
 
-            self._socket.sendto(_bytearray, addr_port)
+            reply(_bytearray)
 
         if operation_type == AAEOperationType.SENDING_SNAPSHOT:
             collection_name_length_bytes = payload[:DRIVER_COLLECTION_NAME_LENGTH_BYTES:1]
@@ -238,34 +947,191 @@ class AAEAnswererWorker:
             doc_id = doc_id.decode('utf-8')
             payload = payload[DRIVER_DOCUMENT_ID_LENGTH::]
 
-            snapshot = payload[::]
+            digest_code, digest_size = payload[0], payload[1]
+            snapshot = payload[Snapshot.HEADER_LENGTH::]
 
             collection: CollectionOperations = self._db_core.get_collection_safely(collection_name_str)
 
+            spec = spec_by_code(digest_code, digest_size)
+            if spec is None:
+                # the digest is not available here, the neighbor is offered to use the collection one
+                _bytearray = bytearray(AAEAnswererWorker.UNSUPPORTED_DIGEST_PAYLOAD_PART)
+                _bytearray.extend(header_by_spec(collection.digest_spec))
+                reply(_bytearray)
+                return
+
             if doc_id not in collection.doc_ids():
                 fake_timestamp = datetime(1970, 1, 1, 0, 0, 0, 0, tzinfo=timezone.utc)
                 send_timestamp(fake_timestamp)
                 return
 
             _doc_id = DocumentId(doc_id)
-            sbf_and_ph2 = collection.get_snapshot(_doc_id)
-            if sbf_and_ph2 is None:
+            digest = collection.calculate_snapshot(_doc_id, spec)
+            if digest is None:
                 fake_timestamp = datetime(1970, 1, 1, 0, 0, 0, 0, tzinfo=timezone.utc)
                 send_timestamp(fake_timestamp)
                 return
 
-            sbf, ph2 = sbf_and_ph2
-            local_snapshot = Snapshot(sbf, ph2)
+            local_snapshot = Snapshot(digest)
 
             if bytes(local_snapshot.get()) == snapshot:
-                self._socket.sendto(AAEAnswererWorker.TERMINATION_PAYLOAD, addr_port)
+                reply(AAEAnswererWorker.TERMINATION_PAYLOAD)
                 return None
 
             local_timestamp = collection.get_updated_at(DocumentId(doc_id))
             send_timestamp(local_timestamp)
 
+        if operation_type == AAEOperationType.CHECK_SNAPSHOT_BATCH:
+            self._answer_check_snapshot_batch(payload, reply)
+
+        if operation_type == AAEOperationType.PULL_DOCUMENTS:
+            self._answer_pull_documents(payload, reply, sender_addr)
+
+        if operation_type == AAEOperationType.MERKLE_REQUEST:
+            self._answer_merkle_request(payload, reply)
+
+        if operation_type == AAEOperationType.IBLT_SKETCH:
+            self._answer_iblt_sketch(payload, reply)
+
+    def _answer_check_snapshot_batch(self, payload: bytes, reply):
+        collection_name_str, payload = _split_collection_name(payload)
+        collection: CollectionOperations = self._db_core.get_collection_safely(collection_name_str)
+
+        digest_code, digest_size = payload[0], payload[1]
+        spec = spec_by_code(digest_code, digest_size)
+        if spec is None:
+            _bytearray = bytearray(AAEAnswererWorker.UNSUPPORTED_DIGEST_PAYLOAD_PART)
+            _bytearray.extend(header_by_spec(collection.digest_spec))
+            reply(_bytearray)
+            return
+
+        offset = Snapshot.HEADER_LENGTH
+        count = int.from_bytes(payload[offset:offset + AAECheckSnapshotBatch.COUNT_LENGTH], DRIVER_BYTEORDER,
+                               signed=False)
+        offset += AAECheckSnapshotBatch.COUNT_LENGTH
+
+        verdicts = []
+        for _ in range(count):
+            doc_id = bytes(payload[offset:offset + DRIVER_DOCUMENT_ID_LENGTH]).decode('utf-8')
+            offset += DRIVER_DOCUMENT_ID_LENGTH
+            snapshot = bytes(payload[offset:offset + digest_size])
+            offset += digest_size
+
+            digest = None
+            if collection.document_exists(doc_id):
+                digest = collection.calculate_snapshot(DocumentId(doc_id), spec)
+
+            if digest is None:
+                verdicts.append((AAESnapshotVerdicts.ABSENT, None))
+            elif bytes(digest.get()) == snapshot:
+                verdicts.append((AAESnapshotVerdicts.SAME, None))
+            else:
+                verdicts.append((AAESnapshotVerdicts.DIFFERENT, collection.get_updated_at(DocumentId(doc_id))))
+
+        reply(AAESnapshotVerdicts(verdicts).get())
+
+    def _answer_pull_documents(self, payload: bytes, reply, sender_addr: str):
+        collection_name_str, payload = _split_collection_name(payload)
+        port, doc_ids = AAEPullDocuments.parse(payload)
+
+        # the documents are pushed only to the configured neighbors
+        recv_doc_addr_port = self._pulling_receiver(sender_addr, port)
+        if recv_doc_addr_port is None:
+            logging.warning(f"Pull of the documents from {sender_addr} which is not a neighbor is ignored")
+            return
+
+        # the requester does not wait for the documents themselves
+        reply(AAEAnswererWorker.TERMINATION_PAYLOAD)
+        if self._pusher is not None:
+            self._pusher(collection_name_str, doc_ids, recv_doc_addr_port)
+
+    def _pulling_receiver(self, sender_addr: str, port: int) -> tuple:
+        # the configured document receiver of the neighbor which sent the pull, None for any other sender.
+        # The neighbor configured by the wildcard address is on the same host
+        for receiver in self._receivers:
+            endpoint = receiver.document_receiver
+            if endpoint.port != port:
+                continue
+
+            if sender_addr in [endpoint.addr, receiver.snapshot_receiver.addr] \
+                    or (endpoint.addr == WILDCARD_ADDR and sender_addr.startswith(LOOPBACK_PREFIX)):
+                return endpoint.addr, endpoint.port
+
+        return None
+
+    def _answer_iblt_sketch(self, payload: bytes, reply):
+        collection_name_str, payload = _split_collection_name(payload)
+        collection: CollectionOperations = self._db_core.get_collection_safely(collection_name_str)
+
+        # the sketches of the snapshots hashed by different digests never decode
+        digest_code, digest_size = payload[0], payload[1]
+        if spec_by_code(digest_code, digest_size) != collection.digest_spec:
+            _bytearray = bytearray(AAEAnswererWorker.UNSUPPORTED_DIGEST_PAYLOAD_PART)
+            _bytearray.extend(header_by_spec(collection.digest_spec))
+            reply(_bytearray)
+            return
+
+        payload = payload[Snapshot.HEADER_LENGTH:]
+        after_length = payload[0]
+        after = bytes(payload[1:1 + after_length]).decode('utf-8')
+        remote_sketch = InvertibleBloomLookupTable.from_bytes(payload[1 + after_length:])
+        local_sketch = collection.iblt_sketch(remote_sketch.subtable_size)
+
+        only_remote, only_local, is_decoded = remote_sketch.subtract(local_sketch).decode()
+        if not is_decoded:
+            reply(AAEAnswererWorker.IBLT_DECODE_FAILED_PAYLOAD)
+            return
+
+        doc_id_length = remote_sketch.key_size - DocumentSetSketch.FINGERPRINT_SIZE
+        doc_ids = {bytes(key[:doc_id_length]).decode('utf-8') for key in only_remote | only_local}
+
+        updated_at_by_doc_id = dict()
+        for doc_id in sorted(doc_id for doc_id in doc_ids if doc_id > after):
+            if collection.document_exists(doc_id):
+                updated_at_by_doc_id[doc_id] = collection.get_updated_at(DocumentId(doc_id))
+            else:
+                updated_at_by_doc_id[doc_id] = None
+
+        difference = AAEIbltDifference(updated_at_by_doc_id, self._datagram_size)
+        reply(difference.get())
+
+    def _answer_merkle_request(self, payload: bytes, reply):
+        collection_name_str, payload = _split_collection_name(payload)
+        collection: CollectionOperations = self._db_core.get_collection_safely(collection_name_str)
+
+        # the trees of the leaves hashed by different digests never match
+        digest_code, digest_size = payload[0], payload[1]
+        if spec_by_code(digest_code, digest_size) != collection.digest_spec:
+            _bytearray = bytearray(AAEAnswererWorker.UNSUPPORTED_DIGEST_PAYLOAD_PART)
+            _bytearray.extend(header_by_spec(collection.digest_spec))
+            reply(_bytearray)
+            return
+
+        payload = payload[Snapshot.HEADER_LENGTH:]
+        prefix_length = payload[0]
+        prefix = bytes(payload[1:1 + prefix_length]).decode('utf-8')
+        offset = 1 + prefix_length
+        remote_hash = bytes(payload[offset:offset + MerkleTree.HASH_SIZE])
+        offset += MerkleTree.HASH_SIZE
+        after_length = payload[offset]
+        after = bytes(payload[offset + 1:offset + 1 + after_length]).decode('utf-8')
+
+        if collection.merkle_hash(prefix) == remote_hash:
+            reply(AAEAnswererWorker.TERMINATION_PAYLOAD)
+            return
+
+        children = {key: _hash for key, _hash in collection.merkle_children(prefix).items() if key > after}
+        children = AAEMerkleChildren(children, self._datagram_size)
+        reply(children.get())
+
 
 class ActiveAntiEntropy(Subscriber):
+    IBLT_MIN_SUBTABLE_SIZE = 16
+    # the number of documents checked between the processing of the queued events
+    SWEEP_CHUNK_SIZE = 256
+    IDLE_TIMEOUT = 0.05
+    HINT_BATCH_SIZE = 256
+    CONCURRENT_QUORUM_WRITES = 16
 
     def __init__(self, config: AAEConfig, db_engine: DBOperationEngine):
         self._conf = config
@@ -273,15 +1139,81 @@ class ActiveAntiEntropy(Subscriber):
         self._db_engine = db_engine
         self._db_core = db_engine.db_core
 
-        self._doc_receiver = DocumentReceiver(self._conf.current.document_receiver.port)
+        self._doc_receiver = DocumentReceiver(self._conf.current.document_receiver.port,
+                                              self._on_received_payload, self._on_received_frame)
+        # the documents could come from several neighbors at the same time
+        self._received_doc_lock = threading.Lock()
+        # the sweeps and the tailing wait until the snapshot of the bootstrap neighbor is streamed
+        self._bootstrapped = threading.Event()
         self._snapshot_receiver = AAEAnswererWorker(
             self._conf.current.snapshot_receiver.addr, self._conf.current.snapshot_receiver.port,
-            self._db_core, self._conf.neighbors
+            self._db_core, self._conf.neighbors, self._push_documents, self._conf.answerer_backlog,
+            self._bootstrapped.is_set, self._conf.datagram_size
         )
 
         self._document_event_queue = Queue()
         self._collection_event_queue = Queue()
 
+        # (snapshot receiver addr and port, collection name) -> digest spec
+        self._negotiated_digests = dict()
+
+        self._ring = None
+        if self._conf.replication_factor is not None:
+            nodes = [node.node_id for node in [self._conf.current] + self._conf.neighbors]
+            self._ring = HashRing(nodes, self._conf.replication_factor, self._conf.virtual_nodes)
+
+        self._channels = dict()
+        for neigh in self._conf.neighbors:
+            receiver_addr_port = (neigh.snapshot_receiver.addr, neigh.snapshot_receiver.port)
+            health = NeighborHealth(f"{receiver_addr_port[0]}:{receiver_addr_port[1]}", _timeout,
+                                    self._conf.max_request_timeout, self._conf.max_suspension)
+            self._channels[receiver_addr_port] = NeighborChannel(receiver_addr_port, health)
+
+        self._streams = dict()
+        self._streams_lock = threading.Lock()
+        for neigh in self._conf.neighbors:
+            recv_doc_addr_port = (neigh.document_receiver.addr, neigh.document_receiver.port)
+            self._streams[recv_doc_addr_port] = ReplicationStream(recv_doc_addr_port, self._conf.stream_window)
+
+        # document receiver addr and port -> hints of the documents to push once the neighbor is back
+        hints_path = os.path.join(self._db_core.db_holder, HINTS_DIR)
+        if not os.path.exists(hints_path):
+            os.mkdir(hints_path)
+        self._hints = dict()
+        for neigh in self._conf.neighbors:
+            recv_doc_addr_port = (neigh.document_receiver.addr, neigh.document_receiver.port)
+            self._hints[recv_doc_addr_port] = HintQueue(
+                os.path.join(hints_path, f"{recv_doc_addr_port[0]}_{recv_doc_addr_port[1]}"), self._conf.max_hints)
+
+        # collection name -> dictionary
+        self._dictionaries = dict()
+        for collection_name, path in self._conf.compression_dictionaries.items():
+            with open(path, 'rb') as f:
+                self._dictionaries[collection_name] = f.read()
+
+        # document receiver addr and port -> LRU of (collection name, doc id) -> (updated at, document)
+        # of the versions the neighbor has applied
+        self._shipped_versions = dict()
+        self._shipped_versions_lock = threading.Lock()
+
+        # every neighbor is served by its own worker, so a slow or dead one does not delay the others
+        self._fan_out_executor = ThreadPoolExecutor(max_workers=max(1, len(self._conf.neighbors)))
+        # the quorum writes do not wait for the sweeps, several writes are replicated at once
+        self._quorum_executor = ThreadPoolExecutor(
+            max_workers=max(1, len(self._conf.neighbors)) * ActiveAntiEntropy.CONCURRENT_QUORUM_WRITES)
+
+        self._sweep_scheduler = SweepScheduler(
+            self._conf.sweep_interval, self._conf.max_sweep_interval, self._conf.sweep_jitter,
+            self._conf.sweep_docs_per_second, self._conf.sweep_bytes_per_second, self._conf.adaptive_sweep_rate
+        )
+        self._sent_bytes = 0
+        self._sent_bytes_lock = threading.Lock()
+
+        # (snapshot receiver addr and port, collection name) -> (collection, change sequence number).
+        # All the documents changed up to the number are confirmed by the neighbor
+        self._watermarks = dict()
+        self._sweep_count = 0
+
         def snapshot_receiver_handler():
             while True:
                 try:
@@ -293,16 +1225,102 @@ class ActiveAntiEntropy(Subscriber):
         receiver = threading.Thread(target=snapshot_receiver_handler, args=())
         receiver.start()
 
+        def snapshot_answerer_handler():
+            while True:
+                try:
+                    self._snapshot_receiver.answer_backlog()
+                except Exception as e:
+                    logging.warning(e)
+
+        for _ in range(self._conf.answerer_workers):
+            threading.Thread(target=snapshot_answerer_handler, args=()).start()
+
         def document_receiver_handler():
             while True:
-                doc_and_metadata = self._doc_receiver.get_document_and_metadata()
-                if doc_and_metadata is not None:
-                    collection, doc_id, doc, updated_at = self._parse_document_and_metadata(doc_and_metadata)
-                    self._on_received_doc(collection, doc_id, doc, updated_at)
+                try:
+                    self._doc_receiver.processing()
+                except Exception as e:
+                    logging.warning(e)
 
         doc_receiver = threading.Thread(target=document_receiver_handler, args=())
         doc_receiver.start()
 
+        self._change_log_server = None
+        if self._conf.current.change_log is not None:
+            self._db_core.enable_change_logs()
+            self._change_log_server = ChangeLogServer(self._conf.current.change_log.port, self._db_core,
+                                                      self._encode_log_document)
+
+            def change_log_server_handler():
+                while True:
+                    try:
+                        self._change_log_server.processing()
+                    except Exception as e:
+                        logging.warning(e)
+
+            threading.Thread(target=change_log_server_handler, args=()).start()
+
+        # change log addr and port -> tailer of the neighbor's change log
+        self._tailers = dict()
+        change_log_path = os.path.join(self._db_core.db_holder, CHANGE_LOG_DIR)
+        if not os.path.exists(change_log_path):
+            os.mkdir(change_log_path)
+        for neigh in self._conf.neighbors:
+            if neigh.change_log is None:
+                continue
+
+            change_log_addr_port = (neigh.change_log.addr, neigh.change_log.port)
+            tailer = ChangeLogTailer(
+                change_log_addr_port,
+                os.path.join(change_log_path, f"{change_log_addr_port[0]}_{change_log_addr_port[1]}"),
+                self._on_log_frame
+            )
+            self._tailers[change_log_addr_port] = tailer
+
+        def tailer_handler(_tailer: ChangeLogTailer):
+            while True:
+                try:
+                    _tailer.processing()
+                except Exception as e:
+                    logging.warning(e)
+
+        def start_tailers():
+            for _tailer in self._tailers.values():
+                threading.Thread(target=tailer_handler, args=(_tailer,)).start()
+
+        self._bootstrap = None
+        if self._conf.bootstrap_from is not None:
+            neigh = self._conf.bootstrap_neighbor
+            self._bootstrap = SnapshotBootstrap((neigh.change_log.addr, neigh.change_log.port),
+                                                os.path.join(change_log_path, BOOTSTRAP_FILENAME), self._on_log_frame)
+
+        if self._bootstrap is None or self._bootstrap.is_done:
+            self._bootstrapped.set()
+            start_tailers()
+        else:
+            def bootstrap_handler():
+                while not self._bootstrap.is_done:
+                    try:
+                        self._bootstrap.processing()
+                    except Exception as e:
+                        logging.warning(e)
+
+                # the changes made while streaming are applied from the log of the bootstrap neighbor
+                neigh = self._conf.bootstrap_neighbor
+                self._tailers[(neigh.change_log.addr, neigh.change_log.port)].start_from(self._bootstrap.positions)
+                self._bootstrapped.set()
+                start_tailers()
+
+            threading.Thread(target=bootstrap_handler, args=()).start()
+
+    @property
+    def is_bootstrapped(self) -> bool:
+        return self._bootstrapped.is_set()
+
+    def replication_lag(self) -> dict:
+        # change log addr and port -> collection name -> the number of the entries not applied yet
+        return {addr_port: tailer.lag for addr_port, tailer in self._tailers.items()}
+
     def callback(self, event: Event):
         doc_opers = [oper.value for oper in list(DocumentOperation) + list(CollectionOperation)]
 
@@ -326,24 +1344,114 @@ class ActiveAntiEntropy(Subscriber):
                 doc_id = str(ev.document_id)
                 by_doc_id[doc_id] = ev
 
-            for doc_id, ev in by_doc_id.items():
-                collection = self._db_core.collections[ev.collection.name]
-                self._broadcast_document(ev.document_id, collection)
+            # the neighbors tail the change log instead of getting the pushes
+            if self._change_log_server is None:
+                for doc_id, ev in by_doc_id.items():
+                    if ev.is_replicated:
+                        continue
+
+                    collection = self._db_core.collections[ev.collection.name]
+                    if ev.has_payload:
+                        self._broadcast_document(ev.document_id, collection, ev.payload, ev.updated_at)
+                    else:
+                        self._broadcast_document(ev.document_id, collection)
 
+            self._sweep_scheduler.on_change()
             return True
 
+        def wait(seconds: float):
+            # the queued events are broadcast while the sweep is paused
+            deadline = time.monotonic() + seconds
+            while True:
+                process_queue()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+
+                time.sleep(min(remaining, ActiveAntiEntropy.IDLE_TIMEOUT))
+
+        def pace(docs: int, checks: int, mismatches: list):
+            # mismatches are the numbers of the unconfirmed documents per neighbor
+            mismatch_ratio = sum(m for m in mismatches if m is not None) / checks if checks > 0 else 0.0
+            wait(self._sweep_scheduler.on_checked(docs, mismatch_ratio, self._take_sent_bytes()))
+
+        def sweep_documents(collection: CollectionOperations, is_full: bool):
+            # only the documents changed since the neighbor confirmed them are checked, the recently changed go first
+            change_seq = collection.change_seq
+            doc_ids_by_neigh = dict()
+            unconfirmed_by_neigh = dict()
+            for neigh in self._conf.neighbors:
+                since = -1 if is_full else self._get_watermark(collection, neigh)
+                # only the documents both nodes are replicas of are reconciled
+                doc_ids_by_neigh[self._receiver_addr_port(neigh)] = [
+                    doc_id for doc_id in collection.doc_ids_by_change(since)
+                    if self._shares(neigh, collection.name, doc_id)
+                ]
+                unconfirmed_by_neigh[self._receiver_addr_port(neigh)] = 0
+
+            while any(len(doc_ids) > 0 for doc_ids in doc_ids_by_neigh.values()):
+                if process_queue():
+                    continue
+
+                chunks = dict()
+                for key, doc_ids in doc_ids_by_neigh.items():
+                    chunks[key] = doc_ids[:ActiveAntiEntropy.SWEEP_CHUNK_SIZE]
+                    del doc_ids[:ActiveAntiEntropy.SWEEP_CHUNK_SIZE]
+
+                mismatches = self._broadcast(chunks, collection)
+                for neigh, unconfirmed in zip(self._conf.neighbors, mismatches):
+                    key = self._receiver_addr_port(neigh)
+                    unconfirmed_by_neigh[key] += len(chunks[key]) if unconfirmed is None else unconfirmed
+
+                docs = len(set().union(*chunks.values()))
+                pace(docs, sum(len(chunk) for chunk in chunks.values()), mismatches)
+
+            for neigh in self._conf.neighbors:
+                if unconfirmed_by_neigh[self._receiver_addr_port(neigh)] == 0:
+                    self._set_watermark(collection, neigh, change_seq)
+
+        def hand_off(collection: CollectionOperations):
+            # the documents written to the current node or left after the ring changed are moved to their replicas
+            doc_ids = [doc_id for doc_id in collection.doc_ids_by_change()
+                       if not self._is_replica(self._conf.current, collection.name, doc_id)]
+            for i in range(0, len(doc_ids), ActiveAntiEntropy.SWEEP_CHUNK_SIZE):
+                process_queue()
+                self._hand_off(collection, doc_ids[i:i + ActiveAntiEntropy.SWEEP_CHUNK_SIZE])
+                wait(self._sweep_scheduler.on_checked(0, 0.0, self._take_sent_bytes()))
+
         def iteration():
             process_queue()
+            # the documents missed by the neighbors are pushed before checking the rest
+            if any(len(hints) > 0 for hints in self._hints.values()):
+                self._fan_out(self._replay_hints)
+
+            is_full = self._sweep_count % self._conf.full_sweep_period == 0
+            self._sweep_count += 1
+
+            for collection in list(self._db_core.collections.values()):
+                checks = len(collection) * len(self._conf.neighbors)
+                # the tree and the sketch miss the documents found at start until the snapshot worker hashes them,
+                # the documents are checked one by one meanwhile
+                is_reconciled_by_sets = not collection.has_pending_snapshots
+
+                if self._conf.reconciliation == RECONCILIATION_MERKLE and is_reconciled_by_sets:
+                    process_queue()
+                    pace(len(collection), checks, self._fan_out(lambda neigh: self._merkle_sync(collection, neigh)))
+                    continue
 
-            for collection in self._db_core.collections.values():
-                doc_ids = collection.doc_ids()
+                if self._conf.reconciliation == RECONCILIATION_IBLT and is_reconciled_by_sets:
+                    process_queue()
+                    pace(len(collection), checks, self._fan_out(lambda neigh: self._iblt_sync(collection, neigh)))
+                    continue
 
-                while len(doc_ids) > 0:
-                    if process_queue():
-                        continue
+                sweep_documents(collection, is_full)
+                if self._ring is not None:
+                    hand_off(collection)
 
-                    doc_id: DocumentId = doc_ids.pop()
-                    self._broadcast(doc_id, collection)
+            wait(self._sweep_scheduler.on_sweep_finished())
+
+        while not self._bootstrapped.is_set():
+            wait(ActiveAntiEntropy.IDLE_TIMEOUT)
 
         while True:
             try:
@@ -351,31 +1459,147 @@ class ActiveAntiEntropy(Subscriber):
             except Exception as e:
                 logging.warning(e)
 
-    def _send_document(self, receiver_addr_port: tuple, collection: CollectionName, doc_id: DocumentId, doc: Document, updated_at: datetime):
-        bytes_to_send = bytearray()
-        collection_name_encoded = collection.name.encode('utf-8')
-        collection_name_len = len(collection_name_encoded)
-        collection_name_len_encoded = collection_name_len.to_bytes(DRIVER_COLLECTION_NAME_LENGTH_BYTES,
-                                                                   DRIVER_BYTEORDER, signed=False)
-        doc_id_encoded = str(doc_id).encode('utf-8')
-        updated_at_encoded = datetime.strftime(updated_at, DocumentId.UTC_FORMAT).encode('utf-8')
-
-        bytes_to_send.extend(collection_name_len_encoded)
-        bytes_to_send.extend(collection_name_encoded)
-        bytes_to_send.extend(doc_id_encoded)
-        bytes_to_send.extend(updated_at_encoded)
-        bytes_to_send.extend(doc.document.encode('utf-8'))
-
-        send_message_to(
-            receiver_addr_port,
-            bytes_to_send
-        )
+    def _send_document(self, receiver_addr_port: tuple, collection: CollectionName, doc_id: DocumentId, doc: Document, updated_at: datetime,
+                       on_applied=None, on_rejected=None):
+        name, _doc_id, document = collection.name, str(doc_id), doc.document
+
+        fallback = None
+        if self._conf.compression:
+            dictionary = self._dictionaries.get(name)
+            bytes_to_send = document_codec.encode_zlib(name, _doc_id, updated_at, document, dictionary)
+            if dictionary is not None:
+                # the neighbor could have another dictionary
+                fallback = document_codec.encode_zlib(name, _doc_id, updated_at, document)
+        else:
+            bytes_to_send = document_codec.encode_raw(name, _doc_id, updated_at, document)
+
+        base = self._get_shipped_version(receiver_addr_port, name, _doc_id)
+        if base is not None and base[0] < updated_at:
+            delta = document_codec.encode_delta(name, _doc_id, updated_at, document, base[0], base[1])
+            if len(delta) < len(bytes_to_send):
+                # the neighbor could have changed the document since, then the full one is sent
+                fallback = bytes_to_send if fallback is None else fallback
+                bytes_to_send = delta
+
+        def on_ack():
+            self._set_shipped_version(receiver_addr_port, name, _doc_id, updated_at, document)
+            if on_applied is not None:
+                on_applied()
+
+        def on_lost():
+            # the frame was not answered before the connection was lost, the document is pushed once it is back
+            self._hints[receiver_addr_port].add(name, _doc_id)
+
+        self._count_sent(len(bytes_to_send))
+        self._get_stream(receiver_addr_port).send(bytes_to_send, on_ack, fallback, on_rejected, on_lost)
+
+    def _get_shipped_version(self, recv_doc_addr_port: tuple, collection_name: str, doc_id: str) -> tuple:
+        with self._shipped_versions_lock:
+            versions = self._shipped_versions.get(recv_doc_addr_port)
+            if versions is None or (collection_name, doc_id) not in versions.keys():
+                return None
 
-    def _broadcast_document(self, doc_id: DocumentId, collection: CollectionOperations):
-        data, updated_at = collection.read_document_with_updated_at(doc_id)
-        _json = json.loads(data)
+            versions.move_to_end((collection_name, doc_id))
+            return versions[(collection_name, doc_id)]
 
+    def _set_shipped_version(self, recv_doc_addr_port: tuple, collection_name: str, doc_id: str,
+                             updated_at: datetime, document: str):
+        if self._conf.delta_cache_size == 0:
+            return
+
+        with self._shipped_versions_lock:
+            versions = self._shipped_versions.setdefault(recv_doc_addr_port, OrderedDict())
+            versions[(collection_name, doc_id)] = (updated_at, document)
+            versions.move_to_end((collection_name, doc_id))
+            if len(versions) > self._conf.delta_cache_size:
+                versions.popitem(last=False)
+
+    def _get_stream(self, recv_doc_addr_port: tuple) -> ReplicationStream:
+        # the streams are opened only to the configured neighbors
+        with self._streams_lock:
+            if recv_doc_addr_port not in self._streams.keys():
+                self._streams[recv_doc_addr_port] = ReplicationStream(recv_doc_addr_port, self._conf.stream_window)
+
+            return self._streams[recv_doc_addr_port]
+
+    def _push_documents(self, collection_name: str, doc_ids: list, recv_doc_addr_port: tuple, on_applied=None):
+        # on_applied is called with the doc id once the neighbor applied the document
+        def applied_callback(doc_id: str):
+            if on_applied is None:
+                return None
+
+            return lambda: on_applied(doc_id)
+
+        collection: CollectionOperations = self._db_core.get_collection_safely(collection_name)
+        for doc_id in doc_ids:
+            if not collection.document_exists(doc_id):
+                continue
+
+            _doc_id = DocumentId(doc_id)
+            data, updated_at = collection.read_document_with_updated_at(_doc_id)
+            self._send_document(recv_doc_addr_port, CollectionName(collection_name), _doc_id, Document(data), updated_at,
+                                applied_callback(doc_id))
+
+    def _pull_documents(self, doc_ids: list, collection: CollectionOperations, neigh: NodeConfig):
+        # the neighbor pushes its versions of the documents back over the replication stream
+        receiver_addr_port = (neigh.snapshot_receiver.addr, neigh.snapshot_receiver.port)
+        port = self._conf.current.document_receiver.port
+
+        pulls = [AAEPullDocuments(collection.name, port, self._conf.datagram_size)]
+        for doc_id in doc_ids:
+            if not pulls[-1].add(doc_id):
+                pulls.append(AAEPullDocuments(collection.name, port, self._conf.datagram_size))
+                pulls[-1].add(doc_id)
+
+        messages = [pull.get() for pull in pulls if len(pull.doc_ids) > 0]
+        self._count_sent(sum(len(message) for message in messages))
+        self._channels[receiver_addr_port].request_all(messages, self._conf.inflight_window)
+
+    def _count_sent(self, size: int):
+        with self._sent_bytes_lock:
+            self._sent_bytes += size
+
+    def _take_sent_bytes(self) -> int:
+        with self._sent_bytes_lock:
+            res = self._sent_bytes
+            self._sent_bytes = 0
+
+        return res
+
+    def _fan_out(self, func) -> list:
+        # Calls func for every neighbor concurrently, waits for all of them and returns their results.
+        # The result is None for the neighbor which is suspected to be down
+        futures = []
         for neigh in self._conf.neighbors:
+            if self._channels[self._receiver_addr_port(neigh)].is_available():
+                futures.append(self._fan_out_executor.submit(func, neigh))
+            else:
+                futures.append(None)
+
+        res = []
+        for future in futures:
+            if future is None:
+                res.append(None)
+                continue
+
+            try:
+                res.append(future.result())
+            except Exception as e:
+                logging.warning(e)
+                res.append(None)
+
+        return res
+
+    def _broadcast_document(self, doc_id: DocumentId, collection: CollectionOperations, data: str = None,
+                            updated_at: datetime = None):
+        # the event could carry the written document, otherwise it is read
+        if data is None or updated_at is None:
+            data, updated_at = collection.read_document_with_updated_at(doc_id)
+
+        def send(neigh: NodeConfig) -> bool:
+            if not self._is_replica(neigh, collection.name, str(doc_id)):
+                return True
+
             self._send_document(
                 (neigh.document_receiver.addr, neigh.document_receiver.port),
                 CollectionName(collection.name),
@@ -383,44 +1607,553 @@ class ActiveAntiEntropy(Subscriber):
                 Document(data),
                 updated_at
             )
+            return True
+
+        # the neighbor which is down gets the document once it is back
+        for neigh, is_sent in zip(self._conf.neighbors, self._fan_out(send)):
+            if is_sent is None:
+                recv_doc_addr_port = (neigh.document_receiver.addr, neigh.document_receiver.port)
+                self._hints[recv_doc_addr_port].add(collection.name, str(doc_id))
+
+    def replicate_write(self, collection_name: str, doc_id: DocumentId, data: str, updated_at: datetime,
+                        write_quorum: int, timeout: float = None) -> int:
+        # Sends the written document to all the neighbors at once and returns when write_quorum replicas,
+        # the local one included, persisted it or the timeout is over. Returns the number of such replicas.
+        # The neighbors which did not apply the document in time still get it
+        if timeout is None:
+            timeout = self._conf.write_quorum_timeout
+
+        def replicate(neigh: NodeConfig) -> bool:
+            recv_doc_addr_port = (neigh.document_receiver.addr, neigh.document_receiver.port)
+            applied = threading.Event()
+            rejected = threading.Event()
+            try:
+                self._send_document(recv_doc_addr_port, CollectionName(collection_name), doc_id, Document(data),
+                                    updated_at, applied.set, rejected.set)
+                # the acks of the concurrent writes are pipelined over the same stream,
+                # the nacked document is not counted
+                self._get_stream(recv_doc_addr_port).wait(lambda: applied.is_set() or rejected.is_set(), timeout)
+                if applied.is_set():
+                    return True
+            except OSError:
+                pass
+
+            self._hints[recv_doc_addr_port].add(collection_name, str(doc_id))
+            return False
+
+        futures = []
+        for neigh in self._conf.neighbors:
+            if not self._is_replica(neigh, collection_name, str(doc_id)):
+                continue
+
+            if self._channels[self._receiver_addr_port(neigh)].is_available():
+                futures.append(self._quorum_executor.submit(replicate, neigh))
+            else:
+                self._hints[(neigh.document_receiver.addr, neigh.document_receiver.port)].add(
+                    collection_name, str(doc_id))
 
-    def _broadcast(self, doc_id: DocumentId, collection: CollectionOperations):
-        sbf_and_ph2 = collection.get_snapshot(doc_id)
-        sbf, ph2 = sbf_and_ph2
-        snapshot = Snapshot(sbf, ph2)
-        check_snapshot = AAECheckSnapshot(collection.name, str(doc_id), snapshot)
-        b_check_snapshot = check_snapshot.get()
+        # the node which is not a replica hands the document off later
+        res = 1 if self._is_replica(self._conf.current, collection_name, str(doc_id)) else 0
+        if res >= write_quorum:
+            return res
 
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                if future.result():
+                    res += 1
+                if res >= write_quorum:
+                    break
+        except FutureTimeoutError:
+            pass
+
+        return res
+
+    def on_read(self, collection_name: str, doc_id: DocumentId):
+        if random.random() < self._conf.read_repair_chance:
+            self._submit_read_repairs(self._db_core.get_collection_safely(collection_name), str(doc_id))
+
+    def _submit_read_repairs(self, collection: CollectionOperations, doc_id: str) -> list:
+        futures = []
         for neigh in self._conf.neighbors:
-            receiver_addr_port = (neigh.snapshot_receiver.addr, neigh.snapshot_receiver.port)
+            if not self._is_replica(neigh, collection.name, doc_id):
+                continue
 
-            sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            if self._channels[self._receiver_addr_port(neigh)].is_available():
+                futures.append(self._quorum_executor.submit(self._repair_read, collection, doc_id, neigh))
 
-            sock.settimeout(_timeout)
+        return futures
 
-            sock.sendto(b_check_snapshot,
-                        receiver_addr_port
-                        )
+    def read_repair(self, collection_name: str, doc_id: DocumentId, read_quorum: int) -> int:
+        # Checks the document with all the other replicas at once and returns when read_quorum replicas,
+        # the local one included, answered and the newest of their versions is applied locally,
+        # or the timeout is over. Returns the number of the replicas which have the local version then
+        collection: CollectionOperations = self._db_core.get_collection_safely(collection_name)
+        doc_id = str(doc_id)
+        deadline = time.monotonic() + self._conf.read_quorum_timeout
+        futures = self._submit_read_repairs(collection, doc_id)
 
-            try:
-                payload, server_addr_port = sock.recvfrom(48)
-            except socket.timeout:
+        res = 1 if self._is_replica(self._conf.current, collection_name, doc_id) else 0
+        # the versions newer than the local one, they are pulled
+        newer = []
+        try:
+            for future in as_completed(futures, timeout=self._conf.read_quorum_timeout):
+                try:
+                    is_answered, newer_updated_at = future.result()
+                except Exception as e:
+                    logging.warning(e)
+                    continue
+
+                if not is_answered:
+                    continue
+
+                if newer_updated_at is None:
+                    res += 1
+                else:
+                    newer.append(newer_updated_at)
+                if res + len(newer) >= read_quorum:
+                    break
+        except FutureTimeoutError:
+            pass
+
+        if len(newer) == 0:
+            return res
+
+        # the pulled version comes over the replication stream
+        newest = max(newer)
+        while time.monotonic() < deadline:
+            if collection.document_exists(doc_id) and collection.get_updated_at(DocumentId(doc_id)) >= newest:
+                return res + len(newer)
+
+            time.sleep(POLL_INTERVAL)
+
+        return res
+
+    def _repair_read(self, collection: CollectionOperations, doc_id: str, neigh: NodeConfig) -> tuple:
+        # Returns whether the replica answered and the updated at of its version if it is newer than the local one.
+        # The newer version is pulled, the older replica gets the local one
+        receiver_addr_port = self._receiver_addr_port(neigh)
+        spec = self._negotiated_digests.get((receiver_addr_port, collection.name), collection.digest_spec)
+
+        _doc_id = DocumentId(doc_id)
+        is_local = collection.document_exists(doc_id)
+        digest = collection.calculate_snapshot(_doc_id, spec) if is_local else None
+        if digest is None:
+            # stands for the absent document, any version of the replica is newer
+            digest = calculate_digest(b'', spec)
+
+        batch = AAECheckSnapshotBatch(collection.name, header_by_spec(spec), self._conf.datagram_size)
+        batch.add(doc_id, Snapshot(digest))
+        message = batch.get()
+        self._count_sent(len(message))
+
+        payload = self._channels[receiver_addr_port].request(message)
+        if payload is None or AAEOperationType.get_by_value(payload[0]) != AAEOperationType.SNAPSHOT_VERDICTS:
+            return False, None
+
+        verdict, remote_updated_at = AAESnapshotVerdicts.parse(payload)[0]
+        if verdict == AAESnapshotVerdicts.ABSENT and not is_local:
+            return True, None
+
+        if not is_local:
+            self._pull_documents([doc_id], collection, neigh)
+            return True, remote_updated_at or datetime.min
+
+        if verdict == AAESnapshotVerdicts.SAME:
+            return True, None
+
+        if verdict == AAESnapshotVerdicts.DIFFERENT:
+            local_updated_at = collection.get_updated_at(_doc_id)
+            if local_updated_at < remote_updated_at:
+                self._pull_documents([doc_id], collection, neigh)
+                return True, remote_updated_at
+            if local_updated_at == remote_updated_at:
+                # the concurrent versions are left to the sweep
+                return True, None
+
+        data, updated_at = collection.read_document_with_updated_at(_doc_id)
+        self._send_document((neigh.document_receiver.addr, neigh.document_receiver.port),
+                            CollectionName(collection.name), _doc_id, Document(data), updated_at)
+        return True, None
+
+    def _is_replica(self, node: NodeConfig, collection_name: str, doc_id: str) -> bool:
+        if self._ring is None:
+            return True
+
+        return self._ring.is_replica(node.node_id, collection_name, doc_id)
+
+    def _shares(self, neigh: NodeConfig, collection_name: str, doc_id: str) -> bool:
+        # both the current node and the neighbor are replicas of the document
+        if self._ring is None:
+            return True
+
+        replicas = self._ring.replicas(collection_name, doc_id)
+        return self._conf.current.node_id in replicas and neigh.node_id in replicas
+
+    @property
+    def ring(self) -> HashRing:
+        return self._ring
+
+    def topology(self, client_port: int) -> dict:
+        # The nodes with the known client endpoints and the ring parameters, the ring is built by the node IDs.
+        # The client endpoint of the current node is on the snapshot receiver address if it is not configured
+        current_client = self._conf.current.client
+        if current_client is None:
+            current_client = Endpoint(self._conf.current.snapshot_receiver.addr, client_port)
+
+        nodes = [{'id': self._conf.current.node_id, 'addr': current_client.addr, 'port': current_client.port}]
+        for neigh in self._conf.neighbors:
+            if neigh.client is not None:
+                nodes.append({'id': neigh.node_id, 'addr': neigh.client.addr, 'port': neigh.client.port})
+
+        return {
+            'nodes': nodes,
+            'ring_nodes': [node.node_id for node in [self._conf.current] + self._conf.neighbors],
+            'replication_factor': self._conf.replication_factor,
+            'virtual_nodes': self._conf.virtual_nodes,
+        }
+
+    def _hand_off(self, collection: CollectionOperations, doc_ids: list) -> int:
+        # Pushes the documents which the current node is not a replica of to their replicas and deletes
+        # them once all the replicas applied them. Returns the number of the deleted documents
+        updated_at_by_doc_id = dict()
+        doc_ids_by_neigh = {self._receiver_addr_port(neigh): [] for neigh in self._conf.neighbors}
+        for doc_id in doc_ids:
+            if not collection.document_exists(doc_id):
+                continue
+
+            updated_at_by_doc_id[doc_id] = collection.get_updated_at(DocumentId(doc_id))
+            for neigh in self._conf.neighbors:
+                if self._is_replica(neigh, collection.name, doc_id):
+                    doc_ids_by_neigh[self._receiver_addr_port(neigh)].append(doc_id)
+
+        # the acks of a neighbor are handled under the lock of its stream
+        applied_by_neigh = {self._receiver_addr_port(neigh): set() for neigh in self._conf.neighbors}
+
+        def hand_off(neigh: NodeConfig) -> bool:
+            recv_doc_addr_port = (neigh.document_receiver.addr, neigh.document_receiver.port)
+            doc_ids_of_neigh = doc_ids_by_neigh[self._receiver_addr_port(neigh)]
+            if len(doc_ids_of_neigh) == 0:
+                return True
+
+            self._push_documents(collection.name, doc_ids_of_neigh, recv_doc_addr_port,
+                                 applied_by_neigh[self._receiver_addr_port(neigh)].add)
+            return self._get_stream(recv_doc_addr_port).flush()
+
+        # a document is kept if any of its replicas did not apply it, e.g. it nacked the document
+        failed = set()
+        for neigh, is_handed_off in zip(self._conf.neighbors, self._fan_out(hand_off)):
+            doc_ids_of_neigh = doc_ids_by_neigh[self._receiver_addr_port(neigh)]
+            if not is_handed_off:
+                failed.update(doc_ids_of_neigh)
+                continue
+
+            applied = applied_by_neigh[self._receiver_addr_port(neigh)]
+            failed.update(doc_id for doc_id in doc_ids_of_neigh if doc_id not in applied)
+
+        res = 0
+        with self._received_doc_lock:
+            for doc_id, updated_at in updated_at_by_doc_id.items():
+                if doc_id in failed or not collection.document_exists(doc_id):
+                    continue
+
+                # the document written meanwhile is handed off by the next sweep
+                if collection.get_updated_at(DocumentId(doc_id)) != updated_at:
+                    continue
+
+                collection.delete_document(doc_id)
+                res += 1
+
+        return res
+
+    def _replay_hints(self, neigh: NodeConfig):
+        recv_doc_addr_port = (neigh.document_receiver.addr, neigh.document_receiver.port)
+        hints = self._hints[recv_doc_addr_port]
+        if hints.take_overflowed():
+            # some documents are not known anymore, the next sweep checks all of them
+            self._reset_watermarks(neigh)
+
+        try:
+            while len(hints) > 0:
+                batch = hints.peek(ActiveAntiEntropy.HINT_BATCH_SIZE)
+                doc_ids_by_collection = dict()
+                # the hint of a deleted document is done, the deletion is repaired by the sweep
+                done = set()
+                for (collection_name, doc_id), _ in batch:
+                    if self._db_core.get_collection_safely(collection_name).document_exists(doc_id):
+                        doc_ids_by_collection.setdefault(collection_name, []).append(doc_id)
+                    else:
+                        done.add((collection_name, doc_id))
+
+                # the acks are handled under the lock of the stream
+                for collection_name, doc_ids in doc_ids_by_collection.items():
+                    self._push_documents(collection_name, doc_ids, recv_doc_addr_port,
+                                         lambda doc_id, _collection_name=collection_name: done.add((_collection_name, doc_id)))
+
+                # the hints are kept until the neighbor applies the documents
+                is_flushed = self._get_stream(recv_doc_addr_port).flush()
+                hints.remove([(hint, version) for hint, version in batch if hint in done])
+                if not is_flushed or len(done) < len(batch):
+                    return
+        finally:
+            # the removed hints are left in the file until the replay is over
+            hints.compact()
+
+    def _request(self, receiver_addr_port: tuple, message: bytes) -> bytes:
+        self._count_sent(len(message))
+        return self._channels[receiver_addr_port].request(message)
+
+    @staticmethod
+    def _receiver_addr_port(neigh: NodeConfig) -> tuple:
+        return neigh.snapshot_receiver.addr, neigh.snapshot_receiver.port
+
+    def _get_watermark(self, collection: CollectionOperations, neigh: NodeConfig) -> int:
+        watermark = self._watermarks.get((self._receiver_addr_port(neigh), collection.name))
+        # the sequence numbers of the recreated collection start over
+        if watermark is None or watermark[0] is not collection:
+            return -1
+
+        return watermark[1]
+
+    def _set_watermark(self, collection: CollectionOperations, neigh: NodeConfig, change_seq: int):
+        self._watermarks[(self._receiver_addr_port(neigh), collection.name)] = (collection, change_seq)
+
+    def _reset_watermarks(self, neigh: NodeConfig):
+        receiver_addr_port = self._receiver_addr_port(neigh)
+        for key in [key for key in list(self._watermarks.keys()) if key[0] == receiver_addr_port]:
+            self._watermarks.pop(key, None)
+
+    def _broadcast(self, doc_ids_by_neigh: dict, collection: CollectionOperations) -> list:
+        # doc_ids_by_neigh: snapshot receiver addr and port -> documents to check against the neighbor
+        return self._fan_out(
+            lambda neigh: self._check_documents(doc_ids_by_neigh[self._receiver_addr_port(neigh)], collection, neigh))
+
+    def _check_documents(self, doc_ids: list, collection: CollectionOperations, neigh: NodeConfig) -> int:
+        # The snapshots are packed into as few datagrams as the path MTU allows.
+        # Returns the number of the documents which are not confirmed to be the same on the neighbor
+        receiver_addr_port = (neigh.snapshot_receiver.addr, neigh.snapshot_receiver.port)
+
+        # the digest which the neighbor agreed to use for the collection
+        negotiation_key = (receiver_addr_port, collection.name)
+        spec = self._negotiated_digests.get(negotiation_key, collection.digest_spec)
+
+        batches = [AAECheckSnapshotBatch(collection.name, header_by_spec(spec), self._conf.datagram_size)]
+        for doc_id in doc_ids:
+            digest = collection.calculate_snapshot(DocumentId(str(doc_id)), spec)
+            if digest is None:
+                continue
+
+            snapshot = Snapshot(digest)
+            if batches[-1].add(str(doc_id), snapshot):
+                continue
+
+            batches.append(AAECheckSnapshotBatch(collection.name, header_by_spec(spec), self._conf.datagram_size))
+            batches[-1].add(str(doc_id), snapshot)
+
+        batches = [batch for batch in batches if len(batch.doc_ids) > 0]
+        messages = [batch.get() for batch in batches]
+        self._count_sent(sum(len(message) for message in messages))
+        replies = self._channels[receiver_addr_port].request_all(messages, self._conf.inflight_window)
+
+        # the documents of the lost replies are checked during the next sweep
+        res = sum(len(batch.doc_ids) for batch in batches)
+        for batch, payload in zip(batches, replies):
+            if payload is None:
+                continue
+
+            matched = self._check_batch(batch, payload, collection, neigh)
+            if matched is None:
+                break
+            res -= matched
+
+        return res
+
+    def _check_batch(self, batch: AAECheckSnapshotBatch, payload: bytes, collection: CollectionOperations,
+                     neigh: NodeConfig) -> int:
+        # returns the number of the same documents or None if the rest of the replies should not be processed
+        receiver_addr_port = (neigh.snapshot_receiver.addr, neigh.snapshot_receiver.port)
+        resp_type = AAEOperationType.get_by_value(payload[0])
+
+        if resp_type == AAEOperationType.UNSUPPORTED_DIGEST:
+            neighbor_spec = spec_by_code(payload[1], payload[2])
+            if neighbor_spec is None or not is_supported(neighbor_spec):
+                logging.warning(f"No common digest with {receiver_addr_port} for {collection.name}")
+                return None
+
+            # the documents are checked by the negotiated digest during the next sweep
+            self._negotiated_digests[(receiver_addr_port, collection.name)] = neighbor_spec
+            return None
+
+        if resp_type != AAEOperationType.SNAPSHOT_VERDICTS:
+            return None
+
+        res = 0
+        to_pull = []
+        recv_doc_addr_port = (neigh.document_receiver.addr, neigh.document_receiver.port)
+        for doc_id, (verdict, remote_updated_at) in zip(batch.doc_ids, AAESnapshotVerdicts.parse(payload)):
+            if verdict == AAESnapshotVerdicts.SAME:
+                res += 1
                 continue
-            resp_type = AAEOperationType.get_by_value(payload[0])
 
+            if not collection.document_exists(doc_id):
+                continue
+
+            _doc_id = DocumentId(doc_id)
+            if verdict == AAESnapshotVerdicts.DIFFERENT:
+                local_updated_at = collection.get_updated_at(_doc_id)
+                if local_updated_at < remote_updated_at:
+                    to_pull.append(doc_id)
+                if local_updated_at <= remote_updated_at:
+                    continue
+
+            data, updated_at = collection.read_document_with_updated_at(_doc_id)
+            self._send_document(recv_doc_addr_port, CollectionName(collection.name), _doc_id, Document(data), updated_at)
+
+        if len(to_pull) > 0:
+            self._pull_documents(to_pull, collection, neigh)
+
+        return res
+
+    def _request_pages(self, receiver_addr_port: tuple, make_request, reply_type: AAEOperationType, parse) -> tuple:
+        # Requests a reply paged by the path MTU, make_request(after) builds the request of the page after the key
+        # and parse(payload) returns the page as a dict and whether it is truncated. Returns the last payload,
+        # None if the neighbor is not reachable, and the pages merged if they are of reply_type
+        res = dict()
+        after = ''
+        while True:
+            payload = self._request(receiver_addr_port, make_request(after).get())
+            if payload is None or AAEOperationType.get_by_value(payload[0]) != reply_type:
+                return payload, res
+
+            page, is_truncated = parse(payload)
+            res.update(page)
+            if not is_truncated or len(page) == 0:
+                return payload, res
+
+            after = max(page.keys())
+
+    def _merkle_sync(self, collection: CollectionOperations, neigh: NodeConfig) -> int:
+        # Descends only into the buckets which hashes differ, so the cost depends on the number of differences.
+        # Returns the number of the differing documents
+        receiver_addr_port = (neigh.snapshot_receiver.addr, neigh.snapshot_receiver.port)
+        if self._negotiated_digests.get((receiver_addr_port, collection.name), collection.digest_spec) \
+                != collection.digest_spec:
+            # the neighbor hashes the leaves by another digest, the documents are checked by the common one
+            return self._check_documents(collection.doc_ids(), collection, neigh)
+
+        differing_doc_ids = []
+        remote_doc_ids = []
+        prefixes = [MerkleTree.ROOT]
+        while len(prefixes) > 0:
+            prefix = prefixes.pop()
+            local_hash = collection.merkle_hash(prefix)
+            if local_hash is None:
+                # the bucket which only the neighbor has, the hash of the empty one is zero
+                local_hash = bytes(MerkleTree.HASH_SIZE)
+
+            payload, remote_children = self._request_pages(
+                receiver_addr_port,
+                lambda after: AAEMerkleRequest(collection.name, header_by_spec(collection.digest_spec), prefix,
+                                               local_hash, after),
+                AAEOperationType.MERKLE_CHILDREN, AAEMerkleChildren.parse)
+            if payload is None:
+                # the neighbor is not reachable, the next sweep starts from the root again
+                return len(collection)
+
+            resp_type = AAEOperationType.get_by_value(payload[0])
             if resp_type == AAEOperationType.TERMINATE_SESSION:
                 continue
 
-            if resp_type == AAEOperationType.SENDING_TIMESTAMP:
-                b_timestamp = payload[1:]
-                s_timestamp = b_timestamp.decode()
-                timestamp = datetime.strptime(s_timestamp, DocumentId.UTC_FORMAT)
+            if resp_type == AAEOperationType.UNSUPPORTED_DIGEST:
+                neighbor_spec = spec_by_code(payload[1], payload[2])
+                logging.warning(f"Merkle trees of {collection.name} on {receiver_addr_port} are hashed by another "
+                                f"digest, the documents are checked one by one")
+                if neighbor_spec is not None and is_supported(neighbor_spec):
+                    self._negotiated_digests[(receiver_addr_port, collection.name)] = neighbor_spec
+                return self._check_documents(collection.doc_ids(), collection, neigh)
+
+            local_children = collection.merkle_children(prefix)
+            for key, local_child_hash in local_children.items():
+                if remote_children.get(key) == local_child_hash:
+                    continue
 
-                local_timestamp = collection.get_updated_at(doc_id)
-                if local_timestamp > timestamp:
-                    recv_doc_addr_port = (neigh.document_receiver.addr, neigh.document_receiver.port)
-                    data, updated_at = collection.read_document_with_updated_at(doc_id)
-                    self._send_document(recv_doc_addr_port, CollectionName(collection.name), doc_id, Document(data), updated_at)
+                if MerkleTree.is_leaf(key):
+                    differing_doc_ids.append(key)
+                else:
+                    prefixes.append(key)
+
+            for key in remote_children.keys() - local_children.keys():
+                if not MerkleTree.is_leaf(key):
+                    prefixes.append(key)
+                elif collection.document_exists(key):
+                    # the snapshot of the written document is not calculated yet
+                    differing_doc_ids.append(key)
+                else:
+                    remote_doc_ids.append(key)
+
+        self._check_documents(differing_doc_ids, collection, neigh)
+        if len(remote_doc_ids) > 0:
+            self._pull_documents(remote_doc_ids, collection, neigh)
+
+        return len(differing_doc_ids) + len(remote_doc_ids)
+
+    def _iblt_sync(self, collection: CollectionOperations, neigh: NodeConfig) -> int:
+        # The neighbors trade one sketch of (doc_id, digest) pairs and decode the difference directly.
+        # The sketch grows only if the difference could not be decoded. Returns the number of the differing documents
+        receiver_addr_port = (neigh.snapshot_receiver.addr, neigh.snapshot_receiver.port)
+        if self._negotiated_digests.get((receiver_addr_port, collection.name), collection.digest_spec) \
+                != collection.digest_spec:
+            # the neighbor hashes the snapshots by another digest, the documents are checked by the common one
+            return self._check_documents(collection.doc_ids(), collection, neigh)
+
+        subtable_size = ActiveAntiEntropy.IBLT_MIN_SUBTABLE_SIZE
+        while subtable_size <= DocumentSetSketch.MAX_SUBTABLE_SIZE:
+            sketch = collection.iblt_sketch(subtable_size)
+            payload, difference = self._request_pages(
+                receiver_addr_port,
+                lambda after: AAEIbltSketch(collection.name, header_by_spec(collection.digest_spec), sketch, after),
+                AAEOperationType.IBLT_DIFFERENCE, AAEIbltDifference.parse)
+            if payload is None:
+                return len(collection)
+
+            resp_type = AAEOperationType.get_by_value(payload[0])
+            if resp_type == AAEOperationType.IBLT_DECODE_FAILED:
+                subtable_size *= 2
+                continue
+
+            if resp_type == AAEOperationType.UNSUPPORTED_DIGEST:
+                neighbor_spec = spec_by_code(payload[1], payload[2])
+                logging.warning(f"Sketches of {collection.name} on {receiver_addr_port} are hashed by another "
+                                f"digest, the documents are checked one by one")
+                if neighbor_spec is not None and is_supported(neighbor_spec):
+                    self._negotiated_digests[(receiver_addr_port, collection.name)] = neighbor_spec
+                return self._check_documents(collection.doc_ids(), collection, neigh)
+
+            to_pull = []
+            for doc_id, remote_updated_at in difference.items():
+                if not collection.document_exists(doc_id):
+                    if remote_updated_at is not None:
+                        to_pull.append(doc_id)
+                    continue
+
+                _doc_id = DocumentId(doc_id)
+                if remote_updated_at is not None:
+                    local_updated_at = collection.get_updated_at(_doc_id)
+                    if local_updated_at < remote_updated_at:
+                        to_pull.append(doc_id)
+                    if local_updated_at <= remote_updated_at:
+                        continue
+
+                recv_doc_addr_port = (neigh.document_receiver.addr, neigh.document_receiver.port)
+                data, updated_at = collection.read_document_with_updated_at(_doc_id)
+                self._send_document(recv_doc_addr_port, CollectionName(collection.name), _doc_id, Document(data), updated_at)
+
+            if len(to_pull) > 0:
+                self._pull_documents(to_pull, collection, neigh)
+
+            return len(difference)
+
+        # the difference is too big for the biggest sketch
+        return self._check_documents(collection.doc_ids(), collection, neigh)
 
     @staticmethod
     def _parse_document_and_metadata(src: bytearray):
@@ -455,6 +2188,77 @@ class ActiveAntiEntropy(Subscriber):
 
         return collection_name, doc_id, doc, updated_at
 
+    def _on_received_payload(self, doc_and_metadata: bytes):
+        collection, doc_id, doc, updated_at = self._parse_document_and_metadata(doc_and_metadata)
+        with self._received_doc_lock:
+            self._on_received_doc(collection, doc_id, doc, updated_at)
+
+    def _on_received_frame(self, payload: bytes) -> bool:
+        # returns False if the document could not be decoded, the neighbor sends the full one then
+        def base_provider(collection_name: str, doc_id: str) -> tuple:
+            db_collection: CollectionOperations = self._db_core.get_collection_safely(collection_name)
+            if not db_collection.document_exists(doc_id):
+                return None
+
+            return db_collection.read_document_with_updated_at(DocumentId(doc_id))
+
+        with self._received_doc_lock:
+            decoded = document_codec.decode(payload, self._dictionaries, base_provider)
+            if decoded is None:
+                return False
+
+            collection_name, doc_id, updated_at, document = decoded
+            self._on_received_doc(CollectionName(collection_name), DocumentId(doc_id), Document(document), updated_at)
+
+        return True
+
+    def _encode_log_document(self, collection_name: str, doc_id: str) -> bytes:
+        collection: CollectionOperations = self._db_core.get_collection_safely(collection_name)
+        if not collection.document_exists(doc_id):
+            return None
+
+        data, updated_at = collection.read_document_with_updated_at(DocumentId(doc_id))
+        if self._conf.compression:
+            return document_codec.encode_zlib(collection_name, doc_id, updated_at, data,
+                                              self._dictionaries.get(collection_name))
+
+        return document_codec.encode_raw(collection_name, doc_id, updated_at, data)
+
+    def _on_log_frame(self, frame_type: LogFrameType, collection_name: str, body: bytes):
+        if frame_type == LogFrameType.SNAPSHOT_END:
+            # the collection is created even if it has no documents
+            self._db_core.get_collection_safely(collection_name)
+            return
+
+        if frame_type == LogFrameType.DELETE_DOC:
+            doc_id, deleted_at = decode_deletion(body)
+            if not self._is_replica(self._conf.current, collection_name, doc_id):
+                return
+
+            with self._received_doc_lock:
+                self._on_received_deletion(CollectionName(collection_name), DocumentId(doc_id), deleted_at)
+            return
+
+        if self._ring is not None:
+            doc_id = document_codec.decode_doc_id(body)
+            if not self._is_replica(self._conf.current, collection_name, doc_id):
+                return
+
+        if not self._on_received_frame(body):
+            raise Exception(f"Could not decode the document of {collection_name} from the change log")
+
+    def _on_received_deletion(self, collection: CollectionName, doc_id: DocumentId, deleted_at: datetime):
+        db_collection: CollectionOperations = self._db_core.get_collection_safely(collection.name)
+        filename = str(doc_id)
+        if not db_collection.document_exists(filename):
+            return
+
+        # the document written after the deletion is kept
+        if db_collection.get_updated_at(doc_id) > deleted_at:
+            return
+
+        db_collection.delete_document(filename, deleted_at)
+
     def _on_received_doc(self, collection: CollectionName, doc_id: DocumentId, doc: Document, updated_at: datetime):
         db_collection: CollectionOperations = self._db_core.get_collection_safely(collection.name)
         filename = str(doc_id)
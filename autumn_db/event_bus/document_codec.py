@@ -0,0 +1,196 @@
+import argparse
+import hashlib
+import os
+import sys
+import zlib
+from datetime import datetime
+
+from autumn_db import DocumentId
+from db_driver import DRIVER_COLLECTION_NAME_LENGTH_BYTES, DRIVER_BYTEORDER, DRIVER_DOCUMENT_ID_LENGTH
+
+# PAYLOAD format of the replication stream
+# |Encoding|Collection name length|Collection name|  DOC_ID  |UPDATED_AT| Extra |  Body  |
+#   1byte          1byte             1-255bytes     26bytes    26bytes
+# RAW:   no extra, the body is the document
+# ZLIB:  extra is the dictionary id (4bytes, zeros without the dictionary), the body is the compressed document
+# DELTA: extra is UPDATED_AT of the base version (26bytes), the body is the document compressed
+#        with the base version as the dictionary
+ENCODING_RAW = 0
+ENCODING_ZLIB = 1
+ENCODING_DELTA = 2
+
+UPDATED_AT_LENGTH = 26
+DICTIONARY_ID_LENGTH = 4
+NO_DICTIONARY_ID = bytes(DICTIONARY_ID_LENGTH)
+COMPRESSION_LEVEL = 6
+# zlib uses only the last 32KB of the dictionary
+MAX_DICTIONARY_SIZE = 32768
+
+
+def dictionary_id(dictionary: bytes) -> bytes:
+    if dictionary is None:
+        return NO_DICTIONARY_ID
+
+    return hashlib.blake2b(dictionary, digest_size=DICTIONARY_ID_LENGTH).digest()
+
+
+def train_dictionary(samples: list, size: int = MAX_DICTIONARY_SIZE) -> bytes:
+    # The dictionary is made of the most common samples. The closer to the end the content is,
+    # the shorter the distances to it, so the most common samples go last
+    counts = dict()
+    for sample in samples:
+        counts[sample] = counts.get(sample, 0) + 1
+
+    res = bytearray()
+    for sample in sorted(counts.keys(), key=lambda s: counts[s], reverse=True):
+        encoded = sample.encode('utf-8')
+        if len(res) + len(encoded) > size:
+            break
+
+        res[:0] = encoded
+
+    return bytes(res)
+
+
+def _compress(data: bytes, dictionary: bytes = None) -> bytes:
+    if dictionary is None:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    else:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=dictionary)
+
+    return compressor.compress(data) + compressor.flush()
+
+
+def _decompress(data: bytes, dictionary: bytes = None) -> bytes:
+    if dictionary is None:
+        decompressor = zlib.decompressobj()
+    else:
+        decompressor = zlib.decompressobj(zdict=dictionary)
+
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def _encode_updated_at(updated_at: datetime) -> bytes:
+    return datetime.strftime(updated_at, DocumentId.UTC_FORMAT).encode('utf-8')
+
+
+def _decode_updated_at(src: bytes) -> datetime:
+    return datetime.strptime(bytes(src).decode('utf-8'), DocumentId.UTC_FORMAT)
+
+
+def _encode_header(encoding: int, collection_name: str, doc_id: str, updated_at: datetime) -> bytearray:
+    b_collection_name = collection_name.encode('utf-8')
+
+    res = bytearray([encoding])
+    res.extend(len(b_collection_name).to_bytes(DRIVER_COLLECTION_NAME_LENGTH_BYTES, DRIVER_BYTEORDER, signed=False))
+    res.extend(b_collection_name)
+    res.extend(str(doc_id).encode('utf-8'))
+    res.extend(_encode_updated_at(updated_at))
+
+    return res
+
+
+def encode_raw(collection_name: str, doc_id: str, updated_at: datetime, document: str) -> bytearray:
+    res = _encode_header(ENCODING_RAW, collection_name, doc_id, updated_at)
+    res.extend(document.encode('utf-8'))
+
+    return res
+
+
+def encode_zlib(collection_name: str, doc_id: str, updated_at: datetime, document: str,
+                dictionary: bytes = None) -> bytearray:
+    res = _encode_header(ENCODING_ZLIB, collection_name, doc_id, updated_at)
+    res.extend(dictionary_id(dictionary))
+    res.extend(_compress(document.encode('utf-8'), dictionary))
+
+    return res
+
+
+def encode_delta(collection_name: str, doc_id: str, updated_at: datetime, document: str,
+                 base_updated_at: datetime, base_document: str) -> bytearray:
+    # the unchanged parts of the document are references to the base version
+    res = _encode_header(ENCODING_DELTA, collection_name, doc_id, updated_at)
+    res.extend(_encode_updated_at(base_updated_at))
+    res.extend(_compress(document.encode('utf-8'), base_document.encode('utf-8')))
+
+    return res
+
+
+def decode_doc_id(payload: bytes) -> str:
+    offset = 1
+    collection_name_length = int.from_bytes(payload[offset:offset + DRIVER_COLLECTION_NAME_LENGTH_BYTES],
+                                            DRIVER_BYTEORDER, signed=False)
+    offset += DRIVER_COLLECTION_NAME_LENGTH_BYTES + collection_name_length
+
+    return bytes(payload[offset:offset + DRIVER_DOCUMENT_ID_LENGTH]).decode('utf-8')
+
+
+def decode(payload: bytes, dictionaries: dict, base_provider) -> tuple:
+    # Returns collection name, doc id, updated at and the document, or None if the payload could not be decoded:
+    # the dictionary is unknown or the base version of the delta is not the local one.
+    # base_provider(collection name, doc id) returns the local (document, updated at) or None
+    encoding = payload[0]
+    offset = 1
+
+    collection_name_length = int.from_bytes(payload[offset:offset + DRIVER_COLLECTION_NAME_LENGTH_BYTES],
+                                            DRIVER_BYTEORDER, signed=False)
+    offset += DRIVER_COLLECTION_NAME_LENGTH_BYTES
+    collection_name = bytes(payload[offset:offset + collection_name_length]).decode('utf-8')
+    offset += collection_name_length
+    doc_id = bytes(payload[offset:offset + DRIVER_DOCUMENT_ID_LENGTH]).decode('utf-8')
+    offset += DRIVER_DOCUMENT_ID_LENGTH
+    updated_at = _decode_updated_at(payload[offset:offset + UPDATED_AT_LENGTH])
+    offset += UPDATED_AT_LENGTH
+
+    if encoding == ENCODING_RAW:
+        document = bytes(payload[offset:])
+    elif encoding == ENCODING_ZLIB:
+        _dictionary_id = bytes(payload[offset:offset + DICTIONARY_ID_LENGTH])
+        offset += DICTIONARY_ID_LENGTH
+
+        dictionary = None
+        if _dictionary_id != NO_DICTIONARY_ID:
+            dictionary = dictionaries.get(collection_name)
+            if dictionary_id(dictionary) != _dictionary_id:
+                return None
+
+        document = _decompress(bytes(payload[offset:]), dictionary)
+    elif encoding == ENCODING_DELTA:
+        base_updated_at = _decode_updated_at(payload[offset:offset + UPDATED_AT_LENGTH])
+        offset += UPDATED_AT_LENGTH
+
+        base = base_provider(collection_name, doc_id)
+        if base is None or base[1] != base_updated_at:
+            return None
+
+        document = _decompress(bytes(payload[offset:]), base[0].encode('utf-8'))
+    else:
+        raise Exception(f"Unknown document encoding {encoding}")
+
+    return collection_name, doc_id, updated_at, document.decode('utf-8')
+
+
+def main(argv: list = None) -> int:
+    # python -m autumn_db.event_bus.document_codec --collection db_holder/telemetry --output telemetry.dict
+    parser = argparse.ArgumentParser(description='Trains the compression dictionary on the documents of a collection')
+    parser.add_argument('--collection', required=True, help='path to the collection directory')
+    parser.add_argument('--output', required=True, help='file to save the dictionary into')
+    parser.add_argument('--size', type=int, default=MAX_DICTIONARY_SIZE)
+    args = parser.parse_args(argv)
+
+    data_path = os.path.join(args.collection, 'data')
+    samples = []
+    for filename in sorted(os.listdir(data_path)):
+        with open(os.path.join(data_path, filename), 'r') as f:
+            samples.append(f.read())
+
+    dictionary = train_dictionary(samples, args.size)
+    with open(args.output, 'wb') as f:
+        f.write(dictionary)
+
+    print(f"{len(dictionary)} bytes dictionary of {len(samples)} documents")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
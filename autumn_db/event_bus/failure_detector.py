@@ -0,0 +1,100 @@
+import logging
+import time
+
+
+class RttEstimator:
+    # Smoothed round-trip time and its variation, the timeout is SRTT + K * RTTVAR as in TCP (RFC 6298)
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial_timeout: float, min_timeout: float, max_timeout: float):
+        self._srtt = None
+        self._rttvar = None
+        self._timeout = initial_timeout
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+
+    @property
+    def srtt(self) -> float:
+        return self._srtt
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout
+
+    def on_sample(self, rtt: float):
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = (1 - RttEstimator.BETA) * self._rttvar + RttEstimator.BETA * abs(self._srtt - rtt)
+            self._srtt = (1 - RttEstimator.ALPHA) * self._srtt + RttEstimator.ALPHA * rtt
+
+        timeout = self._srtt + RttEstimator.K * self._rttvar
+        self._timeout = min(self._max_timeout, max(self._min_timeout, timeout))
+
+    def on_timeout(self):
+        # the estimation could be too optimistic, the next request waits longer
+        self._timeout = min(self._max_timeout, self._timeout * 2)
+
+
+class NeighborHealth:
+    # A heartbeat failure detector which uses the AAE replies as heartbeats. The neighbor is suspected
+    # after SUSPECT_AFTER timeouts in a row and is not requested during the suspension. The suspension
+    # doubles after every failed probe up to the max one, a reply resumes the neighbor
+    SUSPECT_AFTER = 3
+    MIN_TIMEOUT = 0.01
+    INITIAL_SUSPENSION = 1.0
+
+    def __init__(self, name: str, initial_timeout: float, max_timeout: float, max_suspension: float):
+        self._name = name
+        self._rtt = RttEstimator(initial_timeout, NeighborHealth.MIN_TIMEOUT, max_timeout)
+        self._max_suspension = max_suspension
+
+        self._failures = 0
+        self._suspension = NeighborHealth.INITIAL_SUSPENSION
+        self._suspended_until = 0.0
+        self._last_reply_at = None
+
+    @property
+    def timeout(self) -> float:
+        return self._rtt.timeout
+
+    @property
+    def srtt(self) -> float:
+        return self._rtt.srtt
+
+    @property
+    def is_suspected(self) -> bool:
+        return self._failures >= NeighborHealth.SUSPECT_AFTER
+
+    @property
+    def last_reply_at(self) -> float:
+        return self._last_reply_at
+
+    def is_available(self) -> bool:
+        # the suspected neighbor is probed again once the suspension is over
+        return time.monotonic() >= self._suspended_until
+
+    def on_reply(self, rtt: float):
+        if self.is_suspected:
+            logging.warning(f"Neighbor {self._name} is available again")
+
+        self._rtt.on_sample(rtt)
+        self._last_reply_at = time.monotonic()
+        self._failures = 0
+        self._suspension = NeighborHealth.INITIAL_SUSPENSION
+        self._suspended_until = 0.0
+
+    def on_timeout(self):
+        self._rtt.on_timeout()
+        self._failures += 1
+        if not self.is_suspected:
+            return
+
+        if self._failures == NeighborHealth.SUSPECT_AFTER:
+            logging.warning(f"Neighbor {self._name} is suspected to be down")
+
+        self._suspended_until = time.monotonic() + self._suspension
+        self._suspension = min(self._max_suspension, self._suspension * 2)
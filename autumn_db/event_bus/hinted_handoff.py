@@ -0,0 +1,127 @@
+import os
+import threading
+from collections import OrderedDict
+
+HINTS_DIR = '.hints'
+DEFAULT_MAX_HINTS = 100000
+
+
+class HintQueue:
+    # The documents which were not pushed to one neighbor. Every hint is a line of
+    # |Collection name|\t|DOC_ID| appended to the file, a removed hint is the line of \t|Collection name|\t|DOC_ID|.
+    # The file is compacted once the hints are replayed or it has twice as many lines as max_hints.
+    # A hint refers to the document, not to its version: the latest version is pushed on the replay.
+    # The oldest hints are dropped over max_hints, then the neighbor should be checked by a full sweep
+    SEPARATOR = '\t'
+
+    def __init__(self, path: str, max_hints: int = DEFAULT_MAX_HINTS):
+        self._path = path
+        self._max_hints = max_hints
+        # (collection name, doc id) -> version, the version changes when the hint is added again
+        self._hints = OrderedDict()
+        self._version = 0
+        self._file_lines = 0
+        self._overflowed = False
+        self._lock = threading.Lock()
+
+        if os.path.exists(self._path):
+            self._load()
+
+    def _load(self):
+        with open(self._path, 'r') as f:
+            for line in f:
+                self._file_lines += 1
+                line = line.rstrip('\n')
+                is_removed = line.startswith(HintQueue.SEPARATOR)
+                if is_removed:
+                    line = line[len(HintQueue.SEPARATOR):]
+                if HintQueue.SEPARATOR not in line:
+                    # the last line could be written partially
+                    continue
+
+                collection_name, doc_id = line.split(HintQueue.SEPARATOR, 1)
+                if is_removed:
+                    self._hints.pop((collection_name, doc_id), None)
+                else:
+                    self._put((collection_name, doc_id))
+
+        self.compact()
+
+    def __len__(self) -> int:
+        return len(self._hints)
+
+    def _put(self, hint: tuple) -> bool:
+        # returns whether the hint is new
+        self._version += 1
+        if hint in self._hints.keys():
+            self._hints[hint] = self._version
+            return False
+
+        if len(self._hints) >= self._max_hints:
+            self._hints.popitem(last=False)
+            self._overflowed = True
+
+        self._hints[hint] = self._version
+        return True
+
+    def _rewrite(self):
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for collection_name, doc_id in self._hints.keys():
+                f.write(f"{collection_name}{HintQueue.SEPARATOR}{doc_id}\n")
+        os.replace(tmp_path, self._path)
+        self._file_lines = len(self._hints)
+
+    def _append(self, lines: list):
+        # the dropped and removed hints are left in the file until it is compacted
+        if self._file_lines + len(lines) >= 2 * self._max_hints:
+            self._rewrite()
+            return
+
+        with open(self._path, 'a') as f:
+            f.writelines(lines)
+        self._file_lines += len(lines)
+
+    def add(self, collection_name: str, doc_id: str):
+        with self._lock:
+            if not self._put((collection_name, doc_id)):
+                return
+
+            self._append([f"{collection_name}{HintQueue.SEPARATOR}{doc_id}\n"])
+
+    def peek(self, count: int) -> list:
+        # returns up to count of the oldest hints as ((collection name, doc id), version) pairs
+        with self._lock:
+            res = []
+            for hint, version in self._hints.items():
+                if len(res) == count:
+                    break
+                res.append((hint, version))
+
+            return res
+
+    def remove(self, hints: list):
+        # removes the peeked hints, the ones added again since they were peeked are kept
+        with self._lock:
+            lines = []
+            for hint, version in hints:
+                if self._hints.get(hint) == version:
+                    del self._hints[hint]
+                    lines.append(f"{HintQueue.SEPARATOR}{hint[0]}{HintQueue.SEPARATOR}{hint[1]}\n")
+
+            if len(lines) > 0:
+                self._append(lines)
+
+    def compact(self):
+        # rewrites the file without the dropped and removed hints
+        with self._lock:
+            if self._file_lines > len(self._hints):
+                self._rewrite()
+
+    def take_overflowed(self) -> bool:
+        # returns whether some hints were dropped since the last call
+        with self._lock:
+            res = self._overflowed
+            self._overflowed = False
+
+        return res
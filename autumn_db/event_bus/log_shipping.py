@@ -0,0 +1,493 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+from enum import Enum
+
+from autumn_db import DocumentId
+from autumn_db.data_storage.collection.change_log import ChangeLog
+from autumn_db.event_bus import document_codec
+from db_driver import DRIVER_BYTEORDER, DRIVER_COLLECTION_NAME_LENGTH_BYTES, DRIVER_DOCUMENT_ID_LENGTH, \
+    DocumentOperation
+
+# REQUEST format, sent by the neighbor once connected
+# | Mode |...
+#  1byte
+# TAIL: the subscription follows. The collections which are not listed are shipped from the start
+# | Count |Collection name length|Collection name|  Seq  |...
+#  2bytes          1byte            1-255bytes     8bytes
+# SNAPSHOT: the resume points follow. The documents of the listed collections are streamed after the DOC_ID,
+# the collections which are not listed are streamed from the first document
+# | Count |Collection name length|Collection name|  DOC_ID  |...
+#  2bytes          1byte            1-255bytes     26bytes
+#
+# FRAME format
+# |Length| Type |  Seq  |Collection name length|Collection name| Body |
+#  4bytes  1byte  8bytes          1byte           1-255bytes
+# CREATE_DOC, UPDATE_DOC: the body is the document payload of document_codec
+# DELETE_DOC: the body is DOC_ID and UPDATED_AT of the deletion
+# HEARTBEAT: seq is the last shipped one, the body is the head seq of the log (8bytes)
+# TRUNCATED: the entries up to seq are dropped from the log, the documents are repaired by AAE
+# SNAPSHOT_DOC: the body is the document payload, seq is the head seq of the log when the collection was listed
+# SNAPSHOT_END: all the documents of the collection are streamed, the log should be tailed from seq
+# BOOTSTRAP_END: all the collections are streamed, the collection name is empty
+COUNT_BYTES = 2
+SEQ_BYTES = 8
+LENGTH_BYTES = 4
+FRAME_HEADER_LENGTH = LENGTH_BYTES + 1 + SEQ_BYTES
+UPDATED_AT_LENGTH = 26
+READ_BUFFER_SIZE = 65536
+
+CHANGE_LOG_DIR = '.change_log'
+BOOTSTRAP_FILENAME = '.bootstrap'
+
+MODE_TAIL = 0
+MODE_SNAPSHOT = 1
+
+
+class LogFrameType(Enum):
+    HEARTBEAT: int = 0
+    CREATE_DOC: int = DocumentOperation.CREATE_DOC.value
+    UPDATE_DOC: int = DocumentOperation.UPDATE_DOC.value
+    DELETE_DOC: int = DocumentOperation.DELETE_DOC.value
+    TRUNCATED: int = 5
+    SNAPSHOT_DOC: int = 6
+    SNAPSHOT_END: int = 7
+    BOOTSTRAP_END: int = 8
+
+
+def _encode_name(collection_name: str) -> bytearray:
+    b_collection_name = collection_name.encode('utf-8')
+
+    res = bytearray()
+    res.extend(len(b_collection_name).to_bytes(DRIVER_COLLECTION_NAME_LENGTH_BYTES, DRIVER_BYTEORDER, signed=False))
+    res.extend(b_collection_name)
+
+    return res
+
+
+def encode_frame(frame_type: LogFrameType, seq: int, collection_name: str, body: bytes = b'') -> bytearray:
+    name = _encode_name(collection_name)
+
+    res = bytearray()
+    res.extend((1 + SEQ_BYTES + len(name) + len(body)).to_bytes(LENGTH_BYTES, DRIVER_BYTEORDER, signed=False))
+    res.extend(bytes([frame_type.value]))
+    res.extend(seq.to_bytes(SEQ_BYTES, DRIVER_BYTEORDER, signed=False))
+    res.extend(name)
+    res.extend(body)
+
+    return res
+
+
+def decode_frames(buffer: bytearray) -> list:
+    # takes the complete frames out of the buffer and returns them as (type, seq, collection name, body)
+    res = []
+    while len(buffer) >= LENGTH_BYTES:
+        length = int.from_bytes(buffer[:LENGTH_BYTES], DRIVER_BYTEORDER, signed=False)
+        if len(buffer) < LENGTH_BYTES + length:
+            break
+
+        frame = bytes(buffer[LENGTH_BYTES:LENGTH_BYTES + length])
+        del buffer[:LENGTH_BYTES + length]
+
+        frame_type = LogFrameType(frame[0])
+        seq = int.from_bytes(frame[1:1 + SEQ_BYTES], DRIVER_BYTEORDER, signed=False)
+        offset = 1 + SEQ_BYTES
+        name_length = int.from_bytes(frame[offset:offset + DRIVER_COLLECTION_NAME_LENGTH_BYTES],
+                                     DRIVER_BYTEORDER, signed=False)
+        offset += DRIVER_COLLECTION_NAME_LENGTH_BYTES
+        collection_name = frame[offset:offset + name_length].decode('utf-8')
+        res.append((frame_type, seq, collection_name, frame[offset + name_length:]))
+
+    return res
+
+
+def encode_deletion(doc_id: str, updated_at: datetime) -> bytes:
+    return doc_id.encode('utf-8') + datetime.strftime(updated_at, DocumentId.UTC_FORMAT).encode('utf-8')
+
+
+def decode_deletion(body: bytes) -> tuple:
+    doc_id = body[:DRIVER_DOCUMENT_ID_LENGTH].decode('utf-8')
+    updated_at_str = body[DRIVER_DOCUMENT_ID_LENGTH:DRIVER_DOCUMENT_ID_LENGTH + UPDATED_AT_LENGTH].decode('utf-8')
+
+    return doc_id, datetime.strptime(updated_at_str, DocumentId.UTC_FORMAT)
+
+
+class ChangeLogServer:
+    # Ships the change logs of all the collections to every connected neighbor, starting from
+    # the sequence numbers it asked for, and keeps tailing them.
+    # A new neighbor can ask for the snapshot first: the documents of every collection are streamed in bulk
+    # and the log is tailed from its head seq at the moment the collection was listed. A document changed
+    # while streaming is sent in its latest version and its change is shipped again by the log.
+    # encode_document(collection name, doc id) returns the document payload or None if there is no document
+    BATCH_SIZE = 256
+    HEARTBEAT_INTERVAL = 1.0
+    IDLE_TIMEOUT = 0.05
+    ACCEPT_TIMEOUT = 0.2
+    SUBSCRIPTION_TIMEOUT = 5.0
+
+    def __init__(self, port: int, db_core, encode_document):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(
+            ('0.0.0.0', port)
+        )
+        self._socket.settimeout(ChangeLogServer.ACCEPT_TIMEOUT)
+        self._socket.listen()
+        self._db_core = db_core
+        self._encode_document = encode_document
+
+    def processing(self):
+        try:
+            connection, client_address = self._socket.accept()
+        except socket.timeout:
+            return
+
+        # every neighbor is served by its own thread until it disconnects
+        threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    @staticmethod
+    def _recv_exactly(connection: socket.socket, size: int) -> bytes:
+        res = bytearray()
+        while len(res) < size:
+            part = connection.recv(size - len(res))
+            if not part:
+                raise ConnectionError('Subscription is not complete')
+            res.extend(part)
+
+        return bytes(res)
+
+    def _read_subscription(self, connection: socket.socket) -> dict:
+        positions = dict()
+        count = int.from_bytes(self._recv_exactly(connection, COUNT_BYTES), DRIVER_BYTEORDER, signed=False)
+        for _ in range(count):
+            name_length = self._recv_exactly(connection, DRIVER_COLLECTION_NAME_LENGTH_BYTES)
+            name_length = int.from_bytes(name_length, DRIVER_BYTEORDER, signed=False)
+            collection_name = self._recv_exactly(connection, name_length).decode('utf-8')
+            seq = self._recv_exactly(connection, SEQ_BYTES)
+            positions[collection_name] = int.from_bytes(seq, DRIVER_BYTEORDER, signed=False)
+
+        return positions
+
+    def _read_resume_points(self, connection: socket.socket) -> dict:
+        after = dict()
+        count = int.from_bytes(self._recv_exactly(connection, COUNT_BYTES), DRIVER_BYTEORDER, signed=False)
+        for _ in range(count):
+            name_length = self._recv_exactly(connection, DRIVER_COLLECTION_NAME_LENGTH_BYTES)
+            name_length = int.from_bytes(name_length, DRIVER_BYTEORDER, signed=False)
+            collection_name = self._recv_exactly(connection, name_length).decode('utf-8')
+            after[collection_name] = self._recv_exactly(connection, DRIVER_DOCUMENT_ID_LENGTH).decode('utf-8')
+
+        return after
+
+    def _serve(self, connection: socket.socket):
+        try:
+            with connection:
+                connection.settimeout(ChangeLogServer.SUBSCRIPTION_TIMEOUT)
+                mode = self._recv_exactly(connection, 1)[0]
+                if mode == MODE_SNAPSHOT:
+                    after = self._read_resume_points(connection)
+                    connection.settimeout(None)
+                    self._stream_snapshot(connection, after)
+                    return
+
+                positions = self._read_subscription(connection)
+                connection.settimeout(None)
+
+                heartbeat_at = 0.0
+                while True:
+                    shipped = 0
+                    for collection in list(self._db_core.collections.values()):
+                        shipped += self._ship(connection, collection, positions)
+
+                    if time.monotonic() - heartbeat_at >= ChangeLogServer.HEARTBEAT_INTERVAL:
+                        self._send_heartbeats(connection, positions)
+                        heartbeat_at = time.monotonic()
+
+                    if shipped == 0:
+                        time.sleep(ChangeLogServer.IDLE_TIMEOUT)
+        except OSError:
+            # the neighbor disconnected, it resumes from its last applied entry
+            return
+
+    def _stream_snapshot(self, connection: socket.socket, after: dict):
+        for collection in sorted(self._db_core.collections.values(), key=lambda c: c.name):
+            # the changes made while streaming are after the seq
+            seq = collection.change_log.head_seq
+            doc_ids = sorted(str(doc_id) for doc_id in collection.doc_ids() if str(doc_id) > after.get(collection.name, ''))
+
+            for i in range(0, len(doc_ids), ChangeLogServer.BATCH_SIZE):
+                frames = bytearray()
+                for doc_id in doc_ids[i:i + ChangeLogServer.BATCH_SIZE]:
+                    body = self._encode_document(collection.name, doc_id)
+                    if body is not None:
+                        frames.extend(encode_frame(LogFrameType.SNAPSHOT_DOC, seq, collection.name, body))
+
+                if len(frames) > 0:
+                    connection.sendall(frames)
+
+            connection.sendall(encode_frame(LogFrameType.SNAPSHOT_END, seq, collection.name))
+
+        connection.sendall(encode_frame(LogFrameType.BOOTSTRAP_END, 0, ''))
+
+    def _ship(self, connection: socket.socket, collection, positions: dict) -> int:
+        change_log: ChangeLog = collection.change_log
+        since = positions.get(collection.name, 0)
+        if since > change_log.head_seq:
+            # the collection was created again, its log starts from the beginning
+            since = 0
+
+        frames = bytearray()
+        entries = change_log.entries_since(since, ChangeLogServer.BATCH_SIZE)
+        if entries is None:
+            since = change_log.truncated_seq
+            frames.extend(encode_frame(LogFrameType.TRUNCATED, since, collection.name))
+            entries = change_log.entries_since(since, ChangeLogServer.BATCH_SIZE) or []
+        positions[collection.name] = since
+
+        for entry in entries:
+            if not entry.is_shipped:
+                continue
+
+            if entry.operation == DocumentOperation.DELETE_DOC:
+                body = encode_deletion(entry.doc_id, entry.updated_at)
+            else:
+                # the latest version is shipped, the deleted document is skipped as its deletion follows
+                body = self._encode_document(collection.name, entry.doc_id)
+                if body is None:
+                    continue
+
+            frames.extend(encode_frame(LogFrameType(entry.operation.value), entry.seq, collection.name, body))
+
+        if len(entries) > 0:
+            positions[collection.name] = entries[-1].seq
+        if len(frames) > 0:
+            connection.sendall(frames)
+
+        return len(entries)
+
+    def _send_heartbeats(self, connection: socket.socket, positions: dict):
+        frames = bytearray()
+        for collection in list(self._db_core.collections.values()):
+            head_seq = collection.change_log.head_seq
+            frames.extend(encode_frame(LogFrameType.HEARTBEAT, positions.get(collection.name, 0), collection.name,
+                                       head_seq.to_bytes(SEQ_BYTES, DRIVER_BYTEORDER, signed=False)))
+
+        if len(frames) > 0:
+            connection.sendall(frames)
+
+
+class ChangeLogTailer:
+    # Tails the change logs of one neighbor and applies the entries by handler(type, collection name, body).
+    # The applied sequence numbers are saved to the file, so the tailing resumes from them after a restart
+    CONNECT_TIMEOUT = 1.0
+    # several heartbeats are missed before the connection is considered broken
+    READ_TIMEOUT = 5 * ChangeLogServer.HEARTBEAT_INTERVAL
+    SAVE_INTERVAL = 1.0
+    RECONNECT_INTERVAL = 1.0
+
+    def __init__(self, addr_port: tuple, path: str, handler):
+        self._addr_port = addr_port
+        self._path = path
+        self._handler = handler
+
+        # collection name -> the last applied seq
+        self._positions = dict()
+        # collection name -> the last known head seq of the neighbor
+        self._heads = dict()
+        # the number of the entries dropped from the log of the neighbor before they were applied
+        self._missed = 0
+        self._saved_at = time.monotonic()
+        self._is_connected = False
+
+        if os.path.exists(self._path):
+            with open(self._path, 'r') as f:
+                self._positions = json.loads(f.read())
+
+    @property
+    def missed(self) -> int:
+        return self._missed
+
+    @property
+    def lag(self) -> dict:
+        # collection name -> the number of the entries which are not applied yet
+        return {name: max(0, head - self._positions.get(name, 0)) for name, head in self._heads.items()}
+
+    def _save(self):
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(self._positions))
+        os.replace(tmp_path, self._path)
+        self._saved_at = time.monotonic()
+
+    def start_from(self, positions: dict):
+        # must be called before the tailing starts
+        self._positions = dict(positions)
+        self._save()
+
+    def _subscription(self) -> bytearray:
+        positions = dict(self._positions)
+
+        res = bytearray([MODE_TAIL])
+        res.extend(len(positions).to_bytes(COUNT_BYTES, DRIVER_BYTEORDER, signed=False))
+        for collection_name, seq in positions.items():
+            res.extend(_encode_name(collection_name))
+            res.extend(seq.to_bytes(SEQ_BYTES, DRIVER_BYTEORDER, signed=False))
+
+        return res
+
+    def processing(self):
+        try:
+            self._tail()
+        except OSError:
+            if self._is_connected:
+                logging.warning(f"Change log of {self._addr_port[0]}:{self._addr_port[1]} is not available")
+            self._is_connected = False
+            self._save()
+            time.sleep(ChangeLogTailer.RECONNECT_INTERVAL)
+
+    def _tail(self):
+        with socket.create_connection(self._addr_port, timeout=ChangeLogTailer.CONNECT_TIMEOUT) as connection:
+            connection.settimeout(ChangeLogTailer.READ_TIMEOUT)
+            connection.sendall(self._subscription())
+            self._is_connected = True
+
+            buffer = bytearray()
+            while True:
+                part = connection.recv(READ_BUFFER_SIZE)
+                if not part:
+                    raise ConnectionError(f"Change log of {self._addr_port} is closed")
+
+                buffer.extend(part)
+                for frame_type, seq, collection_name, body in decode_frames(buffer):
+                    self._on_frame(frame_type, seq, collection_name, body)
+
+                if time.monotonic() - self._saved_at >= ChangeLogTailer.SAVE_INTERVAL:
+                    self._save()
+
+    def _on_frame(self, frame_type: LogFrameType, seq: int, collection_name: str, body: bytes):
+        if frame_type == LogFrameType.HEARTBEAT:
+            self._heads[collection_name] = int.from_bytes(body, DRIVER_BYTEORDER, signed=False)
+        elif frame_type == LogFrameType.TRUNCATED:
+            position = self._positions.get(collection_name, 0)
+            if seq > position:
+                self._missed += seq - position
+                logging.warning(f"Entries {position + 1}-{seq} of {collection_name} are dropped from the change log of "
+                                f"{self._addr_port[0]}:{self._addr_port[1]}, the documents are repaired by AAE")
+        else:
+            try:
+                self._handler(frame_type, collection_name, body)
+            except Exception as e:
+                # the document is repaired by AAE later, the log is not blocked by it
+                logging.warning(e)
+
+        # the frames come in order, so everything up to the seq is received
+        self._positions[collection_name] = seq
+
+
+class SnapshotBootstrap:
+    # Fills the new node with the snapshot of a neighbor streamed by its change log server, the documents
+    # are applied by handler(type, collection name, body). The last applied document of every collection
+    # is saved to the file, so an interrupted stream resumes after it. Once all the collections are streamed,
+    # positions are the seqs the change log of the neighbor should be tailed from
+    CONNECT_TIMEOUT = 1.0
+    READ_TIMEOUT = 30.0
+    SAVE_INTERVAL = 1.0
+    RECONNECT_INTERVAL = 1.0
+
+    def __init__(self, addr_port: tuple, path: str, handler):
+        self._addr_port = addr_port
+        self._path = path
+        self._handler = handler
+
+        # collection name -> the last applied doc id
+        self._after = dict()
+        # collection name -> the seq of the first snapshot, the earliest one covers the resumed streams
+        self._positions = dict()
+        self._is_done = False
+        self._saved_at = time.monotonic()
+        self._is_connected = False
+
+        if os.path.exists(self._path):
+            with open(self._path, 'r') as f:
+                state = json.loads(f.read())
+            self._after = state['after']
+            self._positions = state['positions']
+            self._is_done = state['is_done']
+
+    @property
+    def is_done(self) -> bool:
+        return self._is_done
+
+    @property
+    def positions(self) -> dict:
+        return dict(self._positions)
+
+    def _save(self):
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({'after': self._after, 'positions': self._positions, 'is_done': self._is_done}))
+        os.replace(tmp_path, self._path)
+        self._saved_at = time.monotonic()
+
+    def _request(self) -> bytearray:
+        res = bytearray([MODE_SNAPSHOT])
+        res.extend(len(self._after).to_bytes(COUNT_BYTES, DRIVER_BYTEORDER, signed=False))
+        for collection_name, doc_id in self._after.items():
+            res.extend(_encode_name(collection_name))
+            res.extend(doc_id.encode('utf-8'))
+
+        return res
+
+    def processing(self):
+        try:
+            self._stream()
+        except OSError:
+            if self._is_connected:
+                logging.warning(f"Snapshot stream of {self._addr_port[0]}:{self._addr_port[1]} is interrupted")
+            self._is_connected = False
+            self._save()
+            time.sleep(SnapshotBootstrap.RECONNECT_INTERVAL)
+
+    def _stream(self):
+        with socket.create_connection(self._addr_port, timeout=SnapshotBootstrap.CONNECT_TIMEOUT) as connection:
+            connection.settimeout(SnapshotBootstrap.READ_TIMEOUT)
+            connection.sendall(self._request())
+            self._is_connected = True
+
+            buffer = bytearray()
+            while not self._is_done:
+                part = connection.recv(READ_BUFFER_SIZE)
+                if not part:
+                    raise ConnectionError(f"Snapshot stream of {self._addr_port} is closed")
+
+                buffer.extend(part)
+                for frame_type, seq, collection_name, body in decode_frames(buffer):
+                    self._on_frame(frame_type, seq, collection_name, body)
+
+                if time.monotonic() - self._saved_at >= SnapshotBootstrap.SAVE_INTERVAL:
+                    self._save()
+
+        self._save()
+
+    def _on_frame(self, frame_type: LogFrameType, seq: int, collection_name: str, body: bytes):
+        if frame_type == LogFrameType.BOOTSTRAP_END:
+            self._is_done = True
+            return
+
+        if collection_name not in self._positions:
+            self._positions[collection_name] = seq
+
+        if frame_type == LogFrameType.SNAPSHOT_DOC:
+            try:
+                self._handler(frame_type, collection_name, body)
+            except Exception as e:
+                # the document is repaired by AAE later, the stream is not blocked by it
+                logging.warning(e)
+
+            self._after[collection_name] = document_codec.decode_doc_id(body)
+        elif frame_type == LogFrameType.SNAPSHOT_END:
+            self._handler(frame_type, collection_name, body)
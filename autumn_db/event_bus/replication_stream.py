@@ -0,0 +1,278 @@
+import logging
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from db_driver import DRIVER_BYTEORDER
+
+# The first byte of a stream connection. A single document connection starts with
+# the collection name length, which is never 0
+STREAM_MARKER = b'\x00'
+
+# FRAME format
+# |Length|  Seq  | Payload |
+#  4bytes 4bytes   Xbytes
+# ACK format (cumulative, sent after the frames are handled)
+# |  Seq  |Nack count|Nacked seq|...
+#  4bytes    2bytes     4bytes
+# A nacked frame was received but could not be applied, its fallback is sent instead
+LENGTH_BYTES = 4
+SEQ_BYTES = 4
+NACK_COUNT_BYTES = 2
+ACK_HEADER_LENGTH = SEQ_BYTES + NACK_COUNT_BYTES
+FRAME_HEADER_LENGTH = LENGTH_BYTES + SEQ_BYTES
+READ_BUFFER_SIZE = 65536
+
+DEFAULT_STREAM_WINDOW = 64
+CONNECT_TIMEOUT = 1.0
+ACK_TIMEOUT = 5.0
+POLL_INTERVAL = 0.01
+
+
+def encode_frame(seq: int, payload: bytes) -> bytearray:
+    res = bytearray()
+    res.extend(len(payload).to_bytes(LENGTH_BYTES, DRIVER_BYTEORDER, signed=False))
+    res.extend(seq.to_bytes(SEQ_BYTES, DRIVER_BYTEORDER, signed=False))
+    res.extend(payload)
+
+    return res
+
+
+def decode_frames(buffer: bytearray) -> list:
+    # takes the complete frames out of the buffer and returns them as (seq, payload) pairs
+    res = []
+    while len(buffer) >= FRAME_HEADER_LENGTH:
+        length = int.from_bytes(buffer[:LENGTH_BYTES], DRIVER_BYTEORDER, signed=False)
+        if len(buffer) < FRAME_HEADER_LENGTH + length:
+            break
+
+        seq = int.from_bytes(buffer[LENGTH_BYTES:FRAME_HEADER_LENGTH], DRIVER_BYTEORDER, signed=False)
+        res.append((seq, bytes(buffer[FRAME_HEADER_LENGTH:FRAME_HEADER_LENGTH + length])))
+        del buffer[:FRAME_HEADER_LENGTH + length]
+
+    return res
+
+
+def encode_ack(seq: int, nacked: list) -> bytearray:
+    res = bytearray()
+    res.extend(seq.to_bytes(SEQ_BYTES, DRIVER_BYTEORDER, signed=False))
+    res.extend(len(nacked).to_bytes(NACK_COUNT_BYTES, DRIVER_BYTEORDER, signed=False))
+    for nacked_seq in nacked:
+        res.extend(nacked_seq.to_bytes(SEQ_BYTES, DRIVER_BYTEORDER, signed=False))
+
+    return res
+
+
+def decode_acks(buffer: bytearray) -> list:
+    # takes the complete acks out of the buffer and returns them as (seq, nacked seqs) pairs
+    res = []
+    while len(buffer) >= ACK_HEADER_LENGTH:
+        count = int.from_bytes(buffer[SEQ_BYTES:ACK_HEADER_LENGTH], DRIVER_BYTEORDER, signed=False)
+        length = ACK_HEADER_LENGTH + count * SEQ_BYTES
+        if len(buffer) < length:
+            break
+
+        seq = int.from_bytes(buffer[:SEQ_BYTES], DRIVER_BYTEORDER, signed=False)
+        nacked = set()
+        for offset in range(ACK_HEADER_LENGTH, length, SEQ_BYTES):
+            nacked.add(int.from_bytes(buffer[offset:offset + SEQ_BYTES], DRIVER_BYTEORDER, signed=False))
+        res.append((seq, nacked))
+        del buffer[:length]
+
+    return res
+
+
+def serve_stream(connection: socket.socket, handler):
+    # Reads the frames of one stream until the sender closes it. The frames got by one read
+    # are handled and acknowledged together, the frames the handler returned False for are nacked
+    buffer = bytearray()
+    with connection:
+        while True:
+            part = connection.recv(READ_BUFFER_SIZE)
+            if not part:
+                return
+
+            buffer.extend(part)
+            frames = decode_frames(buffer)
+            if len(frames) == 0:
+                continue
+
+            nacked = []
+            for seq, payload in frames:
+                try:
+                    if handler(payload) is False:
+                        nacked.append(seq)
+                except Exception as e:
+                    # the frame is not applied, the document is repaired by AAE later
+                    logging.warning(e)
+                    nacked.append(seq)
+
+            last_seq = frames[-1][0]
+            connection.sendall(encode_ack(last_seq, nacked))
+
+
+class ReplicationStream:
+    # A persistent connection to the document receiver of one neighbor. Up to window frames
+    # are sent before waiting for the acks. The not acknowledged frames are sent again once
+    # after a reconnection, then they are dropped with the callback called once the frame is lost.
+    # A frame could have a fallback payload sent if the frame is nacked, a callback called once
+    # the frame is applied and a callback called once it is nacked without a fallback
+
+    def __init__(self, addr_port: tuple, window: int = DEFAULT_STREAM_WINDOW):
+        self._addr_port = addr_port
+        self._window = window
+        self._socket = None
+        self._seq = 0
+        # seq -> (payload, on_ack, fallback, on_nack, on_lost)
+        self._unacked = OrderedDict()
+        self._ack_buffer = bytearray()
+        self._lock = threading.Lock()
+
+    @property
+    def addr_port(self) -> tuple:
+        return self._addr_port
+
+    def _connect(self):
+        self._socket = socket.create_connection(self._addr_port, timeout=CONNECT_TIMEOUT)
+        self._socket.settimeout(ACK_TIMEOUT)
+        self._socket.sendall(STREAM_MARKER)
+        self._ack_buffer = bytearray()
+
+    def _close(self):
+        if self._socket is not None:
+            self._socket.close()
+        self._socket = None
+
+    def _next_seq(self) -> int:
+        self._seq = (self._seq + 1) % (1 << 8 * SEQ_BYTES)
+        return self._seq
+
+    def _read_acks(self, blocking: bool, timeout: float = ACK_TIMEOUT):
+        self._socket.setblocking(blocking)
+        if blocking:
+            self._socket.settimeout(timeout)
+
+        try:
+            part = self._socket.recv(READ_BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        finally:
+            self._socket.settimeout(ACK_TIMEOUT)
+
+        if not part:
+            raise ConnectionError(f"Replication stream to {self._addr_port} is closed")
+
+        self._ack_buffer.extend(part)
+        for acked, nacked in decode_acks(self._ack_buffer):
+            fallbacks = []
+            # the acks are cumulative
+            while acked in self._unacked.keys():
+                seq, (_, on_ack, fallback, on_nack, on_lost) = self._unacked.popitem(last=False)
+                if seq in nacked:
+                    if fallback is not None:
+                        fallbacks.append((fallback, on_ack, on_nack, on_lost))
+                    elif on_nack is not None:
+                        on_nack()
+                elif on_ack is not None:
+                    on_ack()
+
+                if seq == acked:
+                    break
+
+            for fallback, on_ack, on_nack, on_lost in fallbacks:
+                seq = self._next_seq()
+                self._unacked[seq] = (fallback, on_ack, None, on_nack, on_lost)
+                self._socket.sendall(encode_frame(seq, fallback))
+
+    def _send_unacked(self):
+        for seq, (payload, _, _, _, _) in self._unacked.items():
+            self._socket.sendall(encode_frame(seq, payload))
+
+    def _drop_unacked(self):
+        # the frames are lost with the connection
+        for _, (_, _, _, _, on_lost) in self._unacked.items():
+            if on_lost is None:
+                continue
+
+            try:
+                on_lost()
+            except Exception as e:
+                logging.warning(e)
+
+        self._unacked.clear()
+
+    def _send(self, seq: int, payload: bytes):
+        if self._socket is None:
+            self._connect()
+            # the frame is among the not acknowledged ones
+            self._send_unacked()
+        else:
+            self._socket.sendall(encode_frame(seq, payload))
+
+        self._read_acks(blocking=False)
+        while len(self._unacked) >= self._window:
+            self._read_acks(blocking=True)
+
+    def send(self, payload: bytes, on_ack=None, fallback: bytes = None, on_nack=None, on_lost=None):
+        with self._lock:
+            seq = self._next_seq()
+            self._unacked[seq] = (payload, on_ack, fallback, on_nack, on_lost)
+
+            try:
+                self._send(seq, payload)
+                return
+            except OSError:
+                self._close()
+
+            # one more attempt for the case the neighbor restarted
+            try:
+                self._send(seq, payload)
+            except OSError as e:
+                self._close()
+                self._drop_unacked()
+                raise e
+
+    def flush(self) -> bool:
+        # Waits until all the sent frames are answered, returns False if they were not.
+        # A nacked frame is answered too, only its on_ack tells that it is applied
+        with self._lock:
+            try:
+                while len(self._unacked) > 0 and self._socket is not None:
+                    self._read_acks(blocking=True)
+            except OSError:
+                self._close()
+                self._drop_unacked()
+                return False
+
+            return len(self._unacked) == 0
+
+    def wait(self, is_acked, timeout: float) -> bool:
+        # Waits until is_acked() returns True, e.g. the callback of a frame is called.
+        # The stream is not held between the reads, so the other frames are sent meanwhile
+        deadline = time.monotonic() + timeout
+        while not is_acked():
+            if time.monotonic() >= deadline:
+                return False
+
+            with self._lock:
+                if is_acked():
+                    break
+                if self._socket is None:
+                    # the frame is dropped with the connection
+                    return False
+
+                try:
+                    self._read_acks(blocking=True, timeout=POLL_INTERVAL)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    self._close()
+                    self._drop_unacked()
+                    return False
+
+        return True
+
+    def close(self):
+        with self._lock:
+            self._close()
@@ -0,0 +1,122 @@
+import random
+import time
+
+
+class TokenBucket:
+    # None rate means the budget is not limited
+
+    def __init__(self, rate: float = None, burst_seconds: float = 1.0):
+        self._rate = rate
+        self._burst_seconds = burst_seconds
+        self._tokens = self._capacity
+        self._updated_at = time.monotonic()
+
+    @property
+    def _capacity(self) -> float:
+        if self._rate is None:
+            return 0.0
+
+        return self._rate * self._burst_seconds
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def set_rate(self, rate: float):
+        self._refill()
+        self._rate = rate
+        self._tokens = min(self._tokens, self._capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self._rate is not None:
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    def consume(self, amount: float) -> float:
+        # the tokens are taken in debt, returns the seconds to wait until the debt is paid
+        if self._rate is None:
+            return 0.0
+
+        self._refill()
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return 0.0
+
+        return -self._tokens / self._rate
+
+
+class SweepScheduler:
+    # The sweep runs at the full budget while the neighbors diverge and slows down to
+    # MIN_RATE_FACTOR of it when they have converged. The pause between the sweeps doubles
+    # after every sweep without mismatches up to the max interval
+    MIN_RATE_FACTOR = 0.1
+    # the mismatch ratio from which the full budget is used
+    FULL_RATE_MISMATCH_RATIO = 0.01
+    MISMATCH_SMOOTHING = 0.3
+
+    def __init__(self, interval: float, max_interval: float, jitter: float, docs_per_second: float = None,
+                 bytes_per_second: float = None, adaptive_rate: bool = True):
+        self._min_interval = interval
+        self._max_interval = max(interval, max_interval)
+        self._interval = interval
+        self._jitter = jitter
+        self._docs_per_second = docs_per_second
+        self._bytes_per_second = bytes_per_second
+        self._adaptive_rate = adaptive_rate
+
+        self._docs_bucket = TokenBucket(docs_per_second)
+        self._bytes_bucket = TokenBucket(bytes_per_second)
+
+        # smoothed share of the checked documents which differ from the neighbors
+        self._mismatch_ratio = 1.0
+        self._has_mismatches = False
+
+    @property
+    def mismatch_ratio(self) -> float:
+        return self._mismatch_ratio
+
+    @property
+    def interval(self) -> float:
+        return self._interval
+
+    @property
+    def rate_factor(self) -> float:
+        if not self._adaptive_rate:
+            return 1.0
+
+        divergence = min(1.0, self._mismatch_ratio / SweepScheduler.FULL_RATE_MISMATCH_RATIO)
+        return SweepScheduler.MIN_RATE_FACTOR + (1 - SweepScheduler.MIN_RATE_FACTOR) * divergence
+
+    def on_checked(self, docs: int, mismatch_ratio: float, sent_bytes: int) -> float:
+        # returns the seconds to wait before checking the next documents
+        if docs > 0:
+            smoothing = SweepScheduler.MISMATCH_SMOOTHING
+            self._mismatch_ratio = smoothing * mismatch_ratio + (1 - smoothing) * self._mismatch_ratio
+        if mismatch_ratio > 0:
+            self._has_mismatches = True
+
+        factor = self.rate_factor
+        if self._docs_per_second is not None:
+            self._docs_bucket.set_rate(self._docs_per_second * factor)
+        if self._bytes_per_second is not None:
+            self._bytes_bucket.set_rate(self._bytes_per_second * factor)
+
+        res = max(self._docs_bucket.consume(docs), self._bytes_bucket.consume(sent_bytes))
+        return res
+
+    def on_sweep_finished(self) -> float:
+        # returns the seconds to wait before the next sweep
+        if self._has_mismatches:
+            self._interval = self._min_interval
+        else:
+            self._interval = min(self._max_interval, self._interval * 2)
+        self._has_mismatches = False
+
+        res = self._interval * (1 + random.uniform(-self._jitter, self._jitter))
+        return max(0.0, res)
+
+    def on_change(self):
+        # a local change is checked by the next sweep soon
+        self._interval = self._min_interval
+        self._has_mismatches = True
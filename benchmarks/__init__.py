@@ -0,0 +1,140 @@
+import json
+import platform
+import re
+import sys
+import time
+from datetime import datetime
+
+import test_data
+
+DATA_NAME_PATTERN = r'data\d+$'
+
+
+def load_corpus() -> dict:
+    names = [name for name in dir(test_data) if re.match(DATA_NAME_PATTERN, name)]
+    names.sort(key=lambda name: int(name[len('data'):]))
+
+    res = {name: getattr(test_data, name) for name in names}
+    return res
+
+
+def scale_corpus(corpus: dict, scales: list) -> dict:
+    # the corpus documents are close in size, so the bigger ones are built as nested copies of them
+    res = dict()
+    for name, data in corpus.items():
+        for scale in scales:
+            if scale == 1:
+                res[name] = data
+                continue
+
+            _json = json.loads(data)
+            scaled = {f"part{i}": dict(_json) for i in range(scale)}
+            res[f"{name}x{scale}"] = json.dumps(scaled)
+
+    return res
+
+
+class Measurement:
+
+    def __init__(self, case: str, implementation: str, document: str, size: int, seconds_per_doc: float):
+        self.case = case
+        self.implementation = implementation
+        self.document = document
+        self.size = size
+        self.seconds_per_doc = seconds_per_doc
+
+    @property
+    def ns_per_byte(self) -> float:
+        if self.size == 0:
+            return 0.0
+
+        return self.seconds_per_doc * 1e9 / self.size
+
+    @property
+    def docs_per_second(self) -> float:
+        if self.seconds_per_doc == 0:
+            return 0.0
+
+        return 1 / self.seconds_per_doc
+
+    @property
+    def key(self) -> str:
+        return f"{self.case}/{self.implementation}/{self.document}"
+
+    def to_dict(self) -> dict:
+        return {
+            'case': self.case,
+            'implementation': self.implementation,
+            'document': self.document,
+            'size': self.size,
+            'ns_per_byte': self.ns_per_byte,
+            'docs_per_second': self.docs_per_second,
+        }
+
+
+def measure(func, repeat: int, number: int) -> float:
+    # the minimum of the repeats is the least noisy estimation of the cost
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def environment() -> dict:
+    return {
+        'python': sys.version,
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'created_at': datetime.utcnow().isoformat(),
+    }
+
+
+def save_results(pathname: str, measurements: list, extra: dict = None):
+    content = {
+        'environment': environment(),
+        'measurements': [m.to_dict() for m in measurements],
+    }
+    if extra is not None:
+        content.update(extra)
+
+    with open(pathname, 'w') as f:
+        json.dump(content, f, indent=2)
+
+
+def compare_with_baseline(pathname: str, measurements: list, tolerance: float) -> list:
+    # returns the cases which became slower than the baseline by more than the tolerance
+    with open(pathname, 'r') as f:
+        baseline = json.load(f)
+
+    baseline_by_key = dict()
+    for entry in baseline['measurements']:
+        key = f"{entry['case']}/{entry['implementation']}/{entry['document']}"
+        baseline_by_key[key] = entry
+
+    regressions = []
+    for m in measurements:
+        if m.key not in baseline_by_key.keys():
+            continue
+
+        before = baseline_by_key[m.key]['ns_per_byte']
+        if before > 0 and m.ns_per_byte > before * (1 + tolerance):
+            regressions.append((m.key, before, m.ns_per_byte))
+
+    return regressions
+
+
+def print_table(measurements: list):
+    header = f"{'case':<16}{'implementation':<28}{'document':<12}{'bytes':>8}{'ns/byte':>12}{'docs/s':>14}"
+    print(header)
+    print('-' * len(header))
+    for m in measurements:
+        print(f"{m.case:<16}{m.implementation:<28}{m.document:<12}{m.size:>8}"
+              f"{m.ns_per_byte:>12.1f}{m.docs_per_second:>14.1f}")
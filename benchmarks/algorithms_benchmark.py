@@ -0,0 +1,115 @@
+import argparse
+import json
+import random
+import sys
+
+from algorithms import to_bytearray_from_values, diff_bytearrays_from_values
+from algorithms.ph2 import PH2
+from algorithms.spectral_bloom_filter import SpectralBloomFilter
+from algorithms.digest import Digest, calculate_digest, recalculate_digest
+from autumn_db.event_bus.active_anti_entropy import Snapshot
+from benchmarks import load_corpus, scale_corpus, measure, Measurement, save_results, compare_with_baseline, print_table
+
+# python -m benchmarks.algorithms_benchmark --output bench.json [--baseline previous.json]
+
+SEED = 2024
+HOT_FIELDS = ['timestamp', 'speed']
+
+
+def _sbf(_bytearray: bytearray):
+    sbf = SpectralBloomFilter()
+    sbf.add(_bytearray)
+
+
+def _ph2(_bytearray: bytearray):
+    ph2 = PH2()
+    ph2.append(_bytearray)
+    ph2.hashing()
+
+
+def _full_snapshot(data: str):
+    _bytearray = to_bytearray_from_values(json.loads(data))
+    Snapshot(calculate_digest(_bytearray))
+
+
+def _incremental_snapshot(old_data: str, new_data: str, digest: Digest):
+    # the previous version is parsed as the update of a document which is not kept parsed does
+    _cached_incremental_snapshot(json.loads(old_data), new_data, digest)
+
+
+def _cached_incremental_snapshot(old_json: dict, new_data: str, digest: Digest):
+    removed, added = diff_bytearrays_from_values(old_json, json.loads(new_data))
+    Snapshot(recalculate_digest(digest, removed, added))
+
+
+def _hot_field_update(_json: dict, rnd: random.Random) -> dict:
+    res = dict(_json)
+    for field in HOT_FIELDS:
+        if field in res.keys():
+            res[field] = rnd.randrange(1 << 20)
+
+    # the scaled documents keep the hot fields in the first part
+    first_part = next(iter(res.values()))
+    if isinstance(first_part, dict):
+        res['part0'] = _hot_field_update(first_part, rnd)
+
+    return res
+
+
+def run(repeat: int, number: int, scales: list) -> list:
+    rnd = random.Random(SEED)
+    measurements = []
+
+    for name, data in scale_corpus(load_corpus(), scales).items():
+        _json = json.loads(data)
+        _bytearray = to_bytearray_from_values(_json)
+        size = len(_bytearray)
+
+        def add(case: str, implementation: str, func):
+            seconds = measure(func, repeat, number)
+            measurements.append(Measurement(case, implementation, name, size, seconds))
+
+        add('to_bytearray', 'to_bytearray_from_values', lambda: to_bytearray_from_values(_json))
+        add('sbf', 'SpectralBloomFilter', lambda: _sbf(_bytearray))
+        add('ph2', 'PH2', lambda: _ph2(_bytearray))
+
+        # Snapshot maintenance on an update of the hot fields: the full recalculation vs the incremental one,
+        # which parses the previous version unless the document is kept parsed. The disk reads are not measured
+        updated = json.dumps(_hot_field_update(_json, rnd))
+        digest = calculate_digest(_bytearray)
+        add('snapshot', 'full', lambda: _full_snapshot(updated))
+        add('snapshot', 'incremental', lambda: _incremental_snapshot(data, updated, digest))
+        add('snapshot', 'incremental_cached', lambda: _cached_incremental_snapshot(_json, updated, digest))
+
+    return measurements
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmarks of the algorithms package on the test_data corpus')
+    parser.add_argument('--output', default='bench_output.json', help='JSON file to save the results into')
+    parser.add_argument('--baseline', default=None, help='JSON file with the results of the previous run')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown against the baseline')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--scales', default='1,4,16,64', help='comma separated sizes of the documents in the corpus units')
+    args = parser.parse_args(argv)
+
+    scales = [int(scale) for scale in args.scales.split(',')]
+    measurements = run(args.repeat, args.number, scales)
+    print_table(measurements)
+    save_results(args.output, measurements, {
+        'repeat': args.repeat, 'number': args.number, 'scales': scales, 'seed': SEED
+    })
+
+    if args.baseline is None:
+        return 0
+
+    regressions = compare_with_baseline(args.baseline, measurements, args.tolerance)
+    for key, before, after in regressions:
+        print(f"REGRESSION {key}: {before:.1f} -> {after:.1f} ns/byte")
+
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
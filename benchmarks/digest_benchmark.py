@@ -0,0 +1,132 @@
+import argparse
+import json
+import random
+import sys
+
+from algorithms.digest import calculate_document_digest, calculate_digest, create_digest, registered_digests
+from benchmarks import load_corpus, scale_corpus, measure, Measurement, save_results, compare_with_baseline, print_table
+
+# python -m benchmarks.digest_benchmark --output digest_bench.json [--digests sbf_ph2,blake2b:8]
+
+SEED = 2024
+DEFAULT_SIZES = {'blake2b': [8, 16, 32]}
+
+
+def default_specs() -> list:
+    res = []
+    for name in registered_digests():
+        sizes = DEFAULT_SIZES.get(name)
+        if sizes is None:
+            res.append(name)
+            continue
+
+        res.extend(f"{name}:{size}" for size in sizes)
+
+    return res
+
+
+def small_changes(_json: dict, rnd: random.Random, count: int) -> list:
+    # typical divergences of the replicas: a number changed a bit, two values swapped, one char changed
+    numeric_keys = [key for key, value in _json.items() if isinstance(value, int) and not isinstance(value, bool)]
+    string_keys = [key for key, value in _json.items() if isinstance(value, str) and len(value) > 0]
+
+    res = []
+    while len(res) < count:
+        variant = dict(_json)
+        kind = rnd.randrange(3)
+
+        if kind == 0 and len(numeric_keys) > 0:
+            key = rnd.choice(numeric_keys)
+            variant[key] = variant[key] + rnd.choice([-2, -1, 1, 2])
+        elif kind == 1 and len(numeric_keys) > 1:
+            first, second = rnd.sample(numeric_keys, 2)
+            if variant[first] == variant[second]:
+                continue
+            variant[first], variant[second] = variant[second], variant[first]
+        elif kind == 2 and len(string_keys) > 0:
+            key = rnd.choice(string_keys)
+            value = variant[key]
+            i = rnd.randrange(len(value))
+            variant[key] = value[:i] + chr((ord(value[i]) + 1) % 128) + value[i + 1:]
+        else:
+            continue
+
+        if variant != _json:
+            res.append(variant)
+
+    return res
+
+
+def collision_rate(spec: str, corpus: dict, variants_per_doc: int) -> float:
+    # the share of the changed documents which have the same digest as the original, i.e. missed divergences
+    rnd = random.Random(SEED)
+    collisions = 0
+    total = 0
+    for data in corpus.values():
+        _json = json.loads(data)
+        original = calculate_document_digest(_json, spec).get()
+
+        for variant in small_changes(_json, rnd, variants_per_doc):
+            total += 1
+            if calculate_document_digest(variant, spec).get() == original:
+                collisions += 1
+
+    return collisions / total if total > 0 else 0.0
+
+
+def run(specs: list, repeat: int, number: int, scales: list) -> tuple:
+    measurements = []
+    for name, data in scale_corpus(load_corpus(), scales).items():
+        _json = json.loads(data)
+
+        for spec in specs:
+            # every digest hashes its own encoding of the document
+            _bytearray = create_digest(spec).encode_document(_json)
+            seconds = measure(lambda: calculate_digest(_bytearray, spec).get(), repeat, number)
+            measurements.append(Measurement('digest', spec, name, len(_bytearray), seconds))
+
+    return measurements
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Throughput and collision rate of the snapshot digests')
+    parser.add_argument('--output', default='bench_output.json', help='JSON file to save the results into')
+    parser.add_argument('--baseline', default=None, help='JSON file with the results of the previous run')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown against the baseline')
+    parser.add_argument('--digests', default=None, help='comma separated digest specs, all registered by default')
+    parser.add_argument('--variants', type=int, default=500, help='changed copies per document for collisions')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--scales', default='1,4,16,64', help='comma separated sizes of the documents in the corpus units')
+    args = parser.parse_args(argv)
+
+    specs = default_specs() if args.digests is None else args.digests.split(',')
+    scales = [int(scale) for scale in args.scales.split(',')]
+
+    measurements = run(specs, args.repeat, args.number, scales)
+    print_table(measurements)
+
+    corpus = load_corpus()
+    collisions = {spec: collision_rate(spec, corpus, args.variants) for spec in specs}
+    print()
+    print(f"{'digest':<16}{'collision rate':>16}")
+    for spec, rate in collisions.items():
+        print(f"{spec:<16}{rate:>16.4f}")
+
+    save_results(args.output, measurements, {
+        'repeat': args.repeat, 'number': args.number, 'scales': scales, 'seed': SEED,
+        'variants': args.variants, 'collision_rate': collisions,
+    })
+
+    if args.baseline is None:
+        return 0
+
+    regressions = compare_with_baseline(args.baseline, measurements, args.tolerance)
+    for key, before, after in regressions:
+        print(f"REGRESSION {key}: {before:.1f} -> {after:.1f} ns/byte")
+
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
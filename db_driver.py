@@ -1,8 +1,14 @@
 import json
 import math
+import random
 import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
 from enum import Enum
 
+from algorithms.consistent_hash import HashRing
 from autumn_db import DocumentId
 
 DRIVER_OPERATION_LENGTH = 1
@@ -10,6 +16,8 @@ DRIVER_COLLECTION_NAME_LENGTH_BYTES = 1
 DRIVER_COLLECTION_NAME_LENGTH_BYTES_MAX = 255
 DRIVER_BYTEORDER = 'big'
 DRIVER_DOCUMENT_ID_LENGTH = 26
+# the read response of a document which the node does not have
+DRIVER_DOCUMENT_NOT_FOUND = 'None'
 
 
 class DocumentOperation(Enum):
@@ -17,6 +25,11 @@ class DocumentOperation(Enum):
     UPDATE_DOC = 2
     DELETE_DOC = 3
     READ_DOC = 4
+    # |OpCode|W|...| the write is acknowledged once W replicas persisted it
+    CREATE_DOC_QUORUM = 5
+    UPDATE_DOC_QUORUM = 6
+    # |OpCode|R|...| the newest version of R replicas is read
+    READ_DOC_QUORUM = 7
 
 
 class CollectionOperation(Enum):
@@ -24,6 +37,10 @@ class CollectionOperation(Enum):
     DELETE_COLLECTION = 12
 
 
+class ClusterOperation(Enum):
+    GET_TOPOLOGY = 21
+
+
 class CollectionName:
     COLLECTION_NAME_LENGTH = math.pow(2, DRIVER_COLLECTION_NAME_LENGTH_BYTES)
 
@@ -44,7 +61,7 @@ class CollectionName:
 class Document:
 
     def __init__(self, doc: str):
-        if doc == 'None':
+        if doc == DRIVER_DOCUMENT_NOT_FOUND:
             self._doc = None
             return
 
@@ -59,9 +76,29 @@ class Document:
         return self._doc
 
 
-def send_message_to(addr_port: tuple, message: bytes, expect_response: bool = False) -> bytearray:
+class QuorumNotReachedError(Exception):
+    # the write is persisted by fewer replicas than requested, the others still get it
+
+    def __init__(self, message: str, doc_id: str):
+        super().__init__(message)
+        self.doc_id = doc_id
+
+
+class NodeUnreachableError(ConnectionError):
+    # the connection to the node failed, so the request was not sent
+    pass
+
+
+def send_message_to(addr_port: tuple, message: bytes, expect_response: bool = False,
+                    timeout: float = None) -> bytearray:
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect(addr_port)
+    s.settimeout(timeout)
+    try:
+        s.connect(addr_port)
+    except OSError as e:
+        s.close()
+        raise NodeUnreachableError(f"Could not connect to {addr_port}: {e}") from e
+
     s.sendall(message)
 
     resp = None
@@ -79,10 +116,23 @@ def send_message_to(addr_port: tuple, message: bytes, expect_response: bool = Fa
 
 
 class DBDriver:
+    QUORUM_REACHED = b'+'
 
-    def __init__(self, addr: str, port: int = 50000):
+    def __init__(self, addr: str, port: int = 50000, timeout: float = None):
         self._addr = addr
         self._port = port
+        self._timeout = timeout
+
+    def get_topology(self) -> dict:
+        # the nodes of the cluster with their client endpoints and the parameters of the partitioning ring
+        oper_bytes = ClusterOperation.GET_TOPOLOGY.value.to_bytes(
+            DRIVER_OPERATION_LENGTH, DRIVER_BYTEORDER, signed=False)
+
+        _bytes = bytearray(oper_bytes)
+        _bytes.extend(b'\x00')
+
+        response = send_message_to((self._addr, self._port), _bytes, expect_response=True, timeout=self._timeout)
+        return json.loads(response.decode('utf-8'))
 
     def create_collection(self, name: CollectionName):
         pass
@@ -102,11 +152,15 @@ class DBDriver:
         _bytes.extend(collection_name_bytes)
         _bytes.extend(b'\x00')
 
-        send_message_to((self._addr, self._port), _bytes)
+        send_message_to((self._addr, self._port), _bytes, timeout=self._timeout)
 
-    def create_document(self, collection: CollectionName, doc: Document):
+    def create_document(self, collection: CollectionName, doc: Document, write_quorum: int = None):
+        # with write_quorum the call returns once the number of the replicas persisted the document
 
-        oper_bytes = DocumentOperation.CREATE_DOC.value.to_bytes(DRIVER_OPERATION_LENGTH, DRIVER_BYTEORDER, signed=False)
+        oper = DocumentOperation.CREATE_DOC if write_quorum is None else DocumentOperation.CREATE_DOC_QUORUM
+        oper_bytes = oper.value.to_bytes(DRIVER_OPERATION_LENGTH, DRIVER_BYTEORDER, signed=False)
+        if write_quorum is not None:
+            oper_bytes += self._encode_quorum(write_quorum)
 
         collection_name_bytes = collection.name.encode('utf-8')
 
@@ -132,15 +186,36 @@ class DBDriver:
         _bytes.extend(b'\x00')
 
         doc_id_bytes = send_message_to(
-            (self._addr, self._port), _bytes, expect_response=True
+            (self._addr, self._port), _bytes, expect_response=True, timeout=self._timeout
         )
 
+        if write_quorum is not None:
+            doc_id = doc_id_bytes[1:].decode('utf-8')
+            self._check_write_quorum(doc_id_bytes, doc_id, write_quorum)
+            return doc_id
+
         doc_id = doc_id_bytes.decode('utf-8')
         return doc_id
 
-    def read_document(self, collection: CollectionName, doc_id: DocumentId):
-        oper_bytes = DocumentOperation.READ_DOC.value.to_bytes(DRIVER_OPERATION_LENGTH, DRIVER_BYTEORDER,
-                                                               signed=False)
+    @staticmethod
+    def _encode_quorum(quorum: int) -> bytes:
+        if not 1 <= quorum <= 255:
+            raise Exception(f"Quorum {quorum} should be in [1, 255]")
+
+        return quorum.to_bytes(1, DRIVER_BYTEORDER, signed=False)
+
+    @staticmethod
+    def _check_write_quorum(response: bytearray, doc_id: str, write_quorum: int):
+        # the document is still replicated to the other replicas
+        if bytes(response[:1]) != DBDriver.QUORUM_REACHED:
+            raise QuorumNotReachedError(f"Document {doc_id} is persisted by fewer than {write_quorum} replicas", doc_id)
+
+    def read_document(self, collection: CollectionName, doc_id: DocumentId, read_quorum: int = None):
+        # with read_quorum the node checks the document with the other replicas and returns the newest version
+        oper = DocumentOperation.READ_DOC if read_quorum is None else DocumentOperation.READ_DOC_QUORUM
+        oper_bytes = oper.value.to_bytes(DRIVER_OPERATION_LENGTH, DRIVER_BYTEORDER, signed=False)
+        if read_quorum is not None:
+            oper_bytes += self._encode_quorum(read_quorum)
 
         collection_name_bytes = collection.name.encode('utf-8')
 
@@ -159,16 +234,24 @@ class DBDriver:
         _bytes.extend(b'\x00')
 
         doc_bytes = send_message_to(
-            (self._addr, self._port), _bytes, expect_response=True
+            (self._addr, self._port), _bytes, expect_response=True, timeout=self._timeout
         )
 
+        if read_quorum is not None:
+            if bytes(doc_bytes[:1]) != DBDriver.QUORUM_REACHED:
+                raise Exception(f"Document {doc_id} is not confirmed by {read_quorum} replicas")
+            doc_bytes = doc_bytes[1:]
+
         doc = doc_bytes.decode('utf-8')
         res = Document(doc)
         return res.document
 
-    def update_document(self, collection: CollectionName, doc_id: DocumentId, doc: Document):
-        oper_bytes = DocumentOperation.UPDATE_DOC.value.to_bytes(DRIVER_OPERATION_LENGTH, DRIVER_BYTEORDER,
-                                                                 signed=False)
+    def update_document(self, collection: CollectionName, doc_id: DocumentId, doc: Document, write_quorum: int = None):
+        # with write_quorum the call returns once the number of the replicas persisted the document
+        oper = DocumentOperation.UPDATE_DOC if write_quorum is None else DocumentOperation.UPDATE_DOC_QUORUM
+        oper_bytes = oper.value.to_bytes(DRIVER_OPERATION_LENGTH, DRIVER_BYTEORDER, signed=False)
+        if write_quorum is not None:
+            oper_bytes += self._encode_quorum(write_quorum)
 
         collection_name_bytes = collection.name.encode('utf-8')
 
@@ -186,8 +269,14 @@ class DBDriver:
         _bytes.extend(doc_id_bytes)
         _bytes.extend(doc.document.encode('utf-8'))
 
+        if write_quorum is not None:
+            _bytes.extend(b'\x00')
+            response = send_message_to((self._addr, self._port), _bytes, expect_response=True, timeout=self._timeout)
+            self._check_write_quorum(response, str(doc_id), write_quorum)
+            return
+
         send_message_to(
-            (self._addr, self._port), _bytes
+            (self._addr, self._port), _bytes, timeout=self._timeout
         )
 
     def delete_document(self, collection: CollectionName, doc_id: DocumentId):
@@ -210,5 +299,333 @@ class DBDriver:
         _bytes.extend(doc_id_bytes)
 
         send_message_to(
-            (self._addr, self._port), _bytes
-        )
\ No newline at end of file
+            (self._addr, self._port), _bytes, timeout=self._timeout
+        )
+
+class _ClusterNode:
+    # the load of a node seen by the driver: the requests in flight and the latency EWMA
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, node_id: str, addr_port: tuple, timeout: float):
+        self.node_id = node_id
+        self.addr_port = addr_port
+        self.driver = DBDriver(addr_port[0], addr_port[1], timeout)
+        self.outstanding = 0
+        self.latency = 0.0
+        self.down_until = 0.0
+
+    def score(self) -> float:
+        # the node without the observed latency is tried first
+        return (self.outstanding + 1) * self.latency
+
+    def observe(self, latency: float):
+        if self.latency == 0.0:
+            self.latency = latency
+        else:
+            self.latency = _ClusterNode.EWMA_ALPHA * latency + (1 - _ClusterNode.EWMA_ALPHA) * self.latency
+
+
+class ClusterDBDriver:
+    # Learns the nodes and the partitioning ring from the bootstrap nodes and sends every request to a node
+    # which owns the document. The updates and the deletes go to the primary replica, the reads are spread over
+    # the replicas: of two random ones the less loaded is chosen by (outstanding requests + 1) * latency EWMA.
+    # The creates go to the least loaded node since the document id is given by the node, the document is moved
+    # to its replicas by the hand-off. Under partitioning a create waits for one replica at least, so the document
+    # can be read right after it. The node which fails is skipped for DOWN_INTERVAL and the request is
+    # retried on the next replica, then on any node. A create is retried only if it was not sent, a read goes
+    # to the replicas only and the next replica is asked if one does not have the document yet.
+    # The timeout should be larger than write_quorum_timeout and read_quorum_timeout of the nodes,
+    # otherwise a slow quorum request is reported as failed.
+    # With hedge_percentile a read which is not answered in that percentile of the recent read latencies is sent
+    # to a second replica as well, the first answer is returned. The hedges are limited by hedge_budget,
+    # the share of the reads which can be hedged
+    DOWN_INTERVAL = 5.0
+    TOPOLOGY_REFRESH_INTERVAL = 30.0
+    READ_LATENCY_SAMPLES = 1000
+    # the hedge delay is not known until that number of the reads
+    MIN_READ_LATENCY_SAMPLES = 20
+    HEDGE_DELAY_RECALCULATION = 50
+    # the unused budget is accumulated up to that number of the hedges
+    MAX_HEDGE_TOKENS = 10.0
+    HEDGE_WORKERS = 32
+
+    def __init__(self, bootstrap: list, timeout: float = 10.0, hedge_percentile: float = None,
+                 hedge_budget: float = 0.05):
+        # bootstrap is the list of (addr, port) of the client endpoints
+        if hedge_percentile is not None and not 0 < hedge_percentile < 100:
+            raise Exception(f"Hedge percentile {hedge_percentile} should be in (0, 100)")
+
+        self._bootstrap = list(bootstrap)
+        self._timeout = timeout
+        self._hedge_percentile = hedge_percentile
+        self._hedge_budget = hedge_budget
+        self._hedge_tokens = 0.0
+        self._hedge_delay = None
+        self._read_latencies = deque(maxlen=ClusterDBDriver.READ_LATENCY_SAMPLES)
+        self._reads_since_recalculation = 0
+        self._reads = 0
+        self._hedged_reads = 0
+        self._hedge_executor = None
+        if hedge_percentile is not None:
+            self._hedge_executor = ThreadPoolExecutor(max_workers=ClusterDBDriver.HEDGE_WORKERS)
+        # node id -> _ClusterNode
+        self._nodes = dict()
+        self._ring = None
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+
+        self.refresh_topology()
+
+    @property
+    def nodes(self) -> list:
+        with self._lock:
+            return list(self._nodes.keys())
+
+    @property
+    def hedge_stats(self) -> tuple:
+        # (reads, hedged reads, current hedge delay)
+        with self._lock:
+            return self._reads, self._hedged_reads, self._hedge_delay
+
+    def refresh_topology(self):
+        with self._lock:
+            known = [node.addr_port for node in self._nodes.values()]
+
+        topology = None
+        for addr, port in known + self._bootstrap:
+            try:
+                topology = DBDriver(addr, port, self._timeout).get_topology()
+                break
+            except OSError:
+                continue
+
+        if topology is None:
+            raise Exception('None of the nodes returned the cluster topology')
+
+        ring = None
+        if topology['replication_factor'] is not None:
+            ring = HashRing(topology['ring_nodes'], topology['replication_factor'], topology['virtual_nodes'])
+
+        with self._lock:
+            nodes = dict()
+            for node in topology['nodes']:
+                # the load of the known node is kept
+                addr_port = (node['addr'], node['port'])
+                cluster_node = self._nodes.get(node['id'])
+                if cluster_node is None or cluster_node.addr_port != addr_port:
+                    cluster_node = _ClusterNode(node['id'], addr_port, self._timeout)
+                nodes[node['id']] = cluster_node
+
+            self._nodes = nodes
+            self._ring = ring
+            self._refreshed_at = time.monotonic()
+
+    def _replicas(self, collection: CollectionName, doc_id: DocumentId) -> list:
+        # the replicas of the document which the driver can reach, the primary one is first
+        if self._ring is None:
+            # every node stores all the documents
+            return list(self._nodes.keys())
+
+        return [node_id for node_id in self._ring.replicas(collection.name, str(doc_id)) if node_id in self._nodes]
+
+    def _pick(self, candidates: list, balanced: bool) -> _ClusterNode:
+        now = time.monotonic()
+        alive = [self._nodes[node_id] for node_id in candidates if self._nodes[node_id].down_until <= now]
+        if len(alive) == 0:
+            # every node is down, the one which failed first is tried again
+            alive = [min([self._nodes[node_id] for node_id in candidates], key=lambda n: n.down_until)]
+
+        if not balanced or len(alive) == 1:
+            return alive[0]
+
+        first, second = random.sample(alive, 2)
+        return first if first.score() <= second.score() else second
+
+    def _refresh_if_stale(self):
+        if time.monotonic() - self._refreshed_at > ClusterDBDriver.TOPOLOGY_REFRESH_INTERVAL:
+            self.refresh_topology()
+
+    def _call(self, node: _ClusterNode, request):
+        # node.outstanding is increased by the caller
+        started_at = time.monotonic()
+        try:
+            res = request(node.driver)
+        except OSError:
+            with self._lock:
+                node.outstanding -= 1
+                node.down_until = time.monotonic() + ClusterDBDriver.DOWN_INTERVAL
+            raise
+
+        with self._lock:
+            node.outstanding -= 1
+            node.observe(time.monotonic() - started_at)
+            node.down_until = 0.0
+
+        return res
+
+    def _execute(self, request, collection: CollectionName = None, doc_id: DocumentId = None,
+                 balanced: bool = True, idempotent: bool = True, is_found=None):
+        # request(driver) is tried on the replicas of the document, then on the other nodes.
+        # The request which is not idempotent is retried only if it was not sent. With is_found(result)
+        # the request is a read: it is tried on the replicas only, until one of them has the document
+        self._refresh_if_stale()
+
+        last_error = None
+        for attempt in range(2):
+            with self._lock:
+                replicas = list(self._nodes.keys()) if doc_id is None else self._replicas(collection, doc_id)
+                others = [node_id for node_id in self._nodes.keys() if node_id not in replicas]
+
+            tried = set()
+            is_answered = False
+            for candidates in [replicas] if is_found is not None else [replicas, others]:
+                while True:
+                    with self._lock:
+                        candidates = [node_id for node_id in candidates if node_id not in tried]
+                        if len(candidates) == 0:
+                            break
+
+                        node = self._pick(candidates, balanced)
+                        node.outstanding += 1
+
+                    tried.add(node.node_id)
+                    try:
+                        res = self._call(node, request)
+                    except OSError as e:
+                        if not idempotent and not isinstance(e, NodeUnreachableError):
+                            # the node could have executed the request
+                            raise e
+                        last_error = e
+                        continue
+
+                    if is_found is None or is_found(res):
+                        return res
+                    is_answered = True
+
+            if is_answered:
+                # none of the replicas has the document
+                return None
+
+            if attempt == 0:
+                # the nodes could be moved, the topology is learnt again
+                try:
+                    self.refresh_topology()
+                except Exception:
+                    break
+
+        raise Exception(f"None of the nodes executed the request: {last_error}")
+
+    def delete_collection(self, name: CollectionName):
+        with self._lock:
+            drivers = [node.driver for node in self._nodes.values()]
+
+        for driver in drivers:
+            driver.delete_collection(name)
+
+    def create_document(self, collection: CollectionName, doc: Document, write_quorum: int = None) -> str:
+        with self._lock:
+            is_partitioned = self._ring is not None
+
+        if write_quorum is not None or not is_partitioned:
+            return self._execute(lambda driver: driver.create_document(collection, doc, write_quorum), idempotent=False)
+
+        # the node which gets the create could be not a replica of the document
+        def request(driver: DBDriver) -> str:
+            try:
+                return driver.create_document(collection, doc, 1)
+            except QuorumNotReachedError as e:
+                # the replicas are down, they get the document once they are back
+                return e.doc_id
+
+        return self._execute(request, idempotent=False)
+
+    def read_document(self, collection: CollectionName, doc_id: DocumentId, read_quorum: int = None):
+        request = lambda driver: driver.read_document(collection, doc_id, read_quorum)
+        if self._hedge_executor is None:
+            return self._execute(request, collection, doc_id, is_found=ClusterDBDriver._is_found)
+
+        return self._hedged_read(request, collection, doc_id)
+
+    def _timed_read(self, node: _ClusterNode, request):
+        started_at = time.monotonic()
+        res = self._call(node, request)
+        latency = time.monotonic() - started_at
+
+        with self._lock:
+            self._read_latencies.append(latency)
+            self._reads_since_recalculation += 1
+            if self._reads_since_recalculation >= ClusterDBDriver.HEDGE_DELAY_RECALCULATION \
+                    or (self._hedge_delay is None and len(self._read_latencies) >= ClusterDBDriver.MIN_READ_LATENCY_SAMPLES):
+                latencies = sorted(self._read_latencies)
+                self._hedge_delay = latencies[int(self._hedge_percentile / 100 * (len(latencies) - 1))]
+                self._reads_since_recalculation = 0
+
+        return res
+
+    def _hedged_read(self, request, collection: CollectionName, doc_id: DocumentId):
+        self._refresh_if_stale()
+
+        with self._lock:
+            self._reads += 1
+            self._hedge_tokens = min(self._hedge_tokens + self._hedge_budget, ClusterDBDriver.MAX_HEDGE_TOKENS)
+
+            now = time.monotonic()
+            replicas = [node_id for node_id in self._replicas(collection, doc_id)
+                        if self._nodes[node_id].down_until <= now]
+            delay = self._hedge_delay
+            if len(replicas) == 0:
+                node = None
+            else:
+                node = self._pick(replicas, balanced=True)
+                node.outstanding += 1
+
+        if node is None:
+            return self._execute(request, collection, doc_id, is_found=ClusterDBDriver._is_found)
+
+        first = self._hedge_executor.submit(self._timed_read, node, request)
+        try:
+            res = first.result(timeout=delay)
+            if ClusterDBDriver._is_found(res):
+                return res
+            # the other replicas are asked whether they have the document
+            return self._execute(request, collection, doc_id, is_found=ClusterDBDriver._is_found)
+        except FutureTimeoutError:
+            pass
+        except OSError:
+            return self._execute(request, collection, doc_id, is_found=ClusterDBDriver._is_found)
+
+        with self._lock:
+            others = [node_id for node_id in replicas if node_id != node.node_id]
+            hedge = None
+            if len(others) > 0 and self._hedge_tokens >= 1:
+                self._hedge_tokens -= 1
+                self._hedged_reads += 1
+                hedge = self._pick(others, balanced=True)
+                hedge.outstanding += 1
+
+        pending = {first}
+        if hedge is not None:
+            pending.add(self._hedge_executor.submit(self._timed_read, hedge, request))
+
+        # the slower read is not cancelled, its latency is observed as well
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is None and ClusterDBDriver._is_found(future.result()):
+                    return future.result()
+                if error is not None and not isinstance(error, OSError):
+                    raise error
+
+        return self._execute(request, collection, doc_id, is_found=ClusterDBDriver._is_found)
+
+    @staticmethod
+    def _is_found(document: str) -> bool:
+        return document is not None
+
+    def update_document(self, collection: CollectionName, doc_id: DocumentId, doc: Document, write_quorum: int = None):
+        self._execute(lambda driver: driver.update_document(collection, doc_id, doc, write_quorum), collection, doc_id,
+                      balanced=False)
+
+    def delete_document(self, collection: CollectionName, doc_id: DocumentId):
+        self._execute(lambda driver: driver.delete_document(collection, doc_id), collection, doc_id, balanced=False)
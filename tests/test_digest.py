@@ -0,0 +1,27 @@
+import pytest
+
+from algorithms.digest import calculate_document_digest, create_digest, registered_digests
+
+STRONG_SPECS = [name for name in registered_digests() if not create_digest(name).IS_ADDITIVE]
+
+
+@pytest.mark.parametrize('spec', STRONG_SPECS)
+def test_renamed_key_changes_digest(spec):
+    assert calculate_document_digest({'a': 1}, spec).get() != calculate_document_digest({'b': 1}, spec).get()
+
+
+@pytest.mark.parametrize('spec', STRONG_SPECS)
+def test_value_boundaries_change_digest(spec):
+    assert calculate_document_digest({'a': 'xy'}, spec).get() != \
+        calculate_document_digest({'a': 'x', 'b': 'y'}, spec).get()
+
+
+@pytest.mark.parametrize('spec', STRONG_SPECS)
+def test_zero_field_changes_digest(spec):
+    assert calculate_document_digest({'a': 1}, spec).get() != calculate_document_digest({'a': 1, 'b': 0}, spec).get()
+
+
+@pytest.mark.parametrize('spec', STRONG_SPECS)
+def test_key_order_does_not_change_digest(spec):
+    assert calculate_document_digest({'a': 1, 'b': {'c': 2, 'd': 3}}, spec).get() == \
+        calculate_document_digest({'b': {'d': 3, 'c': 2}, 'a': 1}, spec).get()